@@ -3,7 +3,7 @@ from __future__ import annotations
 from typing import Dict
 
 from pydantic_settings import BaseSettings
-from pydantic import field_validator
+from pydantic import BaseModel, field_validator
 
 
 
@@ -15,6 +15,13 @@ TARIFFS: Dict[str, dict] = {
 }
 
 
+class MarzbanNode(BaseModel):
+    name: str
+    base_url: str
+    api_key: str
+    max_users: int | None = None
+
+
 class Settings(BaseSettings):
     telegram_token: str
     telegram_admin_ids: list[int] = []
@@ -24,15 +31,82 @@ class Settings(BaseSettings):
     marzban_proxy: str = "vless"
     marzban_flow: str = "xtls-rprx-vision"
     marzban_inbounds: list[str] = ["VLESS TCP REALITY"]
+    marzban_connection_limit: int = 20
+    marzban_dns_cache_ttl: int = 300
+    marzban_keepalive_timeout: float = 30.0
+    marzban_request_timeout: float = 15.0
+    marzban_request_budget: float = 30.0
+    marzban_max_concurrency: int = 32
+    marzban_retry_attempts: int = 3
+    marzban_retry_base_delay: float = 0.5
+    marzban_retry_max_delay: float = 5.0
+    marzban_breaker_threshold: int = 5
+    marzban_breaker_reset: float = 30.0
+    marzban_token_refresh_margin: float = 60.0
+    # JSON list of {"name", "base_url", "api_key", "max_users"}; empty means
+    # a single node built from marzban_base_url/marzban_api_key.
+    marzban_nodes: list[MarzbanNode] = []
+    marzban_placement: str = "users"
+    marzban_health_interval: float = 15.0
+    marzban_health_timeout: float = 5.0
+    marzban_unhealthy_after: int = 3
+    marzban_healthy_after: int = 2
     payment_provider_key: str
     payment_public_key: str
     payment_webhook_secret: str
     payment_currency: str = "XTR"
     database_path: str = "./bot.db"
+    database_readers: int = 4
+    database_busy_timeout_ms: int = 5000
+    database_statement_cache_size: int = 256
     webhook_host: str = "0.0.0.0"
+    webhook_port: int = 8080
     webhook_path: str = "/payment/webhook"
+    telegram_webhook_url: str | None = None
+    telegram_webhook_path: str = "/telegram/webhook"
+    telegram_webhook_secret: str | None = None
+    update_concurrency: int = 64
+    shutdown_drain_timeout: float = 30.0
+    metrics_enabled: bool = False
+    metrics_path: str = "/metrics"
+    throttle_message_rate: float = 1.0
+    throttle_message_burst: int = 5
+    throttle_callback_rate: float = 2.0
+    throttle_callback_burst: int = 6
+    throttle_notice_interval: float = 10.0
+    throttle_max_users: int = 100_000
     base_subscription_days: int = 30
     referral_bonus_days: int = 7
+    marzban_sync_interval: float = 300.0
+    marzban_sync_page_size: int = 500
+    marzban_sync_max_staleness: float = 900.0
+    status_cache_size: int = 10000
+    status_cache_ttl: float = 30.0
+    status_cache_stale_ttl: float = 300.0
+    stats_cache_ttl: float = 10.0
+    reminder_horizon: float = 21600.0
+    reminder_expired_grace: float = 86400.0
+    reminder_rate_limit: float = 10.0
+    fsm_storage: str = "sqlite"
+    fsm_flush_interval: float = 2.0
+    fsm_cache_ttl: float = 30.0
+    fsm_state_ttl: float = 86400.0
+    user_lock_stripes: int = 0
+    lock_backend: str = "memory"
+    lock_lease_ttl: float = 30.0
+    provisioning_workers: int = 4
+    provisioning_max_attempts: int = 5
+    provisioning_base_delay: float = 5.0
+    provisioning_max_delay: float = 300.0
+    provisioning_poll_interval: float = 5.0
+    pending_retry_interval: float = 60.0
+    pending_retry_concurrency: int = 10
+    pending_retry_base_delay: float = 5.0
+    pending_retry_max_delay: float = 600.0
+    broadcast_concurrency: int = 20
+    broadcast_rate_limit: float = 25.0
+    broadcast_chunk_size: int = 500
+    broadcast_progress_interval: float = 5.0
     happ_apple_url: str = ""
     happ_windows_url: str = ""
     happ_android_url: str = ""
@@ -47,6 +121,18 @@ class Settings(BaseSettings):
             return [int(item.strip()) for item in value.split(",") if item.strip()]
         return [int(value)]
 
+    @field_validator("throttle_message_rate", "throttle_callback_rate")
+    def check_positive_rate(cls, value: float) -> float:
+        if value <= 0:
+            raise ValueError("must be greater than 0")
+        return value
+
+    @field_validator("throttle_notice_interval")
+    def check_notice_interval(cls, value: float) -> float:
+        if value < 0:
+            raise ValueError("must be 0 (no notices) or greater")
+        return value
+
     @field_validator("marzban_inbounds", mode="before")
     def parse_marzban_inbounds(cls, value: object) -> list[str]:
         if value is None or value == "":
@@ -57,14 +143,19 @@ class Settings(BaseSettings):
             return [item.strip() for item in value.split(",") if item.strip()]
         return [str(value)]
 
-    @field_validator("public_base_url", mode="before")
-    def parse_public_base_url(cls, value: object) -> str | None:
+    @field_validator("public_base_url", "telegram_webhook_url", "telegram_webhook_secret", mode="before")
+    def parse_optional_str(cls, value: object) -> str | None:
         if value is None:
             return None
         if isinstance(value, str):
             return value.strip() or None
         return str(value)
 
+    def cluster_nodes(self) -> list[MarzbanNode]:
+        if self.marzban_nodes:
+            return self.marzban_nodes
+        return [MarzbanNode(name="default", base_url=self.marzban_base_url, api_key=self.marzban_api_key)]
+
     class Config:
         env_file = ".env"
         env_prefix = ""
@@ -1,21 +1,273 @@
 from __future__ import annotations
 
 import asyncio
-from typing import Any
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+import sqlite3
+import time
+from typing import Any, AsyncIterator, Callable, Iterable, Sequence
 
 import aiosqlite
 
+SCHEMA_VERSION = 3
+
+_PAID = "('paid', 'paid_pending')"
+_NOW = "CAST(strftime('%s', 'now') AS INTEGER)"
+
+
+def _bump(period: str, size: int, metric: str, ts: str, delta: str) -> str:
+    return f"""
+        INSERT INTO stats_rollups (period, bucket, metric, value)
+        VALUES ('{period}', ({ts} / {size}) * {size}, '{metric}', {delta})
+        ON CONFLICT(period, bucket, metric) DO UPDATE SET value = value + excluded.value;"""
+
+
+def _counter(name: str, delta: str) -> str:
+    return f"""
+        INSERT INTO stats_counters (name, value) VALUES ('{name}', {delta})
+        ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;"""
+
+
+def _payment_delta(row: str, sign: str) -> str:
+    ts = f"COALESCE({row}.updated_at, {_NOW})"
+    return "".join(
+        [
+            _counter("paid_count", f"{sign}1"),
+            _counter("paid_amount", f"{sign}{row}.amount"),
+            _bump("hour", 3600, "payments", ts, f"{sign}1"),
+            _bump("day", 86400, "payments", ts, f"{sign}1"),
+            _bump("hour", 3600, "revenue", ts, f"{sign}{row}.amount"),
+            _bump("day", 86400, "revenue", ts, f"{sign}{row}.amount"),
+        ]
+    )
+
+
+def _expiry_delta(row: str, sign: str) -> str:
+    if sign == "+":
+        return f"""
+        INSERT INTO stats_expiry (bucket, users)
+        SELECT ({row}.subscription_expires_at / 3600) * 3600, 1 WHERE {row}.subscription_expires_at IS NOT NULL
+        ON CONFLICT(bucket) DO UPDATE SET users = users + 1;"""
+    return f"""
+        UPDATE stats_expiry SET users = users - 1
+        WHERE {row}.subscription_expires_at IS NOT NULL
+          AND bucket = ({row}.subscription_expires_at / 3600) * 3600;"""
+
+
+# Keep stats_* in step with the source tables so the admin panel never has to
+# aggregate them. stats_expiry holds users per expiry hour: counting active
+# subscriptions sums future buckets instead of scanning users.
+STATS_TRIGGERS = f"""
+    CREATE TRIGGER IF NOT EXISTS trg_stats_signup AFTER INSERT ON telegram_users
+    BEGIN{_counter("users", "1")}{_bump("hour", 3600, "signups", _NOW, "1")}{_bump("day", 86400, "signups", _NOW, "1")}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_stats_unsignup AFTER DELETE ON telegram_users
+    BEGIN{_counter("users", "-1")}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_stats_payment_insert AFTER INSERT ON payments
+    WHEN NEW.status IN {_PAID}
+    BEGIN{_payment_delta("NEW", "+")}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_stats_payment_paid AFTER UPDATE OF status ON payments
+    WHEN NEW.status IN {_PAID} AND OLD.status NOT IN {_PAID}
+    BEGIN{_payment_delta("NEW", "+")}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_stats_payment_unpaid AFTER UPDATE OF status ON payments
+    WHEN OLD.status IN {_PAID} AND NEW.status NOT IN {_PAID}
+    BEGIN{_payment_delta("OLD", "-")}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_stats_payment_delete AFTER DELETE ON payments
+    WHEN OLD.status IN {_PAID}
+    BEGIN{_payment_delta("OLD", "-")}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_stats_expiry_insert AFTER INSERT ON users
+    BEGIN{_expiry_delta("NEW", "+")}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_stats_expiry_update AFTER UPDATE OF subscription_expires_at ON users
+    WHEN OLD.subscription_expires_at IS NOT NEW.subscription_expires_at
+    BEGIN{_expiry_delta("OLD", "-")}{_expiry_delta("NEW", "+")}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_stats_expiry_delete AFTER DELETE ON users
+    BEGIN{_expiry_delta("OLD", "-")}
+    END;
+"""
+
+STATS_BACKFILL = (
+    "DELETE FROM stats_counters",
+    "DELETE FROM stats_rollups",
+    "DELETE FROM stats_expiry",
+    "INSERT INTO stats_counters (name, value) SELECT 'users', COUNT(*) FROM telegram_users",
+    f"INSERT INTO stats_counters (name, value) SELECT 'paid_count', COUNT(*) FROM payments WHERE status IN {_PAID}",
+    f"""INSERT INTO stats_counters (name, value)
+        SELECT 'paid_amount', COALESCE(SUM(amount), 0) FROM payments WHERE status IN {_PAID}""",
+    *(
+        f"""INSERT INTO stats_rollups (period, bucket, metric, value)
+            SELECT '{period}', (updated_at / {size}) * {size} AS b, 'payments', COUNT(*)
+            FROM payments WHERE status IN {_PAID} AND updated_at IS NOT NULL GROUP BY b"""
+        for period, size in (("hour", 3600), ("day", 86400))
+    ),
+    *(
+        f"""INSERT INTO stats_rollups (period, bucket, metric, value)
+            SELECT '{period}', (updated_at / {size}) * {size} AS b, 'revenue', SUM(amount)
+            FROM payments WHERE status IN {_PAID} AND updated_at IS NOT NULL GROUP BY b"""
+        for period, size in (("hour", 3600), ("day", 86400))
+    ),
+    *(
+        f"""INSERT INTO stats_rollups (period, bucket, metric, value)
+            SELECT '{period}', (CAST(strftime('%s', created_at) AS INTEGER) / {size}) * {size} AS b, 'signups', COUNT(*)
+            FROM telegram_users WHERE created_at IS NOT NULL GROUP BY b"""
+        for period, size in (("hour", 3600), ("day", 86400))
+    ),
+    """INSERT INTO stats_expiry (bucket, users)
+        SELECT (subscription_expires_at / 3600) * 3600 AS b, COUNT(*)
+        FROM users WHERE subscription_expires_at IS NOT NULL GROUP BY b""",
+)
+
 
 class Database:
-    def __init__(self, path: str):
+    """SQLite access with a single writer and an optional pool of readers.
+
+    With ``readers=0`` every statement goes through one connection guarded by
+    a lock. With ``readers > 0`` the database is switched to WAL mode and
+    ``fetchone``/``fetchall`` are served by dedicated read-only connections,
+    so reads no longer wait behind writes and their commits.
+
+    Rows come back as ``sqlite3.Row`` (indexable by position and by column
+    name). Every connection keeps up to ``statement_cache_size`` prepared
+    statements, so repositories keep their SQL in module constants and reuse
+    the exact same strings. ``statements`` counts issued statements and
+    ``observer``, if set, is called with ``("read" | "write", seconds)``.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        readers: int = 0,
+        busy_timeout_ms: int = 5000,
+        statement_cache_size: int = 256,
+    ):
         self._path = path
+        self._statement_cache_size = statement_cache_size
+        self.statements = 0
+        self.observer: Callable[[str, float], None] | None = None
         self._lock = asyncio.Lock()
         self._conn: aiosqlite.Connection | None = None
+        self._busy_timeout_ms = busy_timeout_ms
+        # WAL and extra connections make no sense for a private in-memory db.
+        self._reader_count = 0 if path == ":memory:" else max(readers, 0)
+        self._readers: asyncio.Queue[aiosqlite.Connection] | None = None
+        self._reader_conns: list[aiosqlite.Connection] = []
+        self._in_transaction: ContextVar[bool] = ContextVar(f"db_transaction_{id(self)}", default=False)
+
+    async def _open(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self._path, cached_statements=self._statement_cache_size)
+        conn.row_factory = sqlite3.Row
+        return conn
 
     async def connect(self) -> None:
-        self._conn = await aiosqlite.connect(self._path)
+        self._conn = await self._open()
         await self._conn.execute("PRAGMA foreign_keys = ON;")
+        await self._conn.execute(f"PRAGMA busy_timeout = {int(self._busy_timeout_ms)};")
+        if self._reader_count:
+            await self._conn.execute("PRAGMA journal_mode = WAL;")
+            await self._conn.execute("PRAGMA synchronous = NORMAL;")
         await self._create_schema()
+        if self._reader_count:
+            self._readers = asyncio.Queue()
+            for _ in range(self._reader_count):
+                reader = await self._open()
+                await reader.execute(f"PRAGMA busy_timeout = {int(self._busy_timeout_ms)};")
+                await reader.execute("PRAGMA query_only = ON;")
+                self._reader_conns.append(reader)
+                self._readers.put_nowait(reader)
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[None]:
+        """Run the enclosed statements under one commit, rolling back on error.
+
+        Nested calls join the outer transaction. Reads issued inside the block
+        go through the writer connection so they see uncommitted changes.
+        """
+        assert self._conn is not None
+        if self._in_transaction.get():
+            yield
+            return
+        async with self._lock:
+            token = self._in_transaction.set(True)
+            try:
+                await self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    yield
+                except BaseException:
+                    await self._conn.rollback()
+                    raise
+                await self._conn.commit()
+            finally:
+                self._in_transaction.reset(token)
+
+    @asynccontextmanager
+    async def _writer(self) -> AsyncIterator[aiosqlite.Connection]:
+        started = time.perf_counter()
+        try:
+            async with self._writer_conn() as conn:
+                yield conn
+        finally:
+            self._observe("write", started)
+
+    @asynccontextmanager
+    async def _reader(self) -> AsyncIterator[aiosqlite.Connection]:
+        started = time.perf_counter()
+        try:
+            async with self._reader_conn() as conn:
+                yield conn
+        finally:
+            self._observe("read", started)
+
+    def _observe(self, kind: str, started: float) -> None:
+        self.statements += 1
+        if self.observer is not None:
+            self.observer(kind, time.perf_counter() - started)
+
+    @asynccontextmanager
+    async def _writer_conn(self) -> AsyncIterator[aiosqlite.Connection]:
+        assert self._conn is not None
+        if self._in_transaction.get():
+            yield self._conn
+            return
+        async with self._lock:
+            try:
+                yield self._conn
+            except BaseException:
+                # sqlite3 opened an implicit transaction for the failed
+                # statement; left open it breaks every later BEGIN IMMEDIATE.
+                await self._conn.rollback()
+                raise
+            await self._conn.commit()
+
+    @asynccontextmanager
+    async def _reader_conn(self) -> AsyncIterator[aiosqlite.Connection]:
+        if self._in_transaction.get():
+            assert self._conn is not None
+            yield self._conn
+            return
+        if self._readers is None:
+            assert self._conn is not None
+            async with self._lock:
+                yield self._conn
+            return
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
 
     async def _create_schema(self) -> None:
         assert self._conn is not None
@@ -25,12 +277,16 @@ class Database:
                 telegram_id INTEGER PRIMARY KEY,
                 marzban_username TEXT NOT NULL UNIQUE,
                 marzban_uuid TEXT NOT NULL UNIQUE,
-                subscription_expires_at TEXT,
+                subscription_expires_at INTEGER,
                 subscription_link TEXT,
                 traffic_limit_gb REAL,
                 trial_used INTEGER DEFAULT 0,
                 referrer_telegram_id INTEGER,
                 referral_bonus_applied INTEGER DEFAULT 0,
+                used_traffic_bytes INTEGER,
+                synced_at INTEGER,
+                fencing_token INTEGER,
+                marzban_node TEXT,
                 created_at TEXT DEFAULT CURRENT_TIMESTAMP
             );
 
@@ -39,9 +295,36 @@ class Database:
                 trial_used INTEGER DEFAULT 0,
                 referrer_telegram_id INTEGER,
                 referral_bonus_applied INTEGER DEFAULT 0,
+                blocked INTEGER DEFAULT 0,
                 created_at TEXT DEFAULT CURRENT_TIMESTAMP
             );
 
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                from_chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                admin_chat_id INTEGER NOT NULL,
+                progress_message_id INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'running',
+                total INTEGER DEFAULT 0,
+                last_telegram_id INTEGER DEFAULT 0,
+                processed INTEGER DEFAULT 0,
+                delivered INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                blocked INTEGER DEFAULT 0,
+                created_at INTEGER,
+                updated_at INTEGER
+            );
+
+            CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+                job_id INTEGER NOT NULL,
+                telegram_id INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                created_at INTEGER,
+                PRIMARY KEY (job_id, telegram_id),
+                FOREIGN KEY(job_id) REFERENCES broadcast_jobs(id)
+            );
+
             CREATE TABLE IF NOT EXISTS payments (
                 invoice_id TEXT PRIMARY KEY,
                 telegram_id INTEGER NOT NULL,
@@ -49,11 +332,77 @@ class Database:
                 amount REAL NOT NULL,
                 currency TEXT NOT NULL,
                 status TEXT NOT NULL,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                created_at INTEGER,
+                updated_at INTEGER,
                 UNIQUE(invoice_id, status)
             );
 
+            CREATE TABLE IF NOT EXISTS provisioning_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                invoice_id TEXT NOT NULL UNIQUE,
+                telegram_id INTEGER NOT NULL,
+                chat_id INTEGER,
+                status TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER DEFAULT 0,
+                next_run_at INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                created_at INTEGER,
+                updated_at INTEGER
+            );
+
+            CREATE TABLE IF NOT EXISTS locks (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL DEFAULT '',
+                token INTEGER NOT NULL DEFAULT 0,
+                expires_at INTEGER NOT NULL DEFAULT 0
+            );
+
+            CREATE TABLE IF NOT EXISTS api_tokens (
+                name TEXT PRIMARY KEY,
+                token TEXT NOT NULL,
+                expires_at INTEGER
+            );
+
+            CREATE TABLE IF NOT EXISTS fsm_states (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT NOT NULL DEFAULT '{}',
+                updated_at INTEGER NOT NULL DEFAULT 0
+            );
+
+            CREATE TABLE IF NOT EXISTS stats_counters (
+                name TEXT PRIMARY KEY,
+                value REAL NOT NULL DEFAULT 0
+            );
+
+            CREATE TABLE IF NOT EXISTS stats_rollups (
+                period TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                metric TEXT NOT NULL,
+                value REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (period, metric, bucket)
+            );
+
+            CREATE TABLE IF NOT EXISTS stats_expiry (
+                bucket INTEGER PRIMARY KEY,
+                users INTEGER NOT NULL DEFAULT 0
+            );
+
+            CREATE TABLE IF NOT EXISTS reminders_sent (
+                telegram_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                expires_at INTEGER NOT NULL,
+                sent_at INTEGER NOT NULL,
+                PRIMARY KEY (telegram_id, kind, expires_at)
+            );
+
+            CREATE TABLE IF NOT EXISTS marzban_orphans (
+                node TEXT NOT NULL,
+                username TEXT NOT NULL,
+                created_at INTEGER NOT NULL,
+                PRIMARY KEY (node, username)
+            );
+
             CREATE TABLE IF NOT EXISTS referrals (
                 referrer_id INTEGER NOT NULL,
                 referred_id INTEGER NOT NULL UNIQUE,
@@ -63,6 +412,7 @@ class Database:
 
             CREATE INDEX IF NOT EXISTS idx_payments_user ON payments(telegram_id);
             CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer_id);
+            CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs(status);
             """
         )
         await self._conn.execute(
@@ -73,6 +423,72 @@ class Database:
         )
         await self._ensure_user_columns()
         await self._conn.commit()
+        await self._migrate()
+        # Created after the migration: an index on a column that is about to
+        # be renamed and dropped would block the DROP COLUMN.
+        await self._conn.executescript(
+            """
+            CREATE INDEX IF NOT EXISTS idx_users_expires ON users(subscription_expires_at);
+            CREATE INDEX IF NOT EXISTS idx_payments_status_updated ON payments(status, updated_at);
+            CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states(updated_at);
+            CREATE INDEX IF NOT EXISTS idx_provisioning_jobs_due ON provisioning_jobs(status, next_run_at);
+            """
+            + STATS_TRIGGERS
+        )
+
+    async def _migrate(self) -> None:
+        assert self._conn is not None
+        cursor = await self._conn.execute("PRAGMA user_version;")
+        version = (await cursor.fetchone())[0]
+        await cursor.close()
+        if version >= SCHEMA_VERSION:
+            return
+        await self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            if version < 1:
+                # ISO text timestamps -> integer epoch seconds (UTC).
+                await self._convert_to_epoch("users", "subscription_expires_at")
+                await self._convert_to_epoch("payments", "created_at")
+                await self._convert_to_epoch("payments", "updated_at")
+            if version < 2:
+                for statement in STATS_BACKFILL:
+                    await self._conn.execute(statement)
+            if version < 3:
+                # Worker tables: TEXT CURRENT_TIMESTAMP / REAL time.time() -> epoch seconds.
+                await self._conn.execute("DROP INDEX IF EXISTS idx_fsm_states_updated")
+                await self._conn.execute("DROP INDEX IF EXISTS idx_provisioning_jobs_due")
+                for table, column, definition in (
+                    ("provisioning_jobs", "next_run_at", "INTEGER NOT NULL DEFAULT 0"),
+                    ("provisioning_jobs", "created_at", "INTEGER"),
+                    ("provisioning_jobs", "updated_at", "INTEGER"),
+                    ("broadcast_jobs", "created_at", "INTEGER"),
+                    ("broadcast_jobs", "updated_at", "INTEGER"),
+                    ("broadcast_deliveries", "created_at", "INTEGER"),
+                    ("locks", "expires_at", "INTEGER NOT NULL DEFAULT 0"),
+                    ("api_tokens", "expires_at", "INTEGER"),
+                    ("fsm_states", "updated_at", "INTEGER NOT NULL DEFAULT 0"),
+                ):
+                    await self._convert_to_epoch(table, column, definition)
+            await self._conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION};")
+        except BaseException:
+            await self._conn.rollback()
+            raise
+        await self._conn.commit()
+
+    async def _convert_to_epoch(self, table: str, column: str, definition: str = "INTEGER") -> None:
+        assert self._conn is not None
+        cursor = await self._conn.execute(f"PRAGMA table_info({table});")
+        types = {row[1]: (row[2] or "").upper() for row in await cursor.fetchall()}
+        await cursor.close()
+        if types.get(column) == "INTEGER":
+            return
+        legacy = f"{column}_iso"
+        await self._conn.execute(f"ALTER TABLE {table} RENAME COLUMN {column} TO {legacy}")
+        await self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        # REAL columns already hold epoch seconds (time.time()); TEXT ones are ISO.
+        source = f"CAST({legacy} AS INTEGER)" if types[column] == "REAL" else f"CAST(strftime('%s', {legacy}) AS INTEGER)"
+        await self._conn.execute(f"UPDATE {table} SET {column} = {source} WHERE {legacy} IS NOT NULL")
+        await self._conn.execute(f"ALTER TABLE {table} DROP COLUMN {legacy}")
 
     async def _ensure_user_columns(self) -> None:
         assert self._conn is not None
@@ -82,6 +498,10 @@ class Database:
                 "trial_used": "INTEGER DEFAULT 0",
                 "referrer_telegram_id": "INTEGER",
                 "referral_bonus_applied": "INTEGER DEFAULT 0",
+                "used_traffic_bytes": "INTEGER",
+                "synced_at": "INTEGER",
+                "fencing_token": "INTEGER",
+                "marzban_node": "TEXT",
             },
         )
         await self._ensure_columns(
@@ -90,6 +510,7 @@ class Database:
                 "trial_used": "INTEGER DEFAULT 0",
                 "referrer_telegram_id": "INTEGER",
                 "referral_bonus_applied": "INTEGER DEFAULT 0",
+                "blocked": "INTEGER DEFAULT 0",
             },
         )
 
@@ -105,36 +526,45 @@ class Database:
                 )
 
     async def execute(self, query: str, *args: Any) -> None:
-        assert self._conn is not None
-        async with self._lock:
-            await self._conn.execute(query, args)
-            await self._conn.commit()
+        async with self._writer() as conn:
+            await conn.execute(query, args)
 
     async def execute_with_rowcount(self, query: str, *args: Any) -> int:
-        assert self._conn is not None
-        async with self._lock:
-            cursor = await self._conn.execute(query, args)
-            await self._conn.commit()
+        async with self._writer() as conn:
+            cursor = await conn.execute(query, args)
             rowcount = cursor.rowcount
             await cursor.close()
-            return rowcount
+        return rowcount
+
+    async def executemany(self, query: str, rows: Iterable[Sequence[Any]]) -> None:
+        async with self._writer() as conn:
+            await conn.executemany(query, rows)
+
+    async def execute_with_lastrowid(self, query: str, *args: Any) -> int:
+        async with self._writer() as conn:
+            cursor = await conn.execute(query, args)
+            lastrowid = cursor.lastrowid
+            await cursor.close()
+        return lastrowid
 
     async def fetchone(self, query: str, *args: Any) -> Any:
-        assert self._conn is not None
-        async with self._lock:
-            cursor = await self._conn.execute(query, args)
+        async with self._reader() as conn:
+            cursor = await conn.execute(query, args)
             row = await cursor.fetchone()
             await cursor.close()
             return row
 
     async def fetchall(self, query: str, *args: Any) -> list[Any]:
-        assert self._conn is not None
-        async with self._lock:
-            cursor = await self._conn.execute(query, args)
+        async with self._reader() as conn:
+            cursor = await conn.execute(query, args)
             rows = await cursor.fetchall()
             await cursor.close()
             return rows
 
     async def close(self) -> None:
+        for reader in self._reader_conns:
+            await reader.close()
+        self._reader_conns.clear()
+        self._readers = None
         if self._conn:
             await self._conn.close()
@@ -1,19 +1,17 @@
 from __future__ import annotations
 
-from datetime import datetime
-
 from aiogram import F, Router
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import CallbackQuery, Message
-from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 
 from app.config import Settings
-from app.keyboards.admin import admin_broadcast_keyboard, admin_panel_keyboard
-from app.repositories.payment_repository import PaymentRepository
-from app.repositories.user_repository import UserRepository
-from app.services.subscription import SubscriptionService
+from app.keyboards.admin import admin_broadcast_keyboard, admin_nodes_keyboard, admin_panel_keyboard
+from app.services.broadcast import BroadcastService
+from app.services.marzban_cluster import MarzbanCluster
+from app.services.reconciliation import PendingPaymentWorker
+from app.services.stats import StatsService
 
 router = Router()
 
@@ -26,31 +24,45 @@ def _is_admin(user_id: int, settings: Settings) -> bool:
     return user_id in settings.telegram_admin_ids
 
 
-async def _render_stats(user_repo: UserRepository, payment_repo: PaymentRepository) -> str:
-    total_users = await user_repo.count_users()
-    active_users = await user_repo.count_active_subscriptions(datetime.utcnow().isoformat())
-    paid_count = await payment_repo.count_paid_invoices()
-    paid_total = await payment_repo.sum_paid_amount()
+async def _render_stats(stats_service: StatsService) -> str:
+    stats = await stats_service.snapshot()
     return (
         "Админ-панель\n\n"
-        f"Пользователей всего: {total_users}\n"
-        f"Активных подписок: {active_users}\n"
-        f"Оплат успешно: {paid_count}\n"
-        f"Выручка (в валюте): {paid_total:.2f}"
+        f"Пользователей всего: {stats.total_users}\n"
+        f"Активных подписок: {stats.active_subscriptions}\n"
+        f"Оплат успешно: {stats.paid_count}\n"
+        f"Выручка (в валюте): {stats.paid_total:.2f}\n\n"
+        f"Сегодня: регистраций {stats.signups_today}, выручка {stats.revenue_today:.2f}\n"
+        f"За 24 часа: регистраций {stats.signups_24h}, выручка {stats.revenue_24h:.2f}"
     )
 
 
+def _render_nodes(cluster: MarzbanCluster) -> str:
+    lines = ["Ноды Marzban\n"]
+    for name in cluster.nodes:
+        health = cluster.health[name]
+        load = cluster.loads[name]
+        latency = f"{health.latency_ms:.0f} мс" if health.latency_ms is not None else "—"
+        limit = f"/{load.max_users}" if load.max_users else ""
+        lines.append(
+            f"{'🟢' if health.healthy else '🔴'} {name}: задержка {latency}, "
+            f"пользователей {load.users}{limit} (активных {load.active_users})"
+        )
+        if health.last_error:
+            lines.append(f"    ошибок подряд: {health.failures}, последняя: {health.last_error[:200]}")
+    return "\n".join(lines)
+
+
 @router.message(Command("admin"))
 async def admin_panel(
     message: Message,
     settings: Settings,
-    user_repo: UserRepository,
-    payment_repo: PaymentRepository,
+    stats_service: StatsService,
 ) -> None:
     if not _is_admin(message.from_user.id, settings):
         await message.answer("Доступ запрещён.")
         return
-    text = await _render_stats(user_repo, payment_repo)
+    text = await _render_stats(stats_service)
     await message.answer(text, reply_markup=admin_panel_keyboard())
 
 
@@ -58,31 +70,22 @@ async def admin_panel(
 async def retry_pending(
     message: Message,
     settings: Settings,
-    payment_repo: PaymentRepository,
-    subscription_service: SubscriptionService,
+    pending_worker: PendingPaymentWorker,
 ) -> None:
     if not _is_admin(message.from_user.id, settings):
         await message.answer("Доступ запрещён.")
         return
-    pending = await payment_repo.list_pending_invoices()
-    if not pending:
+    success, failed = await pending_worker.run_once(force=True)
+    if not success and not failed:
         await message.answer("Нет платежей для повторной выдачи.")
         return
-    success = 0
-    failed = 0
-    for invoice_id in pending:
-        try:
-            user = await subscription_service.process_payment_success(invoice_id)
-            if user:
-                success += 1
-            else:
-                failed += 1
-        except Exception:
-            failed += 1
+    metrics = pending_worker.metrics
     await message.answer(
         "Повторная выдача завершена.\n"
         f"Успешно: {success}\n"
-        f"Ошибок: {failed}"
+        f"Ошибок: {failed}\n"
+        f"Осталось в очереди: {metrics.backlog}\n"
+        f"Всего попыток воркера: {metrics.attempts}"
     )
 
 
@@ -90,17 +93,31 @@ async def retry_pending(
 async def admin_refresh(
     callback: CallbackQuery,
     settings: Settings,
-    user_repo: UserRepository,
-    payment_repo: PaymentRepository,
+    stats_service: StatsService,
 ) -> None:
     if not _is_admin(callback.from_user.id, settings):
         await callback.answer("Нет доступа.", show_alert=True)
         return
-    text = await _render_stats(user_repo, payment_repo)
+    text = await _render_stats(stats_service)
     await callback.message.edit_text(text, reply_markup=admin_panel_keyboard())
     await callback.answer()
 
 
+@router.callback_query(F.data.in_(["admin:nodes", "admin:nodes_check"]))
+async def admin_nodes(
+    callback: CallbackQuery,
+    settings: Settings,
+    marzban_cluster: MarzbanCluster,
+) -> None:
+    if not _is_admin(callback.from_user.id, settings):
+        await callback.answer("Нет доступа.", show_alert=True)
+        return
+    if callback.data == "admin:nodes_check":
+        await marzban_cluster.check_nodes()
+    await callback.message.edit_text(_render_nodes(marzban_cluster), reply_markup=admin_nodes_keyboard())
+    await callback.answer()
+
+
 @router.callback_query(F.data == "admin:broadcast")
 async def admin_broadcast_start(
     callback: CallbackQuery,
@@ -122,15 +139,14 @@ async def admin_broadcast_start(
 async def admin_broadcast_cancel(
     callback: CallbackQuery,
     settings: Settings,
-    user_repo: UserRepository,
-    payment_repo: PaymentRepository,
+    stats_service: StatsService,
     state: FSMContext,
 ) -> None:
     if not _is_admin(callback.from_user.id, settings):
         await callback.answer("Нет доступа.", show_alert=True)
         return
     await state.clear()
-    text = await _render_stats(user_repo, payment_repo)
+    text = await _render_stats(stats_service)
     await callback.message.edit_text(f"Рассылка отменена.\n\n{text}", reply_markup=admin_panel_keyboard())
     await callback.answer()
 
@@ -139,15 +155,14 @@ async def admin_broadcast_cancel(
 async def admin_back_to_panel(
     callback: CallbackQuery,
     settings: Settings,
-    user_repo: UserRepository,
-    payment_repo: PaymentRepository,
+    stats_service: StatsService,
     state: FSMContext,
 ) -> None:
     if not _is_admin(callback.from_user.id, settings):
         await callback.answer("Нет доступа.", show_alert=True)
         return
     await state.clear()
-    text = await _render_stats(user_repo, payment_repo)
+    text = await _render_stats(stats_service)
     await callback.message.edit_text(text, reply_markup=admin_panel_keyboard())
     await callback.answer()
 
@@ -157,25 +172,16 @@ async def admin_broadcast_send(
     message: Message,
     settings: Settings,
     state: FSMContext,
-    user_repo: UserRepository,
+    broadcast_service: BroadcastService,
 ) -> None:
     if not _is_admin(message.from_user.id, settings):
         await message.answer("Доступ запрещён.")
         return
-    user_ids = await user_repo.list_telegram_ids()
-    success = 0
-    failed = 0
-    for user_id in user_ids:
-        try:
-            await message.copy_to(user_id)
-            success += 1
-        except (TelegramForbiddenError, TelegramBadRequest):
-            failed += 1
     await state.clear()
-    await message.answer(
-        "Рассылка завершена.\n"
-        f"Получателей: {len(user_ids)}\n"
-        f"Доставлено: {success}\n"
-        f"Ошибок: {failed}",
-        reply_markup=admin_panel_keyboard(),
+    progress_message = await message.answer("Рассылка запущена…")
+    await broadcast_service.start(
+        from_chat_id=message.chat.id,
+        message_id=message.message_id,
+        admin_chat_id=message.chat.id,
+        progress_message_id=progress_message.message_id,
     )
@@ -5,10 +5,10 @@ import logging
 from aiogram import F, Router
 from aiogram.types import CallbackQuery, LabeledPrice, Message, PreCheckoutQuery
 
-from app.config import Settings
-from app.keyboards.common import connection_keyboard, tariffs_keyboard
+from app.keyboards.common import tariffs_keyboard
 from app.repositories.payment_repository import PaymentRepository
 from app.services.payments import PaymentService
+from app.services.provisioning import ProvisioningQueue
 from app.services.subscription import SubscriptionService
 
 router = Router()
@@ -48,8 +48,7 @@ async def handle_pre_checkout(pre_checkout_query: PreCheckoutQuery) -> None:
 async def handle_successful_payment(
     message: Message,
     payment_repo: PaymentRepository,
-    subscription_service: SubscriptionService,
-    settings: Settings,
+    provisioning_queue: ProvisioningQueue,
 ) -> None:
     payment = message.successful_payment
     payload_to_tariff = {
@@ -63,56 +62,12 @@ async def handle_successful_payment(
         await message.answer("Платеж получен, но тариф не найден. Напиши в поддержку.")
         return
     invoice_id = payment.telegram_payment_charge_id
-    await payment_repo.create_invoice(
+    await payment_repo.accept_paid(
         invoice_id,
         message.from_user.id,
         tariff_code,
         float(payment.total_amount),
         payment.currency,
     )
-    try:
-        user = await subscription_service.process_payment_success(invoice_id)
-    except Exception as exc:
-        logger.exception("Failed to provision after payment: invoice_id=%s", invoice_id)
-        await payment_repo.mark_paid_pending(invoice_id)
-        for admin_id in settings.telegram_admin_ids:
-            await message.bot.send_message(
-                admin_id,
-                "ℹ️ Оплата принята, но выдача доступа отложена.\n"
-                f"Invoice: {invoice_id}\n"
-                f"Ошибка: {exc}",
-            )
-        await message.answer(
-            "Оплата подтверждена, но выдача доступа задержана. Мы уже работаем над этим."
-        )
-        return
-    if user and user.subscription_link:
-        await _send_access(message, user.subscription_link)
-        return
-    if user:
-        status = await subscription_service.get_status(user.telegram_id)
-        if status and status.subscription_link:
-            await _send_access(message, status.subscription_link)
-<<<<<<< HEAD
-        return
-=======
-            return
-            
->>>>>>> e2229bf (Fix bug)
-    await message.answer(
-        "Оплата подтверждена, но ссылка на подписку пока не готова. Напиши в поддержку."
-    )
-
-async def _send_access(message: Message, link: str) -> None:
-    keyboard = connection_keyboard(link)
-    if not keyboard:
-        logger.warning("Access link invalid for connection button: %s", link)
-        await message.answer("ℹ️ Access link is not ready yet.")
-        return
-    await message.answer(
-        "🛡 DagDev VPN\n"
-        "━━━━━━━━━━━━\n"
-        "Your VPN is ready.\n"
-        "Tap the button below to connect.",
-        reply_markup=keyboard,
-    )
+    await provisioning_queue.enqueue(invoice_id, chat_id=message.chat.id)
+    await message.answer("Оплата подтверждена. Выдаём доступ, это займёт несколько секунд.")
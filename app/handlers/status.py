@@ -22,6 +22,8 @@ async def show_status(
         return
     expires_at = user.subscription_expires_at.strftime("%d.%m.%Y") if user.subscription_expires_at else "—"
     traffic_limit = f"{user.traffic_limit_gb:.0f} GB" if user.traffic_limit_gb else "—"
+    if user.used_traffic_bytes is not None:
+        traffic_limit = f"{user.used_traffic_bytes / 1024**3:.1f} / {traffic_limit}"
     server_label = settings.marzban_inbounds[0] if settings.marzban_inbounds else ""
     text_lines = ["🛡 DagDev VPN", "━━━━━━━━━━━━", f"ℹ️ До: {expires_at}", f"📊 Трафик: {traffic_limit}"]
     if server_label:
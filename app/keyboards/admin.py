@@ -7,12 +7,22 @@ def admin_panel_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         inline_keyboard=[
             [InlineKeyboardButton(text="📈 Статистика", callback_data="admin:stats")],
+            [InlineKeyboardButton(text="🖥 Ноды", callback_data="admin:nodes")],
             [InlineKeyboardButton(text="📣 Рассылка", callback_data="admin:broadcast")],
             [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin:refresh")],
         ]
     )
 
 
+def admin_nodes_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="🔄 Проверить", callback_data="admin:nodes_check")],
+            [InlineKeyboardButton(text="◀️ В админ-панель", callback_data="admin:back")],
+        ]
+    )
+
+
 def admin_broadcast_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         inline_keyboard=[
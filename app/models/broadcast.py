@@ -0,0 +1,19 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+
+
+@dataclass
+class BroadcastJob:
+    id: int
+    from_chat_id: int
+    message_id: int
+    admin_chat_id: int
+    progress_message_id: int
+    status: str
+    total: int = 0
+    last_telegram_id: int = 0
+    processed: int = 0
+    delivered: int = 0
+    failed: int = 0
+    blocked: int = 0
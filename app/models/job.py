@@ -0,0 +1,14 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+
+
+@dataclass
+class ProvisioningJob:
+    id: int
+    invoice_id: str
+    telegram_id: int
+    chat_id: int | None
+    status: str
+    attempts: int
+    last_error: str | None = None
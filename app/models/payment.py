@@ -21,3 +21,5 @@ class PaymentResult:
     amount: float
     currency: str
     paid_at: datetime
+    telegram_id: int | None = None
+    tariff_code: str | None = None
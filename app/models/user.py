@@ -16,3 +16,15 @@ class User:
     trial_used: bool = False
     referrer_telegram_id: int | None = None
     referral_bonus_applied: bool = False
+    used_traffic_bytes: int | None = None
+    synced_at: datetime | None = None
+    marzban_node: str | None = None
+
+
+@dataclass
+class UserMeta:
+    """Per-Telegram-account flags, known even before a subscription exists."""
+
+    trial_used: bool = False
+    referrer_telegram_id: int | None = None
+    referral_bonus_applied: bool = False
@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+from app.db import Database
+from app.models.broadcast import BroadcastJob
+from app.utils.epoch import SQL_EPOCH_NOW
+
+
+class BroadcastRepository:
+    def __init__(self, db: Database):
+        self._db = db
+
+    async def create_job(
+        self,
+        from_chat_id: int,
+        message_id: int,
+        admin_chat_id: int,
+        progress_message_id: int,
+        total: int,
+    ) -> BroadcastJob:
+        job_id = await self._db.execute_with_lastrowid(
+            f"""
+            INSERT INTO broadcast_jobs (
+                from_chat_id, message_id, admin_chat_id, progress_message_id, total, created_at, updated_at
+            )
+            VALUES (?, ?, ?, ?, ?, {SQL_EPOCH_NOW}, {SQL_EPOCH_NOW})
+            """,
+            from_chat_id,
+            message_id,
+            admin_chat_id,
+            progress_message_id,
+            total,
+        )
+        return BroadcastJob(
+            id=job_id,
+            from_chat_id=from_chat_id,
+            message_id=message_id,
+            admin_chat_id=admin_chat_id,
+            progress_message_id=progress_message_id,
+            status="running",
+            total=total,
+        )
+
+    async def list_unfinished(self) -> list[BroadcastJob]:
+        rows = await self._db.fetchall(
+            """
+            SELECT id, from_chat_id, message_id, admin_chat_id, progress_message_id, status,
+                   total, last_telegram_id, processed, delivered, failed, blocked
+            FROM broadcast_jobs WHERE status = 'running' ORDER BY id
+            """
+        )
+        return [BroadcastJob(*row) for row in rows]
+
+    async def get_deliveries(self, job_id: int, first_id: int, last_id: int) -> dict[int, str]:
+        rows = await self._db.fetchall(
+            """
+            SELECT telegram_id, status FROM broadcast_deliveries
+            WHERE job_id = ? AND telegram_id BETWEEN ? AND ?
+            """,
+            job_id,
+            first_id,
+            last_id,
+        )
+        return {row[0]: row[1] for row in rows}
+
+    async def record_delivery(self, job_id: int, telegram_id: int, status: str) -> None:
+        await self._db.execute(
+            f"INSERT OR IGNORE INTO broadcast_deliveries (job_id, telegram_id, status, created_at) VALUES (?, ?, ?, {SQL_EPOCH_NOW})",
+            job_id,
+            telegram_id,
+            status,
+        )
+
+    async def checkpoint(self, job: BroadcastJob) -> None:
+        await self._db.execute(
+            f"""
+            UPDATE broadcast_jobs
+            SET last_telegram_id = ?, processed = ?, delivered = ?, failed = ?, blocked = ?,
+                updated_at = {SQL_EPOCH_NOW}
+            WHERE id = ?
+            """,
+            job.last_telegram_id,
+            job.processed,
+            job.delivered,
+            job.failed,
+            job.blocked,
+            job.id,
+        )
+
+    async def finish(self, job: BroadcastJob, status: str = "done") -> None:
+        async with self._db.transaction():
+            await self.checkpoint(job)
+            await self._db.execute(
+                f"UPDATE broadcast_jobs SET status = ?, updated_at = {SQL_EPOCH_NOW} WHERE id = ?",
+                status,
+                job.id,
+            )
@@ -0,0 +1,44 @@
+from __future__ import annotations
+
+from typing import Iterable
+
+from app.db import Database
+
+
+class FSMRepository:
+    def __init__(self, db: Database):
+        self._db = db
+
+    async def load(self, key: str, min_updated_at: float) -> tuple[str | None, str, float] | None:
+        return await self._db.fetchone(
+            "SELECT state, data, updated_at FROM fsm_states WHERE key = ? AND updated_at >= ?",
+            key,
+            min_updated_at,
+        )
+
+    async def save_many(
+        self,
+        upserts: Iterable[tuple[str, str | None, str, float]],
+        deletes: Iterable[str],
+    ) -> None:
+        async with self._db.transaction():
+            await self._db.executemany(
+                """
+                INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    state = excluded.state,
+                    data = excluded.data,
+                    updated_at = excluded.updated_at
+                """,
+                [(key, state, data, int(updated_at)) for key, state, data, updated_at in upserts],
+            )
+            await self._db.executemany(
+                "DELETE FROM fsm_states WHERE key = ?",
+                [(key,) for key in deletes],
+            )
+
+    async def purge_expired(self, before: float) -> int:
+        return await self._db.execute_with_rowcount(
+            "DELETE FROM fsm_states WHERE updated_at < ?",
+            before,
+        )
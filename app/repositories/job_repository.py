@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import math
+
+from app.db import Database
+from app.models.job import ProvisioningJob
+from app.utils.epoch import SQL_EPOCH_NOW
+
+
+class ProvisioningJobRepository:
+    def __init__(self, db: Database):
+        self._db = db
+
+    async def enqueue(self, invoice_id: str, telegram_id: int, chat_id: int | None) -> bool:
+        rowcount = await self._db.execute_with_rowcount(
+            f"""
+            INSERT OR IGNORE INTO provisioning_jobs (invoice_id, telegram_id, chat_id, next_run_at, created_at, updated_at)
+            VALUES (?, ?, ?, {SQL_EPOCH_NOW}, {SQL_EPOCH_NOW}, {SQL_EPOCH_NOW})
+            """,
+            invoice_id,
+            telegram_id,
+            chat_id,
+        )
+        return rowcount == 1
+
+    async def claim(self, limit: int = 1) -> list[ProvisioningJob]:
+        """Atomically move due queued jobs to running and return them."""
+        async with self._db.transaction():
+            rows = await self._db.fetchall(
+                f"""
+                SELECT id, invoice_id, telegram_id, chat_id, status, attempts, last_error
+                FROM provisioning_jobs
+                WHERE status = 'queued' AND next_run_at <= {SQL_EPOCH_NOW}
+                ORDER BY next_run_at
+                LIMIT ?
+                """,
+                limit,
+            )
+            for row in rows:
+                await self._db.execute(
+                    f"""
+                    UPDATE provisioning_jobs
+                    SET status = 'running', attempts = attempts + 1, updated_at = {SQL_EPOCH_NOW}
+                    WHERE id = ?
+                    """,
+                    row[0],
+                )
+        jobs = [ProvisioningJob(*row) for row in rows]
+        for job in jobs:
+            job.status = "running"
+            job.attempts += 1
+        return jobs
+
+    async def complete(self, job_id: int) -> None:
+        await self._db.execute(
+            f"UPDATE provisioning_jobs SET status = 'done', last_error = NULL, updated_at = {SQL_EPOCH_NOW} WHERE id = ?",
+            job_id,
+        )
+
+    async def retry_later(self, job_id: int, delay: float, error: str) -> None:
+        await self._db.execute(
+            f"""
+            UPDATE provisioning_jobs
+            SET status = 'queued', next_run_at = {SQL_EPOCH_NOW} + ?, last_error = ?, updated_at = {SQL_EPOCH_NOW}
+            WHERE id = ?
+            """,
+            math.ceil(delay),
+            error,
+            job_id,
+        )
+
+    async def bury(self, job_id: int, error: str) -> None:
+        await self._db.execute(
+            f"UPDATE provisioning_jobs SET status = 'dead', last_error = ?, updated_at = {SQL_EPOCH_NOW} WHERE id = ?",
+            error,
+            job_id,
+        )
+
+    async def requeue_running(self) -> int:
+        """Return jobs left 'running' by a crashed process to the queue."""
+        return await self._db.execute_with_rowcount(
+            f"UPDATE provisioning_jobs SET status = 'queued', updated_at = {SQL_EPOCH_NOW} WHERE status = 'running'"
+        )
+
+    async def count_by_status(self) -> dict[str, int]:
+        rows = await self._db.fetchall("SELECT status, COUNT(*) FROM provisioning_jobs GROUP BY status")
+        return {row[0]: row[1] for row in rows}
@@ -0,0 +1,57 @@
+from __future__ import annotations
+
+import math
+import time
+
+from app.db import Database
+
+
+class LockRepository:
+    """Lease rows for cross-process locks.
+
+    Rows are never deleted, only expired, so each lock name's fencing token
+    keeps increasing across holders.
+    """
+
+    def __init__(self, db: Database):
+        self._db = db
+
+    async def try_acquire(self, name: str, owner: str, ttl: float) -> int | None:
+        """Take the lease if it is free or expired; returns its new fencing token."""
+        # Epoch seconds: the expiry is rounded up so a lease never looks free early.
+        now = time.time()
+        async with self._db.transaction():
+            rowcount = await self._db.execute_with_rowcount(
+                """
+                INSERT INTO locks (name, owner, token, expires_at) VALUES (?, ?, 1, ?)
+                ON CONFLICT(name) DO UPDATE SET
+                    owner = excluded.owner,
+                    token = locks.token + 1,
+                    expires_at = excluded.expires_at
+                WHERE locks.expires_at < ?
+                """,
+                name,
+                owner,
+                math.ceil(now + ttl),
+                int(now),
+            )
+            if rowcount != 1:
+                return None
+            row = await self._db.fetchone("SELECT token FROM locks WHERE name = ?", name)
+        return row[0] if row else None
+
+    async def renew(self, name: str, owner: str, ttl: float) -> bool:
+        rowcount = await self._db.execute_with_rowcount(
+            "UPDATE locks SET expires_at = ? WHERE name = ? AND owner = ?",
+            math.ceil(time.time() + ttl),
+            name,
+            owner,
+        )
+        return rowcount == 1
+
+    async def release(self, name: str, owner: str) -> None:
+        await self._db.execute(
+            "UPDATE locks SET owner = '', expires_at = 0 WHERE name = ? AND owner = ?",
+            name,
+            owner,
+        )
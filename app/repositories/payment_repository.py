@@ -1,8 +1,25 @@
 from __future__ import annotations
 
-from datetime import datetime
-
 from app.db import Database
+from app.utils.epoch import SQL_EPOCH_NOW
+
+# created_at/updated_at are integer epoch seconds, stamped by SQLite itself.
+INSERT_INVOICE = f"""
+    INSERT OR IGNORE INTO payments (
+        invoice_id, telegram_id, tariff_code, amount, currency, status, created_at, updated_at
+    )
+    VALUES (?, ?, ?, ?, ?, 'pending', {SQL_EPOCH_NOW}, {SQL_EPOCH_NOW})
+"""
+SET_STATUS = f"UPDATE payments SET status = ?, updated_at = {SQL_EPOCH_NOW} WHERE invoice_id = ?"
+SET_PAID_PENDING = f"UPDATE payments SET status = 'paid_pending', updated_at = {SQL_EPOCH_NOW} WHERE invoice_id = ?"
+ACCEPT_PAID = f"""
+    UPDATE payments SET status = 'paid_pending', updated_at = {SQL_EPOCH_NOW}
+    WHERE invoice_id = ? AND status = 'pending'
+"""
+COMPLETE = f"""
+    UPDATE payments SET status = 'paid', updated_at = {SQL_EPOCH_NOW}
+    WHERE invoice_id = ? AND status != 'paid'
+"""
 
 
 class PaymentRepository:
@@ -11,10 +28,7 @@ class PaymentRepository:
 
     async def create_invoice(self, invoice_id: str, telegram_id: int, tariff_code: str, amount: float, currency: str) -> None:
         await self._db.execute(
-            """
-            INSERT OR IGNORE INTO payments (invoice_id, telegram_id, tariff_code, amount, currency, status)
-            VALUES (?, ?, ?, ?, ?, 'pending')
-            """,
+            INSERT_INVOICE,
             invoice_id,
             telegram_id,
             tariff_code,
@@ -24,17 +38,35 @@ class PaymentRepository:
 
     async def mark_paid(self, invoice_id: str, status: str = "paid") -> None:
         await self._db.execute(
-            """UPDATE payments SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE invoice_id = ?""",
+            SET_STATUS,
             status,
             invoice_id,
         )
 
     async def mark_paid_pending(self, invoice_id: str) -> None:
         await self._db.execute(
-            """UPDATE payments SET status = 'paid_pending', updated_at = CURRENT_TIMESTAMP WHERE invoice_id = ?""",
+            SET_PAID_PENDING,
             invoice_id,
         )
 
+    async def accept_paid(
+        self,
+        invoice_id: str,
+        telegram_id: int | None,
+        tariff_code: str | None,
+        amount: float,
+        currency: str,
+    ) -> bool:
+        """Move an invoice to paid_pending exactly once; retries of the same invoice return False."""
+        async with self._db.transaction():
+            if telegram_id is not None and tariff_code:
+                await self.create_invoice(invoice_id, telegram_id, tariff_code, amount, currency)
+            rowcount = await self._db.execute_with_rowcount(
+                ACCEPT_PAID,
+                invoice_id,
+            )
+        return rowcount == 1
+
     async def get_payment(self, invoice_id: str) -> tuple | None:
         return await self._db.fetchone(
             """SELECT invoice_id, telegram_id, tariff_code, amount, currency, status FROM payments WHERE invoice_id = ?""",
@@ -51,11 +83,7 @@ class PaymentRepository:
     async def complete_or_skip(self, invoice_id: str) -> bool:
         """Idempotent completion; returns True if marked newly."""
         rowcount = await self._db.execute_with_rowcount(
-            """
-            UPDATE payments
-            SET status = 'paid', updated_at = CURRENT_TIMESTAMP
-            WHERE invoice_id = ? AND status != 'paid'
-            """,
+            COMPLETE,
             invoice_id,
         )
         return rowcount == 1
@@ -67,20 +95,15 @@ class PaymentRepository:
         )
         return row[0] if row else 0
 
-    async def count_paid_invoices(self) -> int:
-        row = await self._db.fetchone(
-            "SELECT COUNT(*) FROM payments WHERE status IN ('paid', 'paid_pending')"
-        )
-        return row[0] if row else 0
-
-    async def sum_paid_amount(self) -> float:
-        row = await self._db.fetchone(
-            "SELECT COALESCE(SUM(amount), 0) FROM payments WHERE status IN ('paid', 'paid_pending')"
-        )
-        return float(row[0]) if row else 0.0
-
     async def list_pending_invoices(self) -> list[str]:
         rows = await self._db.fetchall(
-            "SELECT invoice_id FROM payments WHERE status = 'paid_pending' ORDER BY updated_at ASC"
+            """
+            SELECT invoice_id FROM payments
+            WHERE status = 'paid_pending'
+              AND invoice_id NOT IN (
+                  SELECT invoice_id FROM provisioning_jobs WHERE status IN ('queued', 'running')
+              )
+            ORDER BY updated_at ASC
+            """
         )
         return [row[0] for row in rows]
@@ -0,0 +1,42 @@
+from __future__ import annotations
+
+import time
+
+from app.db import Database
+
+# Range scan on idx_users_expires; blocked accounts are not worth a reminder.
+LIST_EXPIRING = """
+    SELECT u.telegram_id, u.subscription_expires_at
+    FROM users u
+    LEFT JOIN telegram_users t ON t.telegram_id = u.telegram_id
+    WHERE u.subscription_expires_at >= ? AND u.subscription_expires_at < ?
+      AND COALESCE(t.blocked, 0) = 0
+"""
+GET_EXPIRY = "SELECT subscription_expires_at FROM users WHERE telegram_id = ?"
+MARK_SENT = "INSERT OR IGNORE INTO reminders_sent (telegram_id, kind, expires_at, sent_at) VALUES (?, ?, ?, ?)"
+UNMARK_SENT = "DELETE FROM reminders_sent WHERE telegram_id = ? AND kind = ? AND expires_at = ?"
+PURGE_SENT = "DELETE FROM reminders_sent WHERE expires_at < ?"
+
+
+class ReminderRepository:
+    def __init__(self, db: Database):
+        self._db = db
+
+    async def list_expiring(self, start_ts: int, end_ts: int) -> list[tuple[int, int]]:
+        rows = await self._db.fetchall(LIST_EXPIRING, start_ts, end_ts)
+        return [(row[0], row[1]) for row in rows]
+
+    async def get_expiry(self, telegram_id: int) -> int | None:
+        row = await self._db.fetchone(GET_EXPIRY, telegram_id)
+        return row[0] if row else None
+
+    async def try_mark_sent(self, telegram_id: int, kind: str, expires_at: int) -> bool:
+        """Claim a reminder; False if it was already sent for this expiry."""
+        rowcount = await self._db.execute_with_rowcount(MARK_SENT, telegram_id, kind, expires_at, int(time.time()))
+        return rowcount == 1
+
+    async def unmark_sent(self, telegram_id: int, kind: str, expires_at: int) -> None:
+        await self._db.execute(UNMARK_SENT, telegram_id, kind, expires_at)
+
+    async def purge(self, before_ts: int) -> None:
+        await self._db.execute(PURGE_SENT, before_ts)
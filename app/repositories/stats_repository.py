@@ -0,0 +1,39 @@
+from __future__ import annotations
+
+from app.db import Database
+
+COUNTERS = "SELECT name, value FROM stats_counters"
+FUTURE_EXPIRY_BUCKETS = "SELECT COALESCE(SUM(users), 0) FROM stats_expiry WHERE bucket >= ?"
+EXPIRING_BEFORE = "SELECT COUNT(*) FROM users WHERE subscription_expires_at > ? AND subscription_expires_at < ?"
+ROLLUP_TOTALS = """
+    SELECT metric, SUM(value) FROM stats_rollups
+    WHERE period = ? AND bucket >= ?
+    GROUP BY metric
+"""
+PURGE_EXPIRY = "DELETE FROM stats_expiry WHERE bucket < ? OR users <= 0"
+
+
+class StatsRepository:
+    """Reads of the trigger-maintained stats_* tables; none of them scans a source table."""
+
+    def __init__(self, db: Database):
+        self._db = db
+
+    async def counters(self) -> dict[str, float]:
+        rows = await self._db.fetchall(COUNTERS)
+        return {row["name"]: row["value"] for row in rows}
+
+    async def count_active_subscriptions(self, now_ts: int) -> int:
+        # Whole future hours come from the buckets; only the current hour
+        # needs an (index range) look at users.
+        next_hour = (now_ts // 3600 + 1) * 3600
+        future = await self._db.fetchone(FUTURE_EXPIRY_BUCKETS, next_hour)
+        current = await self._db.fetchone(EXPIRING_BEFORE, now_ts, next_hour)
+        return int(future[0]) + int(current[0])
+
+    async def rollup_totals(self, period: str, since_ts: int) -> dict[str, float]:
+        rows = await self._db.fetchall(ROLLUP_TOTALS, period, since_ts)
+        return {row[0]: row[1] for row in rows}
+
+    async def purge_expired_buckets(self, now_ts: int) -> None:
+        await self._db.execute(PURGE_EXPIRY, (now_ts // 3600) * 3600)
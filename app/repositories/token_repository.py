@@ -0,0 +1,25 @@
+from __future__ import annotations
+
+from app.db import Database
+
+
+class TokenRepository:
+    def __init__(self, db: Database):
+        self._db = db
+
+    async def load(self, name: str) -> tuple[str, float | None] | None:
+        return await self._db.fetchone("SELECT token, expires_at FROM api_tokens WHERE name = ?", name)
+
+    async def save(self, name: str, token: str, expires_at: float | None) -> None:
+        await self._db.execute(
+            """
+            INSERT INTO api_tokens (name, token, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET token = excluded.token, expires_at = excluded.expires_at
+            """,
+            name,
+            token,
+            int(expires_at) if expires_at is not None else None,
+        )
+
+    async def delete(self, name: str, token: str) -> None:
+        await self._db.execute("DELETE FROM api_tokens WHERE name = ? AND token = ?", name, token)
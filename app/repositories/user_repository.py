@@ -1,17 +1,118 @@
 from __future__ import annotations
 
 from datetime import datetime
+from typing import Any, AsyncIterator
 
 from app.db import Database
-from app.models.user import User
+from app.models.user import User, UserMeta
+from app.utils.epoch import SQL_EPOCH_NOW, from_epoch, to_epoch
+
+# One row per requested id whether or not either table has it, so a single
+# lookup answers both "is there a subscription" and "what are the flags".
+SELECT_USER_WITH_META = """
+    SELECT
+        k.telegram_id AS telegram_id,
+        u.telegram_id IS NOT NULL AS has_user,
+        u.marzban_username AS marzban_username,
+        u.marzban_uuid AS marzban_uuid,
+        u.subscription_expires_at AS subscription_expires_at,
+        u.subscription_link AS subscription_link,
+        u.traffic_limit_gb AS traffic_limit_gb,
+        COALESCE(t.trial_used, u.trial_used, 0) AS trial_used,
+        COALESCE(t.referrer_telegram_id, u.referrer_telegram_id) AS referrer_telegram_id,
+        COALESCE(t.referral_bonus_applied, u.referral_bonus_applied, 0) AS referral_bonus_applied,
+        u.used_traffic_bytes AS used_traffic_bytes,
+        u.synced_at AS synced_at,
+        u.marzban_node AS marzban_node
+    FROM (SELECT ? AS telegram_id) k
+    LEFT JOIN users u ON u.telegram_id = k.telegram_id
+    LEFT JOIN telegram_users t ON t.telegram_id = k.telegram_id
+"""
+
+# The flags live in telegram_users; users keeps a mirrored copy. An upsert
+# both registers the account and flips the flag, and its rowcount tells
+# whether this call was the one that flipped it.
+MARK_TRIAL_USED = """
+    INSERT INTO telegram_users (telegram_id, trial_used) VALUES (?, 1)
+    ON CONFLICT(telegram_id) DO UPDATE SET trial_used = 1 WHERE telegram_users.trial_used = 0
+"""
+MIRROR_TRIAL_USED = "UPDATE users SET trial_used = 1 WHERE telegram_id = ? AND trial_used = 0"
+
+MARK_REFERRAL_BONUS_APPLIED = """
+    INSERT INTO telegram_users (telegram_id, referral_bonus_applied) VALUES (?, 1)
+    ON CONFLICT(telegram_id) DO UPDATE SET referral_bonus_applied = 1
+    WHERE telegram_users.referral_bonus_applied = 0
+"""
+MIRROR_REFERRAL_BONUS_APPLIED = (
+    "UPDATE users SET referral_bonus_applied = 1 WHERE telegram_id = ? AND referral_bonus_applied = 0"
+)
+
+SET_REFERRER = """
+    INSERT INTO telegram_users (telegram_id, referrer_telegram_id) VALUES (?, ?)
+    ON CONFLICT(telegram_id) DO UPDATE SET referrer_telegram_id = excluded.referrer_telegram_id
+    WHERE telegram_users.referrer_telegram_id IS NULL
+"""
+MIRROR_REFERRER = "UPDATE users SET referrer_telegram_id = ? WHERE telegram_id = ?"
+
+# A page can be older than a renewal that landed while the sync was running:
+# skip rows written after the page was fetched, and never lower an expiry.
+# Only the user's own node may write: a moved user can still have a stale
+# account on the old one.
+APPLY_MARZBAN_SYNC = """
+    UPDATE users SET
+        subscription_expires_at = CASE
+            WHEN subscription_expires_at IS NULL OR ? > subscription_expires_at THEN ?
+            ELSE subscription_expires_at
+        END,
+        subscription_link = COALESCE(?, subscription_link),
+        used_traffic_bytes = COALESCE(?, used_traffic_bytes),
+        synced_at = ?,
+        marzban_node = COALESCE(?, marzban_node)
+    WHERE marzban_username = ?
+      AND (synced_at IS NULL OR synced_at <= ?)
+      AND (marzban_node IS NULL OR marzban_node = ?)
+"""
+
+# Panel accounts left behind on a node a user was moved off. The join skips
+# users that have since moved back: their account there is live again.
+LIST_MARZBAN_ORPHANS = """
+    SELECT o.username
+    FROM marzban_orphans o
+    LEFT JOIN users u ON u.marzban_username = o.username
+    WHERE o.node = ? AND (u.marzban_node IS NULL OR u.marzban_node != o.node)
+    ORDER BY o.created_at
+    LIMIT ?
+"""
+ADD_MARZBAN_ORPHAN = f"""
+    INSERT OR IGNORE INTO marzban_orphans (node, username, created_at) VALUES (?, ?, {SQL_EPOCH_NOW})
+"""
+REMOVE_MARZBAN_ORPHAN = "DELETE FROM marzban_orphans WHERE node = ? AND username = ?"
+
+
+def _row_to_user(row: Any) -> User:
+    return User(
+        telegram_id=row["telegram_id"],
+        marzban_username=row["marzban_username"],
+        marzban_uuid=row["marzban_uuid"],
+        subscription_expires_at=from_epoch(row["subscription_expires_at"]),
+        subscription_link=row["subscription_link"],
+        traffic_limit_gb=row["traffic_limit_gb"],
+        trial_used=bool(row["trial_used"]),
+        referrer_telegram_id=row["referrer_telegram_id"],
+        referral_bonus_applied=bool(row["referral_bonus_applied"]),
+        used_traffic_bytes=row["used_traffic_bytes"],
+        synced_at=from_epoch(row["synced_at"]),
+        marzban_node=row["marzban_node"],
+    )
 
 
 class UserRepository:
     def __init__(self, db: Database):
         self._db = db
 
-    async def upsert_user(self, user: User) -> None:
-        await self._db.execute(
+    async def upsert_user(self, user: User, fencing_token: int | None = None) -> bool:
+        """Insert or update the user; returns False if a newer fencing token already wrote the row."""
+        rowcount = await self._db.execute_with_rowcount(
             """
             INSERT INTO users (
                 telegram_id,
@@ -22,9 +123,12 @@ class UserRepository:
                 traffic_limit_gb,
                 trial_used,
                 referrer_telegram_id,
-                referral_bonus_applied
+                referral_bonus_applied,
+                synced_at,
+                fencing_token,
+                marzban_node
             )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ON CONFLICT(telegram_id) DO UPDATE SET
                 marzban_username=excluded.marzban_username,
                 marzban_uuid=excluded.marzban_uuid,
@@ -33,125 +137,112 @@ class UserRepository:
                 traffic_limit_gb=excluded.traffic_limit_gb,
                 trial_used=excluded.trial_used,
                 referrer_telegram_id=excluded.referrer_telegram_id,
-                referral_bonus_applied=excluded.referral_bonus_applied
+                referral_bonus_applied=excluded.referral_bonus_applied,
+                synced_at=COALESCE(excluded.synced_at, users.synced_at),
+                fencing_token=COALESCE(excluded.fencing_token, users.fencing_token),
+                marzban_node=COALESCE(excluded.marzban_node, users.marzban_node)
+            WHERE excluded.fencing_token IS NULL
+               OR excluded.fencing_token >= COALESCE(users.fencing_token, 0)
             """,
             user.telegram_id,
             user.marzban_username,
             user.marzban_uuid,
-            user.subscription_expires_at.isoformat() if user.subscription_expires_at else None,
+            to_epoch(user.subscription_expires_at),
             user.subscription_link,
             user.traffic_limit_gb,
             int(user.trial_used),
             user.referrer_telegram_id,
             int(user.referral_bonus_applied),
+            to_epoch(user.synced_at),
+            fencing_token,
+            user.marzban_node,
         )
+        return rowcount == 1
 
     async def get_by_telegram_id(self, telegram_id: int) -> User | None:
-        row = await self._db.fetchone(
-            """
-            SELECT
-                u.telegram_id,
-                u.marzban_username,
-                u.marzban_uuid,
-                u.subscription_expires_at,
-                u.subscription_link,
-                u.traffic_limit_gb,
-                COALESCE(t.trial_used, u.trial_used, 0),
-                COALESCE(t.referrer_telegram_id, u.referrer_telegram_id),
-                COALESCE(t.referral_bonus_applied, u.referral_bonus_applied, 0)
-            FROM users u
-            LEFT JOIN telegram_users t ON t.telegram_id = u.telegram_id
-            WHERE u.telegram_id = ?
-            """,
-            telegram_id,
-        )
+        row = await self._db.fetchone(SELECT_USER_WITH_META, telegram_id)
+        return _row_to_user(row) if row and row["has_user"] else None
+
+    async def get_with_meta(self, telegram_id: int) -> tuple[User | None, UserMeta]:
+        """The subscription row (if any) and the account meta in one query."""
+        row = await self._db.fetchone(SELECT_USER_WITH_META, telegram_id)
         if not row:
-            return None
-        subscription_expires_at = (
-            datetime.fromisoformat(row[3]) if row[3] else None
-        )
-        return User(
-            telegram_id=row[0],
-            marzban_username=row[1],
-            marzban_uuid=row[2],
-            subscription_expires_at=subscription_expires_at,
-            subscription_link=row[4],
-            traffic_limit_gb=row[5],
-            trial_used=bool(row[6]),
-            referrer_telegram_id=row[7],
-            referral_bonus_applied=bool(row[8]),
+            return None, UserMeta()
+        meta = UserMeta(
+            trial_used=bool(row["trial_used"]),
+            referrer_telegram_id=row["referrer_telegram_id"],
+            referral_bonus_applied=bool(row["referral_bonus_applied"]),
         )
+        return (_row_to_user(row) if row["has_user"] else None), meta
 
     async def update_subscription(self, telegram_id: int, expires_at: datetime | None, link: str | None) -> None:
         await self._db.execute(
             """UPDATE users SET subscription_expires_at = ?, subscription_link = ? WHERE telegram_id = ?""",
-            expires_at.isoformat() if expires_at else None,
+            to_epoch(expires_at),
             link,
             telegram_id,
         )
 
-    async def get_user_meta(self, telegram_id: int) -> tuple[bool, int | None, bool]:
-        row = await self._db.fetchone(
-            """
-            SELECT trial_used, referrer_telegram_id, referral_bonus_applied
-            FROM telegram_users WHERE telegram_id = ?
-            """,
-            telegram_id,
-        )
-        if row:
-            return bool(row[0]), row[1], bool(row[2])
-        return False, None, False
+    async def apply_marzban_sync(
+        self,
+        rows: list[tuple[str, datetime | None, str | None, int | None]],
+        fetched_at: datetime,
+        node: str | None = None,
+    ) -> None:
+        """Bulk-update users from (username, expires_at, link, used_traffic_bytes) rows seen on ``node``.
+
+        ``fetched_at`` is when the page was requested: rows written after
+        that (e.g. by a renewal) are newer than the page and are left alone.
+        """
+        fetched_ts = to_epoch(fetched_at)
+        async with self._db.transaction():
+            await self._db.executemany(
+                APPLY_MARZBAN_SYNC,
+                [
+                    (
+                        to_epoch(expires_at),
+                        to_epoch(expires_at),
+                        link or None,
+                        used_traffic,
+                        fetched_ts,
+                        node,
+                        username,
+                        fetched_ts,
+                        node,
+                    )
+                    for username, expires_at, link, used_traffic in rows
+                ],
+            )
+
+    async def record_node_move(self, username: str, old_node: str, new_node: str) -> None:
+        """Queue the account on ``old_node`` for deletion; the one on ``new_node`` is live now."""
+        async with self._db.transaction():
+            await self._db.execute(ADD_MARZBAN_ORPHAN, old_node, username)
+            await self._db.execute(REMOVE_MARZBAN_ORPHAN, new_node, username)
+
+    async def list_marzban_orphans(self, node: str, limit: int = 100) -> list[str]:
+        rows = await self._db.fetchall(LIST_MARZBAN_ORPHANS, node, limit)
+        return [row[0] for row in rows]
+
+    async def remove_marzban_orphan(self, node: str, username: str) -> None:
+        await self._db.execute(REMOVE_MARZBAN_ORPHAN, node, username)
 
     async def set_trial_used(self, telegram_id: int) -> None:
-        await self.register_telegram_user(telegram_id)
-        await self._db.execute(
-            "UPDATE telegram_users SET trial_used = 1 WHERE telegram_id = ?",
-            telegram_id,
-        )
-        await self._db.execute(
-            "UPDATE users SET trial_used = 1 WHERE telegram_id = ?",
-            telegram_id,
-        )
+        await self.try_mark_trial_used(telegram_id)
 
     async def try_mark_trial_used(self, telegram_id: int) -> bool:
-        await self.register_telegram_user(telegram_id)
-        rowcount = await self._db.execute_with_rowcount(
-            "UPDATE users SET trial_used = 1 WHERE telegram_id = ? AND trial_used = 0",
-            telegram_id,
-        )
-        if rowcount == 0:
-            rowcount = await self._db.execute_with_rowcount(
-                "UPDATE telegram_users SET trial_used = 1 WHERE telegram_id = ? AND trial_used = 0",
-                telegram_id,
-            )
-        await self._db.execute(
-            "UPDATE users SET trial_used = 1 WHERE telegram_id = ?",
-            telegram_id,
-        )
-        await self._db.execute(
-            "UPDATE telegram_users SET trial_used = 1 WHERE telegram_id = ?",
-            telegram_id,
-        )
+        """Set the trial flag; returns True only for the call that flipped it."""
+        async with self._db.transaction():
+            rowcount = await self._db.execute_with_rowcount(MARK_TRIAL_USED, telegram_id)
+            await self._db.execute(MIRROR_TRIAL_USED, telegram_id)
         return rowcount == 1
 
     async def set_referrer(self, invitee_id: int, referrer_id: int) -> bool:
-        await self.register_telegram_user(invitee_id)
-        row = await self._db.fetchone(
-            "SELECT referrer_telegram_id FROM telegram_users WHERE telegram_id = ?",
-            invitee_id,
-        )
-        if row and row[0] is not None:
-            return False
-        await self._db.execute(
-            "UPDATE telegram_users SET referrer_telegram_id = ? WHERE telegram_id = ?",
-            referrer_id,
-            invitee_id,
-        )
-        await self._db.execute(
-            "UPDATE users SET referrer_telegram_id = ? WHERE telegram_id = ?",
-            referrer_id,
-            invitee_id,
-        )
+        async with self._db.transaction():
+            rowcount = await self._db.execute_with_rowcount(SET_REFERRER, invitee_id, referrer_id)
+            if rowcount != 1:
+                return False
+            await self._db.execute(MIRROR_REFERRER, referrer_id, invitee_id)
         return True
 
     async def get_referrer_id(self, invitee_id: int) -> int | None:
@@ -169,66 +260,57 @@ class UserRepository:
         return bool(row[0]) if row else False
 
     async def mark_referral_bonus_applied(self, invitee_id: int) -> None:
-        await self.register_telegram_user(invitee_id)
-        await self._db.execute(
-            "UPDATE telegram_users SET referral_bonus_applied = 1 WHERE telegram_id = ?",
-            invitee_id,
-        )
-        await self._db.execute(
-            "UPDATE users SET referral_bonus_applied = 1 WHERE telegram_id = ?",
-            invitee_id,
-        )
+        await self.try_mark_referral_bonus_applied(invitee_id)
 
     async def try_mark_referral_bonus_applied(self, invitee_id: int) -> bool:
-        await self.register_telegram_user(invitee_id)
-        rowcount = await self._db.execute_with_rowcount(
-            """
-            UPDATE users
-            SET referral_bonus_applied = 1
-            WHERE telegram_id = ? AND referral_bonus_applied = 0
-            """,
-            invitee_id,
-        )
-        if rowcount == 0:
-            rowcount = await self._db.execute_with_rowcount(
-                """
-                UPDATE telegram_users
-                SET referral_bonus_applied = 1
-                WHERE telegram_id = ? AND referral_bonus_applied = 0
-                """,
-                invitee_id,
-            )
-        await self._db.execute(
-            "UPDATE users SET referral_bonus_applied = 1 WHERE telegram_id = ?",
-            invitee_id,
-        )
-        await self._db.execute(
-            "UPDATE telegram_users SET referral_bonus_applied = 1 WHERE telegram_id = ?",
-            invitee_id,
-        )
+        async with self._db.transaction():
+            rowcount = await self._db.execute_with_rowcount(MARK_REFERRAL_BONUS_APPLIED, invitee_id)
+            await self._db.execute(MIRROR_REFERRAL_BONUS_APPLIED, invitee_id)
         return rowcount == 1
 
     async def count_users(self) -> int:
         row = await self._db.fetchone("SELECT COUNT(*) FROM telegram_users")
         return row[0] if row else 0
 
-    async def count_active_subscriptions(self, now_iso: str) -> int:
-        row = await self._db.fetchone(
-            "SELECT COUNT(*) FROM users WHERE subscription_expires_at IS NOT NULL AND subscription_expires_at > ?",
-            now_iso,
-        )
+    async def count_reachable_users(self) -> int:
+        row = await self._db.fetchone("SELECT COUNT(*) FROM telegram_users WHERE blocked = 0")
         return row[0] if row else 0
 
     async def list_telegram_ids(self) -> list[int]:
         rows = await self._db.fetchall("SELECT telegram_id FROM telegram_users")
         return [row[0] for row in rows]
 
-    async def register_telegram_user(self, telegram_id: int) -> None:
+    async def iter_telegram_ids(
+        self,
+        chunk_size: int = 500,
+        after_id: int = 0,
+        include_blocked: bool = True,
+    ) -> AsyncIterator[list[int]]:
+        query = (
+            "SELECT telegram_id FROM telegram_users WHERE telegram_id > ? ORDER BY telegram_id LIMIT ?"
+            if include_blocked
+            else "SELECT telegram_id FROM telegram_users WHERE telegram_id > ? AND blocked = 0 ORDER BY telegram_id LIMIT ?"
+        )
+        last_id = after_id
+        while True:
+            rows = await self._db.fetchall(query, last_id, chunk_size)
+            if not rows:
+                return
+            chunk = [row[0] for row in rows]
+            yield chunk
+            last_id = chunk[-1]
+
+    async def mark_blocked(self, telegram_id: int) -> None:
         await self._db.execute(
-            "INSERT INTO telegram_users (telegram_id) VALUES (?) ON CONFLICT(telegram_id) DO NOTHING",
+            "UPDATE telegram_users SET blocked = 1 WHERE telegram_id = ?",
             telegram_id,
         )
-<<<<<<< HEAD
-=======
 
->>>>>>> e2229bf (Fix bug)
+    async def register_telegram_user(self, telegram_id: int) -> None:
+        await self._db.execute(
+            """
+            INSERT INTO telegram_users (telegram_id) VALUES (?)
+            ON CONFLICT(telegram_id) DO UPDATE SET blocked = 0 WHERE blocked = 1
+            """,
+            telegram_id,
+        )
@@ -1,52 +1,137 @@
 from __future__ import annotations
 
+import asyncio
+import logging
+from typing import Any
+
 from aiohttp import web
-from aiogram import Bot
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 
+from app.services.metrics import Registry
 from app.services.payments import PaymentService
-from app.services.subscription import SubscriptionService
+from app.services.provisioning import ProvisioningQueue
 
 
 class WebhookApp:
+    """Payment provider notifications.
+
+    A verified notification is recorded as ``paid_pending``, queued for
+    provisioning and acknowledged straight away, so slow Marzban calls never
+    delay the provider. Retries of an invoice are
+    recognised in the database and acknowledged without doing anything.
+    """
+
     def __init__(
         self,
-        bot: Bot,
         payment_service: PaymentService,
-        subscription_service: SubscriptionService,
+        provisioning_queue: ProvisioningQueue,
         webhook_path: str,
     ):
-        self.bot = bot
         self.payment_service = payment_service
-        self.subscription_service = subscription_service
+        self.provisioning_queue = provisioning_queue
         self.webhook_path = webhook_path
+        self._logger = logging.getLogger(__name__)
 
     def build(self) -> web.Application:
         app = web.Application()
-        app.add_routes([web.post(self.webhook_path, self.handle_payment)])
+        self.register(app)
         return app
 
+    def register(self, app: web.Application) -> None:
+        app.add_routes([web.post(self.webhook_path, self.handle_payment)])
+
     async def handle_payment(self, request: web.Request) -> web.Response:
         content_type = request.content_type or ""
-        result = None
-        if content_type.startswith("application/json"):
+        is_json = content_type.startswith("application/json")
+        if is_json:
             payload = await request.text()
             signature = request.headers.get("X-Signature", "")
             result = await self.payment_service.verify_webhook(payload, signature)
         else:
             form = await request.post()
-            result = await self.payment_service.verify_robokassa(dict(form))
+            result = await self.payment_service.verify_robokassa({key: str(value) for key, value in form.items()})
         if not result:
             return web.json_response({"status": "ignored"}, status=400)
-        try:
-            user = await self.subscription_service.process_payment_success(result.invoice_id)
-        except aiohttp.ClientResponseError as exc:
-            return web.json_response(
-                {"status": "marzban_error", "code": exc.status, "message": exc.message},
-                status=502,
-            )
-        if not user:
+        outcome = await self.payment_service.accept_paid(result)
+        if outcome == "unknown":
+            self._logger.warning("Payment webhook for unknown invoice: invoice_id=%s", result.invoice_id)
             return web.json_response({"status": "not_found"}, status=404)
-        await self._send_access_message(user.telegram_id, user.subscription_link or "")
-        if not content_type.startswith("application/json"):
+        if outcome == "accepted":
+            self._logger.info("Payment accepted via webhook: invoice_id=%s", result.invoice_id)
+            await self.provisioning_queue.enqueue(result.invoice_id)
+        if not is_json:
             return web.Response(text=f"OK{result.invoice_id}")
-        return web.json_response({"status": "ok", "user": user.marzban_username})
+        return web.json_response({"status": outcome})
+
+
+class MetricsApp:
+    """Prometheus scrape endpoint."""
+
+    def __init__(self, registry: Registry, path: str = "/metrics"):
+        self.registry = registry
+        self.path = path
+
+    def register(self, app: web.Application) -> None:
+        app.add_routes([web.get(self.path, self.handle_metrics)])
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.registry.render(), content_type="text/plain", charset="utf-8")
+
+
+class TelegramWebhookHandler(SimpleRequestHandler):
+    """Telegram update endpoint with bounded in-flight updates.
+
+    Each update is processed in the background, but no more than
+    ``concurrency`` at a time: once the limit is reached the HTTP response is
+    delayed, which makes Telegram back off. ``close`` stops accepting updates
+    and waits up to ``drain_timeout`` for in-flight ones before the bot
+    session is closed.
+    """
+
+    def __init__(
+        self,
+        dispatcher: Dispatcher,
+        bot: Bot,
+        concurrency: int,
+        drain_timeout: float,
+        secret_token: str | None = None,
+        **data: Any,
+    ):
+        super().__init__(dispatcher, bot, handle_in_background=True, secret_token=secret_token, **data)
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._drain_timeout = drain_timeout
+        self._accepting = True
+        self._logger = logging.getLogger(__name__)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not self._accepting:
+            return web.Response(status=503, text="Shutting down")
+        return await super().handle(request)
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        await self._semaphore.acquire()
+        try:
+            return await super()._handle_request_background(bot=bot, request=request)
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+    async def _background_feed_update(self, bot: Bot, update: dict[str, Any] | Update) -> None:
+        try:
+            await super()._background_feed_update(bot=bot, update=update)
+        except Exception:
+            self._logger.exception("Failed to process Telegram update")
+        finally:
+            self._semaphore.release()
+
+    async def close(self) -> None:
+        self._accepting = False
+        pending = set(self._background_feed_update_tasks)
+        if pending:
+            self._logger.info("Draining %s in-flight updates", len(pending))
+            _, still_running = await asyncio.wait(pending, timeout=self._drain_timeout)
+            if still_running:
+                self._logger.warning("Shutdown with %s updates still running", len(still_running))
+        await super().close()
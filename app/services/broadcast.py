@@ -0,0 +1,192 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramAPIError,
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramRetryAfter,
+)
+
+from app.config import Settings
+from app.keyboards.admin import admin_panel_keyboard
+from app.models.broadcast import BroadcastJob
+from app.repositories.broadcast_repository import BroadcastRepository
+from app.repositories.user_repository import UserRepository
+from app.utils.ratelimit import RateLimiter
+
+
+class BroadcastService:
+    MAX_RETRIES = 3
+
+    def __init__(
+        self,
+        bot: Bot,
+        user_repo: UserRepository,
+        broadcast_repo: BroadcastRepository,
+        settings: Settings,
+    ):
+        self.bot = bot
+        self.user_repo = user_repo
+        self.broadcast_repo = broadcast_repo
+        self.settings = settings
+        # One limiter for the whole bot: Telegram's global limit is ~30 msg/s.
+        # Every recipient gets a single message, so the per-chat limit only
+        # matters for the admin's progress message, which is throttled below.
+        self._limiter = RateLimiter(settings.broadcast_rate_limit)
+        self._tasks: set[asyncio.Task] = set()
+        self._logger = logging.getLogger(__name__)
+
+    async def start(
+        self,
+        from_chat_id: int,
+        message_id: int,
+        admin_chat_id: int,
+        progress_message_id: int,
+    ) -> BroadcastJob:
+        job = await self.broadcast_repo.create_job(
+            from_chat_id,
+            message_id,
+            admin_chat_id,
+            progress_message_id,
+            total=await self.user_repo.count_reachable_users(),
+        )
+        self._spawn(job)
+        return job
+
+    async def resume_unfinished(self) -> int:
+        jobs = await self.broadcast_repo.list_unfinished()
+        for job in jobs:
+            self._logger.info(
+                "Resuming broadcast: job_id=%s last_telegram_id=%s processed=%s",
+                job.id,
+                job.last_telegram_id,
+                job.processed,
+            )
+            self._spawn(job)
+        return len(jobs)
+
+    async def close(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _spawn(self, job: BroadcastJob) -> None:
+        task = asyncio.create_task(self._run(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, job: BroadcastJob) -> None:
+        semaphore = asyncio.Semaphore(self.settings.broadcast_concurrency)
+        last_report = time.monotonic()
+        try:
+            async for chunk in self.user_repo.iter_telegram_ids(
+                self.settings.broadcast_chunk_size,
+                after_id=job.last_telegram_id,
+                include_blocked=False,
+            ):
+                # Recipients handled before a crash are already recorded, so a
+                # resumed job only counts them instead of messaging them again.
+                done = await self.broadcast_repo.get_deliveries(job.id, chunk[0], chunk[-1])
+                for status in done.values():
+                    self._count(job, status)
+                await asyncio.gather(
+                    *(
+                        self._deliver(job, user_id, semaphore)
+                        for user_id in chunk
+                        if user_id not in done
+                    )
+                )
+                job.last_telegram_id = chunk[-1]
+                await self.broadcast_repo.checkpoint(job)
+                if time.monotonic() - last_report >= self.settings.broadcast_progress_interval:
+                    last_report = time.monotonic()
+                    await self._report(job, self._progress_text(job))
+        except asyncio.CancelledError:
+            # Left as 'running' on purpose: resumed from the checkpoint on next start.
+            raise
+        except Exception:
+            self._logger.exception("Broadcast aborted: job_id=%s processed=%s", job.id, job.processed)
+            await self.broadcast_repo.finish(job, status="failed")
+            await self._report(job, f"Рассылка прервана из-за ошибки.\n\n{self._progress_text(job)}", final=True)
+            return
+        await self.broadcast_repo.finish(job)
+        self._logger.info(
+            "Broadcast finished: job_id=%s delivered=%s failed=%s blocked=%s",
+            job.id,
+            job.delivered,
+            job.failed,
+            job.blocked,
+        )
+        await self._report(
+            job,
+            "Рассылка завершена.\n"
+            f"Получателей: {job.processed}\n"
+            f"Доставлено: {job.delivered}\n"
+            f"Заблокировали бота: {job.blocked}\n"
+            f"Ошибок: {job.failed}",
+            final=True,
+        )
+
+    async def _deliver(self, job: BroadcastJob, user_id: int, semaphore: asyncio.Semaphore) -> None:
+        async with semaphore:
+            status = "failed"
+            for _ in range(self.MAX_RETRIES + 1):
+                await self._limiter.acquire()
+                try:
+                    await self.bot.copy_message(
+                        chat_id=user_id,
+                        from_chat_id=job.from_chat_id,
+                        message_id=job.message_id,
+                    )
+                    status = "delivered"
+                    break
+                except TelegramRetryAfter as exc:
+                    self._limiter.pause(exc.retry_after)
+                except TelegramForbiddenError:
+                    status = "blocked"
+                    await self.user_repo.mark_blocked(user_id)
+                    break
+                except TelegramBadRequest:
+                    break
+                except TelegramAPIError:
+                    self._logger.warning("Broadcast delivery failed: user_id=%s", user_id, exc_info=True)
+                    break
+            await self.broadcast_repo.record_delivery(job.id, user_id, status)
+            self._count(job, status)
+
+    def _count(self, job: BroadcastJob, status: str) -> None:
+        job.processed += 1
+        if status == "delivered":
+            job.delivered += 1
+        elif status == "blocked":
+            job.blocked += 1
+        else:
+            job.failed += 1
+
+    def _progress_text(self, job: BroadcastJob) -> str:
+        return (
+            "Рассылка идёт…\n"
+            f"Обработано: {job.processed} из {job.total}\n"
+            f"Доставлено: {job.delivered}\n"
+            f"Заблокировали бота: {job.blocked}\n"
+            f"Ошибок: {job.failed}"
+        )
+
+    async def _report(self, job: BroadcastJob, text: str, final: bool = False) -> None:
+        try:
+            await self.bot.edit_message_text(
+                text,
+                chat_id=job.admin_chat_id,
+                message_id=job.progress_message_id,
+                reply_markup=admin_panel_keyboard() if final else None,
+            )
+        except TelegramRetryAfter as exc:
+            self._limiter.pause(exc.retry_after)
+        except TelegramAPIError:
+            self._logger.warning("Failed to update broadcast progress: job_id=%s", job.id, exc_info=True)
@@ -1,10 +1,18 @@
 from __future__ import annotations
 
+import time
 from typing import Any, Callable, Dict, Awaitable
 
 from aiogram import BaseMiddleware
 from aiogram.types import CallbackQuery, Message
 
+from app.config import Settings
+from app.services.metrics import BotMetrics, UpdateScope, current_scope
+from app.utils.ratelimit import KeyedRateLimiter
+
+THROTTLED_CALLBACK_TEXT = "Подождите…"
+THROTTLED_MESSAGE_TEXT = "⏳ Слишком много запросов. Подождите несколько секунд."
+
 
 class DependencyMiddleware(BaseMiddleware):
     def __init__(self, **deps: Any):
@@ -19,3 +27,85 @@ class DependencyMiddleware(BaseMiddleware):
     ) -> Any:
         data.update(self.deps)
         return await handler(event, data)
+
+
+class InstrumentationMiddleware(BaseMiddleware):
+    """Times each handler and attributes DB/Marzban work done for the update to it."""
+
+    def __init__(self, metrics: BotMetrics):
+        super().__init__()
+        self.metrics = metrics
+
+    async def __call__(
+        self,
+        handler: Callable[[Message | CallbackQuery, Dict[str, Any]], Awaitable[Any]],
+        event: Message | CallbackQuery,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        callback = getattr(handler_object, "callback", None)
+        if callback is None:
+            name = "unhandled"
+        else:
+            name = f"{callback.__module__.rsplit('.', 1)[-1]}.{callback.__name__}"
+        scope = UpdateScope()
+        token = current_scope.set(scope)
+        started = time.perf_counter()
+        error: BaseException | None = None
+        try:
+            return await handler(event, data)
+        except Exception as exc:
+            error = exc
+            raise
+        finally:
+            current_scope.reset(token)
+            self.metrics.observe_handler(name, time.perf_counter() - started, scope, error)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Per-user token bucket in front of the handlers.
+
+    Excess callbacks are answered with a short toast so the client stops
+    spinning; excess messages are dropped with at most one notice per
+    ``throttle_notice_interval`` (none if it is 0).
+    """
+
+    def __init__(self, settings: Settings):
+        super().__init__()
+        self.admin_ids = set(settings.telegram_admin_ids)
+        maxsize = settings.throttle_max_users
+        self._messages = KeyedRateLimiter(settings.throttle_message_rate, settings.throttle_message_burst, maxsize)
+        self._callbacks = KeyedRateLimiter(settings.throttle_callback_rate, settings.throttle_callback_burst, maxsize)
+        # A zero interval turns the notice off.
+        self._notices = (
+            KeyedRateLimiter(1.0 / settings.throttle_notice_interval, 1, maxsize)
+            if settings.throttle_notice_interval > 0
+            else None
+        )
+        self.throttled = 0
+
+    async def __call__(
+        self,
+        handler: Callable[[Message | CallbackQuery, Dict[str, Any]], Awaitable[Any]],
+        event: Message | CallbackQuery,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = event.from_user
+        if user is None or user.id in self.admin_ids:
+            return await handler(event, data)
+        if isinstance(event, CallbackQuery):
+            if self._callbacks.allow(user.id):
+                return await handler(event, data)
+            self.throttled += 1
+            await event.answer(THROTTLED_CALLBACK_TEXT)
+            return None
+        # Payment confirmations must never be dropped.
+        if event.successful_payment is not None or self._messages.allow(user.id):
+            return await handler(event, data)
+        self.throttled += 1
+        if self._notices is not None and self._notices.allow(user.id):
+            await event.answer(THROTTLED_MESSAGE_TEXT)
+        return None
+
+    def tracked_users(self) -> int:
+        return len(self._messages) + len(self._callbacks)
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from app.repositories.fsm_repository import FSMRepository
+
+
+class _Record:
+    __slots__ = ("state", "data", "touched_at", "loaded_at")
+
+    def __init__(self, state: str | None, data: Dict[str, Any], touched_at: float):
+        self.state = state
+        self.data = data
+        self.touched_at = touched_at
+        self.loaded_at = time.monotonic()
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM storage persisted in SQLite behind a write-behind cache.
+
+    Changes are kept in memory and flushed in one transaction every
+    ``flush_interval`` seconds. Clean entries are re-read after ``cache_ttl``
+    so several processes sharing the database converge, and states untouched
+    for ``state_ttl`` are dropped from both the cache and the table.
+    """
+
+    def __init__(
+        self,
+        repository: FSMRepository,
+        flush_interval: float = 2.0,
+        cache_ttl: float = 30.0,
+        state_ttl: float = 86400.0,
+    ):
+        self._repository = repository
+        self._flush_interval = flush_interval
+        self._cache_ttl = cache_ttl
+        self._state_ttl = state_ttl
+        self._cache: dict[str, _Record] = {}
+        self._dirty: set[str] = set()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self._logger = logging.getLogger(__name__)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush()
+        except Exception:
+            # Shutdown must go on: the DB and Marzban sessions close after us.
+            self._logger.exception("Final FSM storage flush failed; unsaved states are lost")
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._record(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._touch(key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._record(key)).state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = await self._record(key)
+        record.data = data.copy()
+        self._touch(key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._record(key)).data.copy()
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, set()
+            upserts = []
+            deletes = []
+            for cache_key in dirty:
+                record = self._cache.get(cache_key)
+                if record is None:
+                    continue
+                if record.state is None and not record.data:
+                    deletes.append(cache_key)
+                else:
+                    upserts.append((cache_key, record.state, json.dumps(record.data), record.touched_at))
+            try:
+                await self._repository.save_many(upserts, deletes)
+            except Exception:
+                # Keep the changes for the next attempt unless rewritten since.
+                self._dirty |= dirty
+                raise
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+                await self._expire()
+            except Exception:
+                self._logger.exception("FSM storage flush failed")
+
+    async def _expire(self) -> None:
+        now = time.monotonic()
+        cutoff = time.time() - self._state_ttl
+        for cache_key, record in list(self._cache.items()):
+            if cache_key in self._dirty:
+                continue
+            if record.touched_at < cutoff or now - record.loaded_at > self._cache_ttl:
+                del self._cache[cache_key]
+        await self._repository.purge_expired(cutoff)
+
+    def _touch(self, key: StorageKey, record: _Record) -> None:
+        record.touched_at = time.time()
+        self._dirty.add(self._key(key))
+
+    async def _record(self, key: StorageKey) -> _Record:
+        cache_key = self._key(key)
+        record = self._cache.get(cache_key)
+        if record is not None and (
+            cache_key in self._dirty or time.monotonic() - record.loaded_at < self._cache_ttl
+        ):
+            return record
+        row = await self._repository.load(cache_key, time.time() - self._state_ttl)
+        if row:
+            record = _Record(row[0], json.loads(row[1]), row[2])
+        else:
+            record = _Record(None, {}, time.time())
+        self._cache[cache_key] = record
+        return record
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
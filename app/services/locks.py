@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+import asyncio
+from contextlib import asynccontextmanager
+import logging
+import os
+import random
+import socket
+from typing import AsyncContextManager, AsyncIterator, Hashable, Protocol
+import uuid
+
+from app.repositories.lock_repository import LockRepository
+
+
+class LockLostError(RuntimeError):
+    """A write was fenced off because another holder took over the lock."""
+
+
+class LockBackend(Protocol):
+    # True when other processes take the same locks, i.e. may write the same users.
+    cross_process: bool
+
+    def hold(self, key: Hashable) -> AsyncContextManager[int | None]:
+        """Hold the lock for ``key``; yields a fencing token or ``None``."""
+
+
+class _Entry:
+    __slots__ = ("lock", "refs")
+
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        self.refs = 0
+
+
+class KeyedLock:
+    """Per-key mutual exclusion with a bounded footprint.
+
+    By default each key gets its own lock, reference-counted by holders and
+    waiters and dropped as soon as the count reaches zero, so memory follows
+    the number of keys in use rather than every key ever seen. With
+    ``stripes`` set, keys hash onto a fixed pool of locks instead; unrelated
+    keys may then wait on each other, so callers must never hold two keys
+    at once in that mode.
+    """
+
+    cross_process = False
+
+    def __init__(self, stripes: int = 0):
+        self._stripes = [asyncio.Lock() for _ in range(stripes)] if stripes > 0 else None
+        self._entries: dict[Hashable, _Entry] = {}
+
+    def __len__(self) -> int:
+        return len(self._stripes) if self._stripes is not None else len(self._entries)
+
+    @asynccontextmanager
+    async def hold(self, key: Hashable) -> AsyncIterator[None]:
+        if self._stripes is not None:
+            async with self._stripes[hash(key) % len(self._stripes)]:
+                yield None
+            return
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = _Entry()
+        entry.refs += 1
+        try:
+            async with entry.lock:
+                yield None
+        finally:
+            entry.refs -= 1
+            if entry.refs == 0:
+                del self._entries[key]
+
+
+class SQLiteLeaseLock:
+    """Cross-process lock built on a lease table in the shared SQLite file.
+
+    A holder owns the lease until it releases it or ``ttl`` passes without a
+    heartbeat, so a crashed process cannot block a user forever. Every
+    acquisition bumps the lock's fencing token; writers pass it to the
+    repository so a holder whose lease silently expired cannot overwrite
+    newer data. Contention inside one process is resolved in memory first.
+    """
+
+    cross_process = True
+
+    def __init__(
+        self,
+        repository: LockRepository,
+        ttl: float = 30.0,
+        namespace: str = "user",
+        poll_interval: float = 0.05,
+        max_poll_interval: float = 1.0,
+    ):
+        self._repository = repository
+        self._ttl = ttl
+        self._namespace = namespace
+        self._poll_interval = poll_interval
+        self._max_poll_interval = max_poll_interval
+        self._local = KeyedLock()
+        self._owner_prefix = f"{socket.gethostname()}:{os.getpid()}"
+        self._logger = logging.getLogger(__name__)
+
+    @asynccontextmanager
+    async def hold(self, key: Hashable) -> AsyncIterator[int]:
+        name = f"{self._namespace}:{key}"
+        async with self._local.hold(key):
+            owner = f"{self._owner_prefix}:{uuid.uuid4().hex}"
+            token = await self._acquire(name, owner)
+            heartbeat = asyncio.create_task(self._heartbeat(name, owner))
+            try:
+                yield token
+            finally:
+                heartbeat.cancel()
+                await self._repository.release(name, owner)
+
+    async def _acquire(self, name: str, owner: str) -> int:
+        delay = self._poll_interval
+        while True:
+            token = await self._repository.try_acquire(name, owner, self._ttl)
+            if token is not None:
+                return token
+            await asyncio.sleep(delay * (0.5 + random.random()))
+            delay = min(delay * 2, self._max_poll_interval)
+
+    async def _heartbeat(self, name: str, owner: str) -> None:
+        while True:
+            await asyncio.sleep(self._ttl / 3)
+            if not await self._repository.renew(name, owner, self._ttl):
+                self._logger.error("Lease lost while held: lock=%s", name)
+                return
@@ -1,64 +1,265 @@
 from __future__ import annotations
 
+import asyncio
 from datetime import datetime, timedelta
 import logging
-from typing import Any
+import re
+import time
+from typing import Any, Callable
 
 import aiohttp
 
+from app.repositories.token_repository import TokenRepository
+from app.services.marzban_auth import TokenManager
+from app.services.resilience import CircuitBreaker
+from app.utils.backoff import backoff_delay
+
+IDEMPOTENT_METHODS = frozenset({"GET", "PUT", "DELETE"})
+_USER_PATH = re.compile(r"^/api/user/[^/?]+")
+
+
+class _TokenExpired(Exception):
+    def __init__(self, token: str):
+        super().__init__("Marzban token rejected")
+        self.token = token
+
+
+def _endpoint_key(method: str, path: str) -> str:
+    # One breaker per route, not per user: /api/user/alice and /api/user/bob
+    # hit the same handler on the panel.
+    path = path.split("?", 1)[0]
+    path = _USER_PATH.sub("/api/user/{username}", path)
+    return f"{method} {path}"
+
 
 class MarzbanService:
-    def __init__(self, base_url: str, api_key: str):
+    def __init__(
+        self,
+        base_url: str,
+        api_key: str,
+        connection_limit: int = 20,
+        dns_cache_ttl: int = 300,
+        keepalive_timeout: float = 30.0,
+        request_timeout: float = 15.0,
+        request_budget: float = 30.0,
+        max_concurrency: int = 32,
+        retry_attempts: int = 3,
+        retry_base_delay: float = 0.5,
+        retry_max_delay: float = 5.0,
+        breaker_threshold: int = 5,
+        breaker_reset: float = 30.0,
+        token_repository: TokenRepository | None = None,
+        token_refresh_margin: float = 60.0,
+        name: str = "default",
+    ):
         self.base_url = base_url.rstrip("/")
+        self.name = name
+        # Called with (node, endpoint, status, seconds) for every HTTP attempt.
+        self.observer: Callable[[str, str, str, float], None] | None = None
         self.api_key = api_key
-        self._token: str | None = None
+        self._tokens: TokenManager | None = None
+        if self._can_refresh_token():
+            admin = api_key.split(":", maxsplit=1)[0].strip()
+            self._tokens = TokenManager(
+                f"{self.base_url}:{admin}",
+                self._fetch_token,
+                repository=token_repository,
+                refresh_margin=token_refresh_margin,
+            )
         self._logger = logging.getLogger(__name__)
+        self._connection_limit = connection_limit
+        self._dns_cache_ttl = dns_cache_ttl
+        self._keepalive_timeout = keepalive_timeout
+        self._timeout = aiohttp.ClientTimeout(total=request_timeout)
+        self._session: aiohttp.ClientSession | None = None
+        self._request_timeout = request_timeout
+        self._request_budget = request_budget
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._retry_attempts = max(1, retry_attempts)
+        self._retry_base_delay = retry_base_delay
+        self._retry_max_delay = retry_max_delay
+        self._breaker_threshold = breaker_threshold
+        self._breaker_reset = breaker_reset
+        self._breakers: dict[str, CircuitBreaker] = {}
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # The session must be created inside the running loop, so it is built
+        # on first use and reused for every request afterwards.
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self._connection_limit,
+                ttl_dns_cache=self._dns_cache_ttl,
+                keepalive_timeout=self._keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self._timeout)
+        return self._session
+
+    async def close(self) -> None:
+        if self._tokens is not None:
+            await self._tokens.close()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
 
     async def _request(self, method: str, path: str, json: dict[str, Any] | None = None) -> dict[str, Any]:
-        for attempt in range(2):
-            token = await self._get_token()
-            headers = {"Authorization": f"Bearer {token}"} if token else {}
-            async with aiohttp.ClientSession(headers=headers) as session:
-                async with session.request(method, f"{self.base_url}{path}", json=json, timeout=15) as resp:
-                    if resp.status == 401 and self._can_refresh_token() and attempt == 0:
-                        self._token = None
-                        continue
-                    if resp.status >= 400:
-                        body = await resp.text()
-                        self._logger.error(
-                            "Marzban API error %s %s: status=%s body=%s",
-                            method,
-                            path,
-                            resp.status,
-                            body,
-                        )
-                        resp.raise_for_status()
-                    if resp.status == 204:
-                        return {}
-                    try:
-                        return await resp.json(content_type=None)
-                    except aiohttp.ContentTypeError:
-                        return {}
-        return {}
+        endpoint = _endpoint_key(method, path)
+        breaker = self._breakers.get(endpoint)
+        if breaker is None:
+            breaker = CircuitBreaker(endpoint, self._breaker_threshold, self._breaker_reset)
+            self._breakers[endpoint] = breaker
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self._request_budget
+        attempts = self._retry_attempts if method in IDEMPOTENT_METHODS else 1
+        token_refreshed = False
+        attempt = 0
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError(f"Marzban request budget exhausted for {endpoint}")
+            breaker.before_call()
+            # Every exit below must settle the breaker, or a half-open trial
+            # slot stays taken and the endpoint is rejected until restart.
+            try:
+                async with self._semaphore:
+                    result = await self._send(
+                        method,
+                        path,
+                        json,
+                        min(self._request_timeout, remaining),
+                        allow_refresh=not token_refreshed,
+                    )
+                breaker.record_success()
+                return result
+            except _TokenExpired as exc:
+                # Not a panel failure: refresh once and retry without consuming an attempt.
+                breaker.record_success()
+                token_refreshed = True
+                await self._tokens.invalidate(exc.token)
+                continue
+            except aiohttp.ClientResponseError as exc:
+                if exc.status < 500 and exc.status != 429:
+                    breaker.record_success()
+                    raise
+                breaker.record_failure()
+                error: Exception = exc
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                breaker.record_failure()
+                error = exc
+            except asyncio.CancelledError:
+                breaker.release()
+                raise
+            except BaseException:
+                # E.g. a malformed JSON body: the panel answered, but badly.
+                breaker.record_failure()
+                raise
+            attempt += 1
+            if attempt >= attempts:
+                raise error
+            delay = backoff_delay(attempt, self._retry_base_delay, self._retry_max_delay)
+            if loop.time() + delay >= deadline:
+                raise error
+            self._logger.warning(
+                "Retrying Marzban %s in %.2fs (attempt %s/%s): %r",
+                endpoint,
+                delay,
+                attempt + 1,
+                attempts,
+                error,
+            )
+            await asyncio.sleep(delay)
+
+    async def _send(
+        self,
+        method: str,
+        path: str,
+        json: dict[str, Any] | None,
+        timeout: float,
+        allow_refresh: bool = True,
+    ) -> dict[str, Any]:
+        if self.observer is None:
+            return await self._send_request(method, path, json, timeout, allow_refresh)
+        started = time.perf_counter()
+        status = "2xx"
+        try:
+            return await self._send_request(method, path, json, timeout, allow_refresh)
+        except _TokenExpired:
+            status = "401"
+            raise
+        except aiohttp.ClientResponseError as exc:
+            status = str(exc.status)
+            raise
+        except BaseException as exc:
+            status = type(exc).__name__
+            raise
+        finally:
+            self.observer(self.name, _endpoint_key(method, path), status, time.perf_counter() - started)
+
+    async def _send_request(
+        self,
+        method: str,
+        path: str,
+        json: dict[str, Any] | None,
+        timeout: float,
+        allow_refresh: bool,
+    ) -> dict[str, Any]:
+        session = self._get_session()
+        token = await self._get_token()
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        async with session.request(
+            method,
+            f"{self.base_url}{path}",
+            json=json,
+            headers=headers,
+            timeout=aiohttp.ClientTimeout(total=timeout),
+        ) as resp:
+            if resp.status == 401 and self._tokens is not None and allow_refresh:
+                raise _TokenExpired(token)
+            if resp.status >= 400:
+                body = await resp.text()
+                self._logger.error(
+                    "Marzban API error %s %s: status=%s body=%s",
+                    method,
+                    path,
+                    resp.status,
+                    body,
+                )
+                resp.raise_for_status()
+            if resp.status == 204:
+                return {}
+            try:
+                return await resp.json(content_type=None)
+            except aiohttp.ContentTypeError:
+                return {}
+
+    async def probe(self, timeout: float) -> dict[str, Any]:
+        """One health-check call, bypassing retries and circuit breakers."""
+        try:
+            return await self._send("GET", "/api/system", None, timeout)
+        except _TokenExpired as exc:
+            await self._tokens.invalidate(exc.token)
+            return await self._send("GET", "/api/system", None, timeout, allow_refresh=False)
+
+    def breaker_states(self) -> dict[str, str]:
+        return {endpoint: breaker.state for endpoint, breaker in self._breakers.items()}
 
     async def _get_token(self) -> str:
         if not self.api_key:
             return ""
-        if ":" not in self.api_key:
+        if self._tokens is None:
             return self.api_key
-        if self._token is not None:
-            return self._token
+        return await self._tokens.get()
+
+    async def _fetch_token(self) -> str:
         username, password = [part.strip() for part in self.api_key.split(":", maxsplit=1)]
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{self.base_url}/api/admin/token",
-                data={"username": username, "password": password},
-                timeout=15,
-            ) as resp:
-                resp.raise_for_status()
-                data = await resp.json()
-        self._token = data.get("access_token") or data.get("token") or ""
-        return self._token
+        session = self._get_session()
+        async with session.post(
+            f"{self.base_url}/api/admin/token",
+            data={"username": username, "password": password},
+        ) as resp:
+            resp.raise_for_status()
+            data = await resp.json()
+        self._logger.info("Obtained Marzban admin token for %s", self.base_url)
+        return data.get("access_token") or data.get("token") or ""
 
     def _can_refresh_token(self) -> bool:
         return ":" in self.api_key
@@ -99,6 +300,12 @@ class MarzbanService:
     async def get_user(self, username: str) -> dict[str, Any]:
         return await self._request("GET", f"/api/user/{username}")
 
+    async def list_users(self, offset: int = 0, limit: int = 100) -> dict[str, Any]:
+        return await self._request("GET", f"/api/users?offset={offset}&limit={limit}")
+
+    async def get_system_stats(self) -> dict[str, Any]:
+        return await self._request("GET", "/api/system")
+
     async def delete_user(self, username: str) -> dict[str, Any]:
         return await self._request("DELETE", f"/api/user/{username}")
 
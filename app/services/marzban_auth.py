@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+import json
+import logging
+import time
+from typing import Awaitable, Callable
+
+from app.repositories.token_repository import TokenRepository
+
+
+def jwt_expiry(token: str) -> float | None:
+    """``exp`` claim of a JWT as epoch seconds; the signature is not checked."""
+    parts = token.split(".")
+    if len(parts) != 3:
+        return None
+    payload = parts[1] + "=" * (-len(parts[1]) % 4)
+    try:
+        claims = json.loads(base64.urlsafe_b64decode(payload))
+    except (ValueError, UnicodeDecodeError):
+        return None
+    exp = claims.get("exp") if isinstance(claims, dict) else None
+    return float(exp) if isinstance(exp, (int, float)) else None
+
+
+class TokenManager:
+    """Single-flight holder of a Marzban admin token.
+
+    Concurrent callers share one fetch, a token close to its ``exp`` is
+    refreshed in the background while still being served, and the token is
+    persisted so a restart does not log in again.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fetch: Callable[[], Awaitable[str]],
+        repository: TokenRepository | None = None,
+        refresh_margin: float = 60.0,
+    ):
+        self.name = name
+        self._fetch = fetch
+        self._repository = repository
+        self._refresh_margin = refresh_margin
+        self._token: str | None = None
+        self._expires_at: float | None = None
+        self._loaded = repository is None
+        self._lock = asyncio.Lock()
+        self._background: asyncio.Task | None = None
+        self._logger = logging.getLogger(__name__)
+        self.refreshes = 0
+
+    async def get(self) -> str:
+        token = self._token
+        if token is not None and self._loaded:
+            if self._expires_at is None:
+                return token
+            remaining = self._expires_at - time.time()
+            if remaining > self._refresh_margin:
+                return token
+            if remaining > 0:
+                self._refresh_in_background(token)
+                return token
+        return await self._refresh(token)
+
+    async def invalidate(self, token: str) -> None:
+        """Drop ``token`` after a 401, unless another request already replaced it."""
+        if self._token != token:
+            return
+        self._token = None
+        self._expires_at = None
+        if self._repository is not None:
+            await self._repository.delete(self.name, token)
+
+    async def close(self) -> None:
+        if self._background is not None:
+            self._background.cancel()
+            await asyncio.gather(self._background, return_exceptions=True)
+            self._background = None
+
+    def _refresh_in_background(self, stale: str) -> None:
+        if self._background is None or self._background.done():
+            self._background = asyncio.create_task(self._refresh_quietly(stale))
+
+    async def _refresh_quietly(self, stale: str) -> None:
+        try:
+            await self._refresh(stale)
+        except Exception:
+            self._logger.warning("Proactive Marzban token refresh failed: %s", self.name, exc_info=True)
+
+    async def _refresh(self, stale: str | None) -> str:
+        async with self._lock:
+            if not self._loaded:
+                self._loaded = True
+                await self._load()
+                if self._token is not None and not self._expires_soon():
+                    return self._token
+            # Whoever held the lock before us may already have refreshed.
+            if self._token is not None and self._token != stale and not self._expires_soon():
+                return self._token
+            token = await self._fetch()
+            self.refreshes += 1
+            self._token = token
+            self._expires_at = jwt_expiry(token)
+            if self._repository is not None:
+                await self._repository.save(self.name, token, self._expires_at)
+            return token
+
+    async def _load(self) -> None:
+        row = await self._repository.load(self.name)
+        if row is None:
+            return
+        token, expires_at = row
+        if expires_at is not None and expires_at <= time.time():
+            return
+        self._token = token
+        self._expires_at = expires_at
+
+    def _expires_soon(self) -> bool:
+        return self._expires_at is not None and self._expires_at - time.time() <= self._refresh_margin
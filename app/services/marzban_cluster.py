@@ -0,0 +1,195 @@
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+import logging
+import time
+from typing import Any, Collection
+
+from app.services.marzban import MarzbanService
+
+
+@dataclass
+class NodeLoad:
+    users: int = 0
+    active_users: int = 0
+    traffic_bytes: int = 0
+    max_users: int | None = None
+    updated_at: float = 0.0
+
+    @property
+    def full(self) -> bool:
+        return self.max_users is not None and self.users >= self.max_users
+
+
+@dataclass
+class NodeHealth:
+    healthy: bool = True
+    failures: int = 0
+    successes: int = 0
+    latency_ms: float | None = None
+    last_error: str | None = None
+    checked_at: float = 0.0
+
+
+class MarzbanCluster:
+    """Several Marzban panels behind the ``MarzbanService`` call surface.
+
+    Every user-level call takes the node the user lives on (``None`` means the
+    first, default node). New users are placed on the least loaded healthy
+    node by user count or traffic.
+
+    A background probe of ``/api/system`` refreshes loads and health: a node
+    is drained after ``unhealthy_after`` consecutive failures and re-admitted
+    after ``healthy_after`` consecutive successes.
+    """
+
+    def __init__(
+        self,
+        nodes: dict[str, MarzbanService],
+        placement: str = "users",
+        health_interval: float = 15.0,
+        health_timeout: float = 5.0,
+        unhealthy_after: int = 3,
+        healthy_after: int = 2,
+        max_users: dict[str, int | None] | None = None,
+    ):
+        if not nodes:
+            raise ValueError("MarzbanCluster needs at least one node")
+        self.nodes = nodes
+        self.default_node = next(iter(nodes))
+        self.placement = placement
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.unhealthy_after = unhealthy_after
+        self.healthy_after = healthy_after
+        self.loads = {
+            name: NodeLoad(max_users=(max_users or {}).get(name)) for name in nodes
+        }
+        self.health = {name: NodeHealth() for name in nodes}
+        self._task: asyncio.Task | None = None
+        self._logger = logging.getLogger(__name__)
+
+    def node(self, name: str | None) -> MarzbanService:
+        if name is None:
+            return self.nodes[self.default_node]
+        service = self.nodes.get(name)
+        if service is None:
+            self._logger.warning("Unknown Marzban node %r, using %s", name, self.default_node)
+            return self.nodes[self.default_node]
+        return service
+
+    def is_healthy(self, name: str | None) -> bool:
+        health = self.health.get(name or self.default_node)
+        return health is not None and health.healthy
+
+    def pick_node(self, exclude: Collection[str] = ()) -> str | None:
+        """Least loaded node outside ``exclude``, preferring healthy ones; ``None`` if all are excluded."""
+        names = [name for name in self.nodes if name not in exclude]
+        if not names:
+            return None
+        healthy = [name for name in names if self.health[name].healthy] or names
+        candidates = [name for name in healthy if not self.loads[name].full] or healthy
+        if self.placement == "traffic":
+            name = min(candidates, key=lambda item: (self.loads[item].traffic_bytes, self.loads[item].users))
+        else:
+            name = min(candidates, key=lambda item: (self.loads[item].users, self.loads[item].traffic_bytes))
+        return name
+
+    def report_failure(self, name: str | None, error: BaseException) -> None:
+        """Count a failed call made outside the probe towards draining the node."""
+        self._record(name or self.default_node, error=error)
+
+    def start(self) -> None:
+        if self._task is None and self.health_interval > 0:
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for service in self.nodes.values():
+            await service.close()
+
+    async def _loop(self) -> None:
+        while True:
+            await self.check_nodes()
+            await asyncio.sleep(self.health_interval)
+
+    async def check_nodes(self) -> None:
+        await asyncio.gather(*(self._check(name) for name in self.nodes))
+
+    async def _check(self, name: str) -> None:
+        started = time.monotonic()
+        try:
+            stats = await self.nodes[name].probe(self.health_timeout)
+        except Exception as exc:
+            self._record(name, error=exc)
+            return
+        self._record(name, latency=time.monotonic() - started)
+        load = self.loads[name]
+        load.users = int(stats.get("total_user") or 0)
+        load.active_users = int(stats.get("users_active") or 0)
+        load.traffic_bytes = int(stats.get("incoming_bandwidth") or 0) + int(stats.get("outgoing_bandwidth") or 0)
+        load.updated_at = time.time()
+
+    def _record(self, name: str, latency: float | None = None, error: BaseException | None = None) -> None:
+        health = self.health[name]
+        health.checked_at = time.time()
+        if error is not None:
+            health.failures += 1
+            health.successes = 0
+            health.last_error = f"{type(error).__name__}: {error}"
+            if health.healthy and health.failures >= self.unhealthy_after:
+                health.healthy = False
+                self._logger.warning("Marzban node %s drained: %s", name, health.last_error)
+            return
+        health.successes += 1
+        health.failures = 0
+        latency_ms = (latency or 0.0) * 1000
+        # Smoothed so a single slow probe does not swing the number.
+        health.latency_ms = latency_ms if health.latency_ms is None else health.latency_ms * 0.7 + latency_ms * 0.3
+        if not health.healthy and health.successes >= self.healthy_after:
+            health.healthy = True
+            health.last_error = None
+            self._logger.info("Marzban node %s re-admitted", name)
+
+    async def create_user(
+        self,
+        username: str,
+        expire_at: datetime,
+        traffic_gb: float | None = None,
+        proxy: str | None = None,
+        flow: str | None = None,
+        inbounds: list[str] | None = None,
+        node: str | None = None,
+    ) -> dict[str, Any]:
+        created = await self.node(node).create_user(username, expire_at, traffic_gb, proxy, flow, inbounds)
+        # Count the account now so a burst of signups between two refreshes
+        # does not all land on the same node; picks that never create (failed
+        # or probing calls) must not inflate the load.
+        self.loads[node if node in self.loads else self.default_node].users += 1
+        return created
+
+    async def renew_user(self, username: str, add_days: timedelta, node: str | None = None) -> dict[str, Any]:
+        return await self.node(node).renew_user(username, add_days)
+
+    async def update_user_expire(self, username: str, expire_at: datetime, node: str | None = None) -> dict[str, Any]:
+        return await self.node(node).update_user_expire(username, expire_at)
+
+    async def get_user(self, username: str, node: str | None = None) -> dict[str, Any]:
+        return await self.node(node).get_user(username)
+
+    async def list_users(self, offset: int = 0, limit: int = 100, node: str | None = None) -> dict[str, Any]:
+        return await self.node(node).list_users(offset=offset, limit=limit)
+
+    async def delete_user(self, username: str, node: str | None = None) -> dict[str, Any]:
+        return await self.node(node).delete_user(username)
+
+    async def get_subscription_link(self, username: str, node: str | None = None) -> str:
+        return await self.node(node).get_subscription_link(username)
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass
+from datetime import datetime
+import logging
+import time
+
+import aiohttp
+
+from app.config import Settings
+from app.repositories.user_repository import UserRepository
+from app.services.marzban_cluster import MarzbanCluster
+from app.services.subscription import SubscriptionService
+
+
+@dataclass
+class SyncMetrics:
+    runs: int = 0
+    pages: int = 0
+    users_seen: int = 0
+    orphans_deleted: int = 0
+    last_run_at: datetime | None = None
+    last_run_seconds: float = 0.0
+
+
+class MarzbanSyncWorker:
+    """Periodically pages through Marzban's user list and reconciles ``users``.
+
+    Rows touched by a sync get ``synced_at``; ``SubscriptionService.get_status``
+    serves those straight from SQLite while they are younger than
+    ``marzban_sync_max_staleness``.
+    """
+
+    def __init__(
+        self,
+        settings: Settings,
+        user_repo: UserRepository,
+        marzban: MarzbanCluster,
+        subscription_service: SubscriptionService,
+    ):
+        self.settings = settings
+        self.user_repo = user_repo
+        self.marzban = marzban
+        self.subscription_service = subscription_service
+        self.metrics = SyncMetrics()
+        self._task: asyncio.Task | None = None
+        self._logger = logging.getLogger(__name__)
+
+    def start(self) -> None:
+        if self._task is None and self.settings.marzban_sync_interval > 0:
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await self.sync_once()
+            except Exception:
+                self._logger.exception("Marzban user sync failed")
+            await asyncio.sleep(self.settings.marzban_sync_interval)
+
+    async def sync_once(self) -> int:
+        started = time.monotonic()
+        synced_at = datetime.utcnow()
+        seen = 0
+        for node in self.marzban.nodes:
+            try:
+                seen += await self._sync_node(node)
+            except Exception:
+                # One unreachable node must not keep the others stale.
+                self._logger.exception("Marzban user sync failed: node=%s", node)
+        self.metrics.runs += 1
+        self.metrics.users_seen = seen
+        self.metrics.last_run_at = synced_at
+        self.metrics.last_run_seconds = time.monotonic() - started
+        self._logger.info("Marzban user sync finished: users=%s seconds=%.2f", seen, self.metrics.last_run_seconds)
+        return seen
+
+    async def _sync_node(self, node: str) -> int:
+        await self._purge_orphans(node)
+        page_size = self.settings.marzban_sync_page_size
+        offset = 0
+        seen = 0
+        while True:
+            fetched_at = datetime.utcnow()
+            data = await self.marzban.list_users(offset=offset, limit=page_size, node=node)
+            users = data.get("users") or []
+            rows = []
+            for marzban_user in users:
+                username = marzban_user.get("username")
+                if not username:
+                    continue
+                expires_at, link, used_traffic = self.subscription_service.marzban_snapshot(marzban_user)
+                rows.append((str(username), expires_at, link, used_traffic))
+            if rows:
+                await self.user_repo.apply_marzban_sync(rows, fetched_at, node=node)
+            self.metrics.pages += 1
+            seen += len(users)
+            offset += len(users)
+            total = data.get("total")
+            if len(users) < page_size or (isinstance(total, int) and offset >= total):
+                break
+        return seen
+
+    async def _purge_orphans(self, node: str) -> None:
+        """Delete accounts left on ``node`` by users who were moved to another node."""
+        for username in await self.user_repo.list_marzban_orphans(node):
+            try:
+                await self.marzban.delete_user(username, node=node)
+            except Exception as exc:
+                if not (isinstance(exc, aiohttp.ClientResponseError) and exc.status == 404):
+                    # Retried on the next sync; the node's users are still synced.
+                    self._logger.warning(
+                        "Deleting old-node account failed: node=%s username=%s error=%r", node, username, exc
+                    )
+                    return
+            await self.user_repo.remove_marzban_orphan(node, username)
+            self.metrics.orphans_deleted += 1
+            self._logger.info("Deleted Marzban account left on old node: node=%s username=%s", node, username)
@@ -0,0 +1,183 @@
+from __future__ import annotations
+
+from bisect import bisect_left
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Callable, Iterable
+
+# (labels, value) pairs of one metric family.
+Samples = Iterable[tuple[dict[str, str], float]]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # Per label set: non-cumulative bucket counts (+Inf last), sum.
+        self._series: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = ([0] * (len(self.buckets) + 1), [0.0])
+            self._series[labels] = series
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1][0] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, labels)} {_format_value(total[0])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Minimal Prometheus text-format registry.
+
+    Counters and histograms are updated in place; gauges are collected on
+    scrape from callbacks, so components only expose the numbers they
+    already keep.
+    """
+
+    def __init__(self) -> None:
+        self._metrics: list[Counter | Histogram] = []
+        self._gauges: list[tuple[str, str, Callable[[], Samples]]] = []
+
+    def counter(self, name: str, help_text: str, labels: tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, help_text, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(
+        self,
+        name: str,
+        help_text: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        metric = Histogram(name, help_text, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, help_text: str, collect: Callable[[], Samples]) -> None:
+        self._gauges.append((name, help_text, collect))
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for name, help_text, collect in self._gauges:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in collect():
+                names = tuple(labels)
+                values = tuple(str(labels[key]) for key in names)
+                lines.append(f"{name}{_format_labels(names, values)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+@dataclass
+class UpdateScope:
+    """Work done on behalf of the update currently being handled."""
+
+    db_statements: int = 0
+    db_seconds: float = 0.0
+    marzban_calls: int = 0
+
+
+current_scope: ContextVar[UpdateScope | None] = ContextVar("metrics_update_scope", default=None)
+
+
+class BotMetrics:
+    def __init__(self, registry: Registry | None = None):
+        self.registry = registry or Registry()
+        r = self.registry
+        self.handler_seconds = r.histogram("bot_handler_seconds", "Handler latency.", ("handler",))
+        self.handler_errors = r.counter("bot_handler_errors_total", "Handler exceptions.", ("handler", "error"))
+        self.handler_db_statements = r.histogram(
+            "bot_handler_db_statements", "DB statements per handled update.", ("handler",), COUNT_BUCKETS
+        )
+        self.handler_marzban_calls = r.histogram(
+            "bot_handler_marzban_calls", "Marzban requests per handled update.", ("handler",), COUNT_BUCKETS
+        )
+        self.db_seconds = r.histogram(
+            "db_statement_seconds", "SQLite statement time including lock wait.", ("kind",)
+        )
+        self.marzban_requests = r.counter(
+            "marzban_requests_total", "Marzban HTTP requests by outcome.", ("node", "endpoint", "status")
+        )
+        self.marzban_seconds = r.histogram(
+            "marzban_request_seconds", "Marzban HTTP request latency.", ("node", "endpoint")
+        )
+
+    def observe_db(self, kind: str, seconds: float) -> None:
+        self.db_seconds.observe(seconds, kind)
+        scope = current_scope.get()
+        if scope is not None:
+            scope.db_statements += 1
+            scope.db_seconds += seconds
+
+    def observe_marzban(self, node: str, endpoint: str, status: str, seconds: float) -> None:
+        self.marzban_requests.inc(node, endpoint, status)
+        self.marzban_seconds.observe(seconds, node, endpoint)
+        scope = current_scope.get()
+        if scope is not None:
+            scope.marzban_calls += 1
+
+    def observe_handler(self, handler: str, seconds: float, scope: UpdateScope, error: BaseException | None) -> None:
+        self.handler_seconds.observe(seconds, handler)
+        self.handler_db_statements.observe(scope.db_statements, handler)
+        self.handler_marzban_calls.observe(scope.marzban_calls, handler)
+        if error is not None:
+            self.handler_errors.inc(handler, type(error).__name__)
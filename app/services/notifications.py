@@ -0,0 +1,27 @@
+from __future__ import annotations
+
+import logging
+
+from aiogram import Bot
+
+from app.keyboards.common import connection_keyboard
+
+logger = logging.getLogger(__name__)
+
+ACCESS_READY_TEXT = (
+    "🛡 DagDev VPN\n"
+    "━━━━━━━━━━━━\n"
+    "Your VPN is ready.\n"
+    "Tap the button below to connect."
+)
+ACCESS_NOT_READY_TEXT = "ℹ️ Access link is not ready yet."
+
+
+async def send_access_message(bot: Bot, chat_id: int, link: str) -> bool:
+    keyboard = connection_keyboard(link)
+    if not keyboard:
+        logger.warning("Access link invalid for connection button: %s", link)
+        await bot.send_message(chat_id, ACCESS_NOT_READY_TEXT)
+        return False
+    await bot.send_message(chat_id, ACCESS_READY_TEXT, reply_markup=keyboard)
+    return True
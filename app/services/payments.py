@@ -1,9 +1,14 @@
 from __future__ import annotations
 
+from datetime import datetime
 import hashlib
+import hmac
+import json
+import logging
+from typing import Mapping
 
-from app.config import Settings
-from app.models.payment import PaymentInvoice
+from app.config import TARIFFS, Settings
+from app.models.payment import PaymentInvoice, PaymentResult
 from app.repositories.payment_repository import PaymentRepository
 
 
@@ -11,6 +16,7 @@ class PaymentService:
     def __init__(self, settings: Settings, payment_repo: PaymentRepository):
         self.settings = settings
         self.payment_repo = payment_repo
+        self._logger = logging.getLogger(__name__)
 
     async def create_invoice(self, user_id: int, tariff_code: str, amount: float) -> PaymentInvoice:
         invoice_id = self._payload_for_tariff(tariff_code)
@@ -24,6 +30,89 @@ class PaymentService:
             payment_url=payment_url,
         )
 
+    async def verify_webhook(self, payload: str, signature: str) -> PaymentResult | None:
+        """Check an HMAC-SHA256 signed JSON notification and parse it."""
+        secret = self.settings.payment_webhook_secret
+        if not secret:
+            return None
+        expected = hmac.new(secret.encode(), payload.encode(), hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(expected, signature.strip().lower()):
+            self._logger.warning("Payment webhook rejected: bad signature")
+            return None
+        try:
+            data = json.loads(payload)
+            invoice_id = str(data["invoice_id"])
+            status = str(data.get("status", "paid"))
+            amount = float(data.get("amount", 0))
+            raw_telegram_id = data.get("telegram_id")
+            telegram_id = int(raw_telegram_id) if raw_telegram_id is not None else None
+            tariff_code = data.get("tariff_code")
+            tariff_code = str(tariff_code) if tariff_code in TARIFFS else None
+        except (ValueError, KeyError, TypeError):
+            self._logger.warning("Payment webhook rejected: malformed payload")
+            return None
+        if status not in {"paid", "success", "succeeded"}:
+            return None
+        return PaymentResult(
+            invoice_id=invoice_id,
+            status="paid",
+            amount=amount,
+            currency=str(data.get("currency") or self.settings.payment_currency),
+            paid_at=datetime.utcnow(),
+            telegram_id=telegram_id,
+            tariff_code=tariff_code,
+        )
+
+    async def verify_robokassa(self, form: Mapping[str, str]) -> PaymentResult | None:
+        """Check a Robokassa ResultURL notification signed with Password #2."""
+        secret = self.settings.payment_webhook_secret
+        out_sum = form.get("OutSum")
+        inv_id = form.get("InvId")
+        signature = form.get("SignatureValue", "")
+        if not secret or not out_sum or not inv_id:
+            return None
+        shp = ":".join(f"{key}={form[key]}" for key in sorted(form) if key.startswith("Shp_"))
+        base = f"{out_sum}:{inv_id}:{secret}" + (f":{shp}" if shp else "")
+        expected = hashlib.md5(base.encode()).hexdigest()
+        if not hmac.compare_digest(expected, signature.strip().lower()):
+            self._logger.warning("Robokassa webhook rejected: bad signature invoice_id=%s", inv_id)
+            return None
+        telegram_id = form.get("Shp_telegram_id")
+        tariff_code = form.get("Shp_tariff")
+        try:
+            amount = float(out_sum)
+        except ValueError:
+            return None
+        return PaymentResult(
+            invoice_id=str(inv_id),
+            status="paid",
+            amount=amount,
+            currency=self.settings.payment_currency,
+            paid_at=datetime.utcnow(),
+            telegram_id=int(telegram_id) if telegram_id and telegram_id.isdigit() else None,
+            tariff_code=tariff_code if tariff_code in TARIFFS else None,
+        )
+
+    async def accept_paid(self, result: PaymentResult) -> str:
+        """Record a verified payment for provisioning.
+
+        Returns ``accepted`` the first time an invoice is seen as paid,
+        ``duplicate`` for provider retries and ``unknown`` when the invoice
+        does not exist and the notification lacks the data to create it.
+        """
+        accepted = await self.payment_repo.accept_paid(
+            result.invoice_id,
+            result.telegram_id,
+            result.tariff_code,
+            result.amount,
+            result.currency,
+        )
+        if accepted:
+            return "accepted"
+        if await self.payment_repo.get_payment(result.invoice_id):
+            return "duplicate"
+        return "unknown"
+
     def _payload_for_tariff(self, tariff_code: str) -> str:
         payloads = {
             "m1": "vpn_1m",
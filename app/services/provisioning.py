@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass
+import logging
+
+from aiogram import Bot
+
+from app.config import Settings
+from app.models.job import ProvisioningJob
+from app.repositories.job_repository import ProvisioningJobRepository
+from app.repositories.payment_repository import PaymentRepository
+from app.services.notifications import send_access_message
+from app.services.resilience import CircuitOpenError
+from app.services.subscription import SubscriptionService
+from app.utils.backoff import backoff_delay
+
+
+@dataclass
+class ProvisioningMetrics:
+    enqueued: int = 0
+    succeeded: int = 0
+    retried: int = 0
+    dead: int = 0
+
+
+class ProvisioningQueue:
+    """SQLite-backed queue that provisions paid invoices off the request path.
+
+    Delivery is at-least-once: jobs interrupted by a crash are re-queued on
+    start, and a repeated run of an already completed invoice is turned into
+    a no-op by ``SubscriptionService.process_payment_success``. Jobs that keep
+    failing are dead-lettered into ``paid_pending`` for the reconciliation
+    worker and the admins are told about them.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        settings: Settings,
+        job_repo: ProvisioningJobRepository,
+        payment_repo: PaymentRepository,
+        subscription_service: SubscriptionService,
+    ):
+        self.bot = bot
+        self.settings = settings
+        self.job_repo = job_repo
+        self.payment_repo = payment_repo
+        self.subscription_service = subscription_service
+        self.metrics = ProvisioningMetrics()
+        self._wakeup = asyncio.Event()
+        self._workers: list[asyncio.Task] = []
+        self._logger = logging.getLogger(__name__)
+
+    async def enqueue(self, invoice_id: str, chat_id: int | None = None) -> bool:
+        payment_row = await self.payment_repo.get_payment(invoice_id)
+        if not payment_row:
+            return False
+        telegram_id = payment_row[1]
+        added = await self.job_repo.enqueue(invoice_id, telegram_id, chat_id or telegram_id)
+        if added:
+            self.metrics.enqueued += 1
+            self._wakeup.set()
+        return added
+
+    async def start(self) -> None:
+        if self._workers:
+            return
+        requeued = await self.job_repo.requeue_running()
+        if requeued:
+            self._logger.warning("Re-queued %s provisioning jobs interrupted by a restart", requeued)
+        self._workers = [
+            asyncio.create_task(self._worker()) for _ in range(self.settings.provisioning_workers)
+        ]
+
+    async def close(self) -> None:
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _worker(self) -> None:
+        while True:
+            try:
+                jobs = await self.job_repo.claim()
+            except Exception:
+                self._logger.exception("Failed to claim provisioning job")
+                jobs = []
+            if not jobs:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.settings.provisioning_poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+            for job in jobs:
+                await self._run(job)
+
+    async def _run(self, job: ProvisioningJob) -> None:
+        try:
+            user = await self.subscription_service.process_payment_success(job.invoice_id)
+        except asyncio.CancelledError:
+            # Stays 'running' and is re-queued on next start.
+            raise
+        except Exception as exc:
+            await self._handle_failure(job, exc)
+            return
+        await self.job_repo.complete(job.id)
+        self.metrics.succeeded += 1
+        chat_id = job.chat_id or job.telegram_id
+        try:
+            link = user.subscription_link if user else None
+            if user and not link:
+                status = await self.subscription_service.get_status(user.telegram_id)
+                link = status.subscription_link if status else None
+            if link:
+                await send_access_message(self.bot, chat_id, link)
+            else:
+                await self.bot.send_message(
+                    chat_id,
+                    "Оплата подтверждена, но ссылка на подписку пока не готова. Напиши в поддержку.",
+                )
+        except Exception:
+            self._logger.warning("Failed to notify user after provisioning: invoice_id=%s", job.invoice_id, exc_info=True)
+
+    async def _handle_failure(self, job: ProvisioningJob, exc: Exception) -> None:
+        error = f"{type(exc).__name__}: {exc}"
+        if job.attempts < self.settings.provisioning_max_attempts:
+            delay = backoff_delay(
+                job.attempts,
+                self.settings.provisioning_base_delay,
+                self.settings.provisioning_max_delay,
+            )
+            if isinstance(exc, CircuitOpenError):
+                # No point in retrying before the breaker lets a trial call through.
+                delay = max(delay, exc.retry_after)
+            self._logger.warning(
+                "Provisioning failed, retrying: invoice_id=%s attempt=%s next_in=%.1fs error=%s",
+                job.invoice_id,
+                job.attempts,
+                delay,
+                error,
+            )
+            await self.job_repo.retry_later(job.id, delay, error)
+            self.metrics.retried += 1
+            return
+        self._logger.error("Provisioning dead-lettered: invoice_id=%s error=%s", job.invoice_id, error)
+        await self.job_repo.bury(job.id, error)
+        await self.payment_repo.mark_paid_pending(job.invoice_id)
+        self.metrics.dead += 1
+        for admin_id in self.settings.telegram_admin_ids:
+            try:
+                await self.bot.send_message(
+                    admin_id,
+                    "ℹ️ Оплата принята, но выдача доступа отложена.\n"
+                    f"Invoice: {job.invoice_id}\n"
+                    f"Ошибка: {error}",
+                )
+            except Exception:
+                self._logger.warning("Failed to notify admin %s", admin_id, exc_info=True)
@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass
+from datetime import datetime
+import logging
+import time
+
+from aiogram import Bot
+
+from app.config import Settings
+from app.repositories.payment_repository import PaymentRepository
+from app.services.notifications import send_access_message
+from app.services.subscription import SubscriptionService
+from app.utils.backoff import backoff_delay
+
+
+@dataclass
+class ReconciliationMetrics:
+    runs: int = 0
+    attempts: int = 0
+    succeeded: int = 0
+    failed: int = 0
+    backlog: int = 0
+    waiting_backoff: int = 0
+    last_run_at: datetime | None = None
+    last_run_seconds: float = 0.0
+
+
+class PendingPaymentWorker:
+    """Background retry of ``paid_pending`` invoices.
+
+    Due invoices are provisioned concurrently up to
+    ``pending_retry_concurrency``. ``SubscriptionService`` still serializes
+    work per telegram_id, and every failed invoice waits out its own
+    jittered exponential backoff before the next attempt.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        settings: Settings,
+        payment_repo: PaymentRepository,
+        subscription_service: SubscriptionService,
+    ):
+        self.bot = bot
+        self.settings = settings
+        self.payment_repo = payment_repo
+        self.subscription_service = subscription_service
+        self.metrics = ReconciliationMetrics()
+        self._backoff: dict[str, tuple[int, float]] = {}
+        self._run_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._logger = logging.getLogger(__name__)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    def wake(self) -> None:
+        self._wakeup.set()
+
+    async def close(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                self._logger.exception("Pending payment reconciliation failed")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.settings.pending_retry_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def run_once(self, force: bool = False) -> tuple[int, int]:
+        """Retry due invoices; ``force`` ignores backoff. Returns (succeeded, failed)."""
+        async with self._run_lock:
+            started = time.monotonic()
+            pending = await self.payment_repo.list_pending_invoices()
+            pending_set = set(pending)
+            for invoice_id in list(self._backoff):
+                if invoice_id not in pending_set:
+                    del self._backoff[invoice_id]
+            due = [invoice_id for invoice_id in pending if force or self._is_due(invoice_id, started)]
+            semaphore = asyncio.Semaphore(self.settings.pending_retry_concurrency)
+            results = await asyncio.gather(*(self._retry(invoice_id, semaphore) for invoice_id in due))
+            succeeded = sum(1 for result in results if result)
+            failed = len(results) - succeeded
+
+            self.metrics.runs += 1
+            self.metrics.attempts += len(results)
+            self.metrics.succeeded += succeeded
+            self.metrics.failed += failed
+            self.metrics.backlog = len(pending) - succeeded
+            self.metrics.waiting_backoff = len(self._backoff)
+            self.metrics.last_run_at = datetime.utcnow()
+            self.metrics.last_run_seconds = time.monotonic() - started
+            if results:
+                self._logger.info(
+                    "Pending payments retried: succeeded=%s failed=%s backlog=%s",
+                    succeeded,
+                    failed,
+                    self.metrics.backlog,
+                )
+            return succeeded, failed
+
+    def _is_due(self, invoice_id: str, now: float) -> bool:
+        state = self._backoff.get(invoice_id)
+        return state is None or state[1] <= now
+
+    def _schedule_backoff(self, invoice_id: str) -> float:
+        failures = self._backoff.get(invoice_id, (0, 0.0))[0] + 1
+        delay = backoff_delay(
+            failures,
+            self.settings.pending_retry_base_delay,
+            self.settings.pending_retry_max_delay,
+        )
+        self._backoff[invoice_id] = (failures, time.monotonic() + delay)
+        return delay
+
+    async def _retry(self, invoice_id: str, semaphore: asyncio.Semaphore) -> bool:
+        async with semaphore:
+            try:
+                user = await self.subscription_service.process_payment_success(invoice_id)
+            except Exception:
+                delay = self._schedule_backoff(invoice_id)
+                self._logger.warning(
+                    "Pending payment retry failed: invoice_id=%s next_attempt_in=%.1fs",
+                    invoice_id,
+                    delay,
+                    exc_info=True,
+                )
+                await self.payment_repo.mark_paid_pending(invoice_id)
+                return False
+            self._backoff.pop(invoice_id, None)
+            if not user:
+                return False
+            if user.subscription_link:
+                try:
+                    await send_access_message(self.bot, user.telegram_id, user.subscription_link)
+                except Exception:
+                    self._logger.warning(
+                        "Failed to notify user after pending retry: invoice_id=%s telegram_id=%s",
+                        invoice_id,
+                        user.telegram_id,
+                        exc_info=True,
+                    )
+            return True
@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+import asyncio
+from datetime import datetime
+import heapq
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramForbiddenError, TelegramRetryAfter
+
+from app.config import Settings
+from app.keyboards.common import renew_keyboard
+from app.repositories.reminder_repository import ReminderRepository
+from app.repositories.user_repository import UserRepository
+from app.utils.epoch import from_epoch, to_epoch
+from app.utils.ratelimit import RateLimiter
+
+# (kind, seconds before expiry), earliest first.
+REMINDERS: tuple[tuple[str, int], ...] = (("3d", 3 * 86400), ("1d", 86400), ("expired", 0))
+
+REMINDER_TEXTS = {
+    "3d": "⏳ Подписка закончится через 3 дня ({date}). Продли заранее, чтобы VPN не отключился.",
+    "1d": "⚠️ Подписка закончится завтра ({date}). Продли сейчас — дни добавятся к текущему сроку.",
+    "expired": "❌ Подписка закончилась {date}. Продли её, чтобы снова пользоваться VPN.",
+}
+
+
+class ReminderScheduler:
+    """Sends expiry reminders from a min-heap of due times.
+
+    Only reminders due within the next ``reminder_horizon`` seconds are kept
+    in memory; the window is reloaded from the expiry index when it runs out.
+    The loop sleeps until the earliest entry is due, and
+    ``on_expiry_changed`` re-plans a single user and wakes it. Entries made
+    obsolete by a renewal are dropped lazily when popped. ``reminders_sent``
+    guarantees one message per (user, kind, expiry) across restarts.
+    """
+
+    MAX_RETRIES = 2
+
+    def __init__(
+        self,
+        bot: Bot,
+        settings: Settings,
+        reminder_repo: ReminderRepository,
+        user_repo: UserRepository,
+    ):
+        self.bot = bot
+        self.settings = settings
+        self.reminder_repo = reminder_repo
+        self.user_repo = user_repo
+        self._heap: list[tuple[int, int, str, int]] = []
+        self._expiry: dict[int, int] = {}
+        self._window_end = 0
+        self._wakeup = asyncio.Event()
+        self._limiter = RateLimiter(settings.reminder_rate_limit)
+        self._task: asyncio.Task | None = None
+        self._logger = logging.getLogger(__name__)
+        self.sent = 0
+
+    def start(self) -> None:
+        if self._task is None and self.settings.reminder_horizon > 0:
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def on_expiry_changed(self, telegram_id: int, expires_at: datetime | None) -> None:
+        self._expiry.pop(telegram_id, None)
+        expires_ts = to_epoch(expires_at)
+        if expires_ts is not None:
+            self._plan(telegram_id, expires_ts, int(time.time()), catch_up=False)
+        self._wakeup.set()
+
+    def _plan(self, telegram_id: int, expires_at: int, now: int, catch_up: bool = True) -> None:
+        """Queue the user's reminders due within the window.
+
+        ``catch_up`` keeps reminders that are already overdue (missed while
+        the bot was down). A fresh expiry has no missed reminders: a new
+        1-day trial must not be told "3 days left" on activation.
+        """
+        if expires_at < now - self.settings.reminder_expired_grace:
+            return
+        planned = False
+        for kind, offset in REMINDERS:
+            due = expires_at - offset
+            if not catch_up and due <= now and kind != "expired":
+                continue
+            if due < self._window_end:
+                heapq.heappush(self._heap, (due, telegram_id, kind, expires_at))
+                planned = True
+        if planned:
+            self._expiry[telegram_id] = expires_at
+
+    async def _reload(self, now: int) -> None:
+        self._window_end = now + int(self.settings.reminder_horizon)
+        self._heap.clear()
+        self._expiry.clear()
+        grace = int(self.settings.reminder_expired_grace)
+        rows = await self.reminder_repo.list_expiring(now - grace, self._window_end + REMINDERS[0][1])
+        for telegram_id, expires_at in rows:
+            self._plan(telegram_id, expires_at, now)
+        await self.reminder_repo.purge(now - grace)
+        self._logger.info("Reminder window loaded: users=%s reminders=%s", len(self._expiry), len(self._heap))
+
+    async def _loop(self) -> None:
+        while True:
+            now = int(time.time())
+            if now >= self._window_end:
+                try:
+                    await self._reload(now)
+                except Exception:
+                    self._logger.exception("Failed to load reminder window")
+                    await asyncio.sleep(60)
+                    continue
+            next_due = self._heap[0][0] if self._heap else self._window_end
+            timeout = min(next_due, self._window_end) - time.time()
+            if timeout > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._fire_due(now)
+
+    async def _fire_due(self, now: int) -> None:
+        while self._heap and self._heap[0][0] <= now:
+            due, telegram_id, kind, expires_at = heapq.heappop(self._heap)
+            if self._expiry.get(telegram_id) != expires_at or self._superseded(kind, expires_at, now):
+                continue
+            try:
+                await self._send(telegram_id, kind, expires_at)
+            except Exception:
+                self._logger.exception("Reminder failed: telegram_id=%s kind=%s", telegram_id, kind)
+
+    @staticmethod
+    def _superseded(kind: str, expires_at: int, now: int) -> bool:
+        # After downtime several reminders can be overdue at once; only the
+        # latest one still makes sense.
+        kinds = [name for name, _ in REMINDERS]
+        return any(expires_at - offset <= now for _, offset in REMINDERS[kinds.index(kind) + 1 :])
+
+    async def _send(self, telegram_id: int, kind: str, expires_at: int) -> None:
+        # The sync worker may have moved the expiry without telling us.
+        if await self.reminder_repo.get_expiry(telegram_id) != expires_at:
+            return
+        if not await self.reminder_repo.try_mark_sent(telegram_id, kind, expires_at):
+            return
+        text = REMINDER_TEXTS[kind].format(date=from_epoch(expires_at).strftime("%d.%m.%Y"))
+        for _ in range(self.MAX_RETRIES + 1):
+            await self._limiter.acquire()
+            try:
+                await self.bot.send_message(telegram_id, text, reply_markup=renew_keyboard())
+                self.sent += 1
+                return
+            except TelegramRetryAfter as exc:
+                self._limiter.pause(exc.retry_after)
+            except TelegramForbiddenError:
+                await self.user_repo.mark_blocked(telegram_id)
+                return
+            except TelegramAPIError:
+                self._logger.warning("Reminder delivery failed: telegram_id=%s", telegram_id, exc_info=True)
+                break
+        # Not delivered: let the next window load try again.
+        await self.reminder_repo.unmark_sent(telegram_id, kind, expires_at)
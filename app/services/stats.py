@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass
+import logging
+import time
+
+from app.repositories.stats_repository import StatsRepository
+
+
+@dataclass
+class StatsSnapshot:
+    total_users: int
+    active_subscriptions: int
+    paid_count: int
+    paid_total: float
+    signups_today: int
+    revenue_today: float
+    signups_24h: int
+    revenue_24h: float
+    taken_at: float
+
+
+class StatsService:
+    """Admin statistics from the trigger-maintained counters, cached for ``ttl`` seconds.
+
+    Rendering only reads; past expiry buckets are purged by a background
+    task every ``purge_interval`` seconds so the view never takes the
+    writer lock.
+    """
+
+    def __init__(self, stats_repo: StatsRepository, ttl: float = 10.0, purge_interval: float = 3600.0):
+        self.stats_repo = stats_repo
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._snapshot: StatsSnapshot | None = None
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self._logger = logging.getLogger(__name__)
+
+    def start(self) -> None:
+        if self._task is None and self.purge_interval > 0:
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await self.stats_repo.purge_expired_buckets(int(time.time()))
+            except Exception:
+                self._logger.exception("Stats bucket purge failed")
+            await asyncio.sleep(self.purge_interval)
+
+    async def snapshot(self) -> StatsSnapshot:
+        snapshot = self._snapshot
+        if snapshot is not None and time.time() - snapshot.taken_at < self.ttl:
+            return snapshot
+        async with self._lock:
+            snapshot = self._snapshot
+            if snapshot is not None and time.time() - snapshot.taken_at < self.ttl:
+                return snapshot
+            self._snapshot = await self._collect()
+            return self._snapshot
+
+    async def _collect(self) -> StatsSnapshot:
+        now = time.time()
+        now_ts = int(now)
+        counters = await self.stats_repo.counters()
+        active = await self.stats_repo.count_active_subscriptions(now_ts)
+        today = await self.stats_repo.rollup_totals("day", (now_ts // 86400) * 86400)
+        last_day = await self.stats_repo.rollup_totals("hour", (now_ts // 3600 - 23) * 3600)
+        return StatsSnapshot(
+            total_users=int(counters.get("users", 0)),
+            active_subscriptions=active,
+            paid_count=int(counters.get("paid_count", 0)),
+            paid_total=float(counters.get("paid_amount", 0.0)),
+            signups_today=int(today.get("signups", 0)),
+            revenue_today=float(today.get("revenue", 0.0)),
+            signups_24h=int(last_day.get("signups", 0)),
+            revenue_24h=float(last_day.get("revenue", 0.0)),
+            taken_at=now,
+        )
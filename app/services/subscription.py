@@ -1,12 +1,13 @@
 from __future__ import annotations
 
 from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from datetime import datetime, timedelta
 import asyncio
 import logging
 import math
 from urllib.parse import urljoin, urlparse
-from typing import Optional
+from typing import Callable, Optional
 
 import aiohttp
 
@@ -15,7 +16,10 @@ from app.models.tariff import DEFAULT_TRAFFIC_LIMIT_GB, Tariff
 from app.models.user import User
 from app.repositories.payment_repository import PaymentRepository
 from app.repositories.user_repository import UserRepository
-from app.services.marzban import MarzbanService
+from app.services.locks import KeyedLock, LockBackend, LockLostError
+from app.services.marzban_cluster import MarzbanCluster
+from app.services.resilience import CircuitOpenError
+from app.utils.cache import TTLCache
 
 
 class SubscriptionService:
@@ -27,20 +31,46 @@ class SubscriptionService:
         settings: Settings,
         user_repo: UserRepository,
         payment_repo: PaymentRepository,
-        marzban: MarzbanService,
+        marzban: MarzbanCluster,
+        locks: LockBackend | None = None,
     ):
         self.settings = settings
         self.user_repo = user_repo
         self.payment_repo = payment_repo
         self.marzban = marzban
         self._logger = logging.getLogger(__name__)
-        self._locks: dict[int, asyncio.Lock] = {}
+        self._locks: LockBackend = locks if locks is not None else KeyedLock(stripes=settings.user_lock_stripes)
+        self._fencing_token: ContextVar[int | None] = ContextVar("subscription_fencing_token", default=None)
+        self.status_cache: TTLCache[str, dict[str, object]] = TTLCache(
+            maxsize=settings.status_cache_size,
+            ttl=settings.status_cache_ttl,
+            stale_ttl=settings.status_cache_stale_ttl,
+        )
+        self._refreshing: dict[str, asyncio.Task] = {}
+        # Bumped on every local write to a panel user; a fetch that started
+        # before the bump must not repopulate status_cache with the old user.
+        self._generations: dict[str, int] = {}
+        self._expiry_listeners: list[Callable[[int, datetime | None], None]] = []
+
+    def add_expiry_listener(self, listener: Callable[[int, datetime | None], None]) -> None:
+        """Call ``listener(telegram_id, expires_at)`` whenever a stored expiry changes."""
+        self._expiry_listeners.append(listener)
+
+    def _notify_expiry(self, telegram_id: int, expires_at: datetime | None) -> None:
+        for listener in self._expiry_listeners:
+            try:
+                listener(telegram_id, expires_at)
+            except Exception:
+                self._logger.exception("Expiry listener failed: telegram_id=%s", telegram_id)
 
     @asynccontextmanager
     async def _user_lock(self, telegram_id: int) -> object:
-        lock = self._locks.setdefault(telegram_id, asyncio.Lock())
-        async with lock:
-            yield
+        async with self._locks.hold(telegram_id) as token:
+            reset = self._fencing_token.set(token)
+            try:
+                yield
+            finally:
+                self._fencing_token.reset(reset)
 
     def get_tariff(self, code: str) -> Tariff:
         plan = TARIFFS[code]
@@ -58,69 +88,180 @@ class SubscriptionService:
         referral_bonus: timedelta | None = None,
         traffic_limit_gb: float | None = None,
     ) -> User:
-        existing = await self.user_repo.get_by_telegram_id(telegram_id)
-        trial_used_meta, referrer_meta, bonus_applied_meta = await self.user_repo.get_user_meta(telegram_id)
+        existing, meta = await self.user_repo.get_with_meta(telegram_id)
         bonus = referral_bonus or timedelta()
         now = datetime.utcnow()
         username = existing.marzban_username if existing else f"tg_{telegram_id}"
-        created = False
-        marzban_user: dict[str, object] | None = None
-
-        try:
-            marzban_user = await self.marzban.get_user(username)
-            self._logger.info(
-                "Marzban user found for provisioning: telegram_id=%s username=%s",
-                telegram_id,
-                username,
-            )
-        except aiohttp.ClientResponseError as exc:
-            if exc.status == 404:
-                marzban_user = None
-            elif exc.status == 500:
-                self._logger.warning(
-                    "Marzban get_user returned 500, retrying: telegram_id=%s username=%s",
+        # Rows from before clustering have no node: they live on the default one.
+        home_node = (existing.marzban_node or self.marzban.default_node) if existing else None
+        node = home_node if home_node and self.marzban.is_healthy(home_node) else self.marzban.pick_node()
+        marzban_calls = 0
+        tried: set[str] = set()
+        while True:
+            try:
+                marzban_user, target_expires_at, calls = await self._apply_on_node(
                     telegram_id,
                     username,
+                    node,
+                    existing,
+                    node == home_node,
+                    tariff,
+                    bonus,
+                    traffic_limit_gb,
+                    now,
+                )
+                marzban_calls += calls
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError) as exc:
+                if isinstance(exc, aiohttp.ClientResponseError) and exc.status < 500 and exc.status != 429:
+                    raise
+                self.marzban.report_failure(node, exc)
+                if node == home_node and self.marzban.is_healthy(node):
+                    # Moving means a new account and link on another node: only
+                    # for a drained node, not one failed call. The caller retries.
+                    raise
+                tried.add(node)
+                fallback = self.marzban.pick_node(exclude=tried)
+                if fallback is None or not self.marzban.is_healthy(fallback):
+                    raise
+                self._logger.warning(
+                    "Marzban node %s failed, provisioning on %s instead: telegram_id=%s error=%r",
+                    node,
+                    fallback,
+                    telegram_id,
+                    exc,
                 )
+                node = fallback
+        if home_node and node != home_node:
+            self._logger.warning(
+                "User moved to another Marzban node: telegram_id=%s from=%s to=%s",
+                telegram_id,
+                home_node,
+                node,
+            )
+            # The old account stays active until removed; the sync worker
+            # deletes it once the old node is reachable again.
+            await self.user_repo.record_node_move(username, home_node, node)
+
+        # A link issued by another node does not cover the new one.
+        existing_link = existing.subscription_link if existing and node == home_node else None
+        link = existing_link or await self._fetch_subscription_link(username, marzban_user)
+        marzban_uuid = ""
+        if marzban_user:
+            marzban_uuid = str(marzban_user.get("uuid") or "")
+        if not marzban_uuid:
+            marzban_uuid = existing.marzban_uuid if existing else username
+
+        user = User(
+            telegram_id=telegram_id,
+            marzban_username=username,
+            marzban_uuid=marzban_uuid or (existing.marzban_uuid if existing else ""),
+            subscription_expires_at=target_expires_at,
+            subscription_link=existing_link or link or (existing.subscription_link if existing else None),
+            traffic_limit_gb=existing.traffic_limit_gb if existing else (traffic_limit_gb or DEFAULT_TRAFFIC_LIMIT_GB),
+            trial_used=meta.trial_used,
+            referrer_telegram_id=meta.referrer_telegram_id,
+            referral_bonus_applied=meta.referral_bonus_applied,
+            used_traffic_bytes=existing.used_traffic_bytes if existing else None,
+            synced_at=datetime.utcnow(),
+            marzban_node=node,
+        )
+        written = await self.user_repo.upsert_user(user, fencing_token=self._fencing_token.get())
+        self._invalidate_status(username)
+        if not written:
+            raise LockLostError(f"user lock for telegram_id={telegram_id} was taken over")
+        self._notify_expiry(telegram_id, target_expires_at)
+        if marzban_user:
+            self.status_cache.set(username, marzban_user)
+        self._logger.info(
+            "Provisioned: telegram_id=%s username=%s marzban_calls=%s",
+            telegram_id,
+            username,
+            marzban_calls,
+        )
+        return user
+
+    async def _apply_on_node(
+        self,
+        telegram_id: int,
+        username: str,
+        node: str,
+        existing: User | None,
+        home: bool,
+        tariff: Tariff,
+        bonus: timedelta,
+        traffic_limit_gb: float | None,
+        now: datetime,
+    ) -> tuple[dict[str, object] | None, datetime, int]:
+        """Extend or create the panel user on ``node``.
+
+        ``home`` is False when the user is being moved off their own node:
+        the user is then created on ``node`` carrying over the local expiry.
+        Returns the panel's view of the user, the new expiry and the number
+        of calls.
+        """
+        marzban_calls = 0
+        # A fresh cached response is as good as asking the panel: fetches
+        # that started before our last write never make it into the cache.
+        # That only holds while this process is the sole writer; with a
+        # shared lease another replica may have renewed the user since, so
+        # the panel is asked under the lease instead. Unknown users are
+        # created straight away (a conflict means they exist after all). A
+        # local row is not trusted for the base expiry: the sync may have
+        # written an older view of the panel into it.
+        use_cache = home and not self._locks.cross_process
+        cached = self.status_cache.get(username) if use_cache else None
+        marzban_user: dict[str, object] | None = None
+        exists_on_panel = False
+        if cached is not None and not cached[1]:
+            marzban_user = cached[0]
+            exists_on_panel = True
+        elif existing is None or not home:
+            exists_on_panel = False
+        else:
+            marzban_calls += 1
+            marzban_user = await self._fetch_marzban_user(telegram_id, username, node)
+            exists_on_panel = marzban_user is not None
+
+        current_expires_at = self._current_expiry(marzban_user, existing, now)
+        target_expires_at = max(current_expires_at, now) + tariff.duration + bonus
+
+        if exists_on_panel:
+            add_days = self._calculate_add_days(current_expires_at, target_expires_at)
+            if add_days > 0:
                 try:
-                    marzban_user = await self.marzban.get_user(username)
-                except aiohttp.ClientResponseError as retry_exc:
-                    if retry_exc.status == 404:
-                        marzban_user = None
-                    elif retry_exc.status == 500:
-                        self._logger.error(
-                            "Marzban get_user repeated 500, aborting provisioning: telegram_id=%s username=%s",
-                            telegram_id,
-                            username,
-                        )
-                        raise
-                    else:
+                    marzban_calls += 1
+                    updated = await self.marzban.update_user_expire(username, target_expires_at, node=node)
+                    marzban_user = updated or marzban_user
+                    self._logger.info(
+                        "Marzban user renewed: telegram_id=%s username=%s add_days=%s new_expire=%s",
+                        telegram_id,
+                        username,
+                        add_days,
+                        target_expires_at.isoformat(),
+                    )
+                except aiohttp.ClientResponseError as exc:
+                    if exc.status != 404:
                         self._logger.exception(
-                            "Marzban get_user failed after retry: telegram_id=%s username=%s status=%s",
+                            "Marzban update_user failed: telegram_id=%s username=%s status=%s",
                             telegram_id,
                             username,
-                            retry_exc.status,
+                            exc.status,
                         )
                         raise
+                    # The local row outlived the panel user: fall through to create.
+                    exists_on_panel = False
+                    marzban_user = None
             else:
-                self._logger.exception(
-                    "Marzban get_user failed: telegram_id=%s username=%s status=%s",
+                self._logger.info(
+                    "Marzban renewal skipped (no additional days): telegram_id=%s username=%s",
                     telegram_id,
                     username,
-                    exc.status,
                 )
-                raise
 
-        current_expires_at = (
-            self._extract_expire(marzban_user) if marzban_user else None
-        ) or (existing.subscription_expires_at if existing else None)
-        if not current_expires_at:
-            current_expires_at = now
-        effective_base = max(current_expires_at, now)
-        target_expires_at = effective_base + tariff.duration + bonus
-
-        if marzban_user is None:
+        if not exists_on_panel:
             try:
+                marzban_calls += 1
                 marzban_user = await self.marzban.create_user(
                     username,
                     target_expires_at,
@@ -128,22 +269,16 @@ class SubscriptionService:
                     proxy=self.settings.marzban_proxy or None,
                     flow=self.settings.marzban_flow or None,
                     inbounds=self.settings.marzban_inbounds or None,
+                    node=node,
                 )
-                created = True
                 self._logger.info(
-                    "Marzban user created: telegram_id=%s username=%s",
+                    "Marzban user created: telegram_id=%s username=%s node=%s",
                     telegram_id,
                     username,
+                    node,
                 )
             except aiohttp.ClientResponseError as exc:
-                if exc.status in {409, 422}:
-                    self._logger.warning(
-                        "Marzban user already exists on create, syncing: telegram_id=%s username=%s",
-                        telegram_id,
-                        username,
-                    )
-                    marzban_user = await self.marzban.get_user(username)
-                else:
+                if exc.status not in {409, 422}:
                     self._logger.exception(
                         "Marzban create_user failed: telegram_id=%s username=%s status=%s",
                         telegram_id,
@@ -151,66 +286,72 @@ class SubscriptionService:
                         exc.status,
                     )
                     raise
-
-        if not created:
-            add_days = self._calculate_add_days(current_expires_at, target_expires_at)
-            if add_days > 0:
-                await self.marzban.update_user_expire(username, target_expires_at)
-                self._logger.info(
-                    "Marzban user renewed: telegram_id=%s username=%s add_days=%s new_expire=%s",
+                self._logger.warning(
+                    "Marzban user already exists on create, syncing: telegram_id=%s username=%s",
                     telegram_id,
                     username,
-                    add_days,
-                    target_expires_at.isoformat(),
                 )
-            else:
-                self._logger.info(
-                    "Marzban renewal skipped (no additional days): telegram_id=%s username=%s",
-                    telegram_id,
-                    username,
+                marzban_calls += 2
+                marzban_user = await self.marzban.get_user(username, node=node)
+                current_expires_at = self._current_expiry(marzban_user, existing, now)
+                target_expires_at = max(current_expires_at, now) + tariff.duration + bonus
+                marzban_user = (
+                    await self.marzban.update_user_expire(username, target_expires_at, node=node) or marzban_user
                 )
 
-        existing_link = existing.subscription_link if existing else None
-        link = existing_link or await self._fetch_subscription_link(username, marzban_user)
-        if existing_link:
-            self._logger.info(
-                "Using existing subscription link for user: telegram_id=%s username=%s",
+        return marzban_user, target_expires_at, marzban_calls
+
+    async def _fetch_marzban_user(
+        self, telegram_id: int, username: str, node: str | None
+    ) -> dict[str, object] | None:
+        """Fetch the panel user, or ``None`` if it does not exist.
+
+        Transient failures are already retried by ``MarzbanService``.
+        """
+        try:
+            return await self.marzban.get_user(username, node=node)
+        except aiohttp.ClientResponseError as exc:
+            if exc.status == 404:
+                return None
+            self._logger.error(
+                "Marzban get_user failed, aborting provisioning: telegram_id=%s username=%s status=%s",
                 telegram_id,
                 username,
+                exc.status,
             )
-        marzban_uuid = ""
-        if marzban_user:
-            marzban_uuid = str(marzban_user.get("uuid") or "")
-        if not marzban_uuid:
-            marzban_uuid = existing.marzban_uuid if existing else username
+            raise
 
-        user = User(
-            telegram_id=telegram_id,
-            marzban_username=username,
-            marzban_uuid=marzban_uuid or (existing.marzban_uuid if existing else ""),
-            subscription_expires_at=target_expires_at,
-            subscription_link=existing_link or link or (existing.subscription_link if existing else None),
-            traffic_limit_gb=existing.traffic_limit_gb if existing else (traffic_limit_gb or DEFAULT_TRAFFIC_LIMIT_GB),
-            trial_used=existing.trial_used if existing else trial_used_meta,
-            referrer_telegram_id=existing.referrer_telegram_id if existing else referrer_meta,
-            referral_bonus_applied=existing.referral_bonus_applied if existing else bonus_applied_meta,
+    def _current_expiry(
+        self,
+        marzban_user: dict[str, object] | None,
+        existing: User | None,
+        now: datetime,
+    ) -> datetime:
+        return (
+            self._extract_expire(marzban_user)
+            or (existing.subscription_expires_at if existing else None)
+            or now
         )
-        await self.user_repo.upsert_user(user)
-        return user
 
     async def process_payment_success(self, invoice_id: str) -> Optional[User]:
         payment_row = await self.payment_repo.get_payment(invoice_id)
         if not payment_row:
             return None
         invoice_id, telegram_id, tariff_code, amount, currency, status = payment_row
-        marked = await self.payment_repo.complete_or_skip(invoice_id)
-        if not marked:
-            return await self.user_repo.get_by_telegram_id(telegram_id)
         tariff = self.get_tariff(tariff_code)
         async with self._user_lock(telegram_id):
+            # Checked under the lock so a retried delivery of the same invoice
+            # is a no-op. The invoice is completed only after provisioning, so
+            # a crash in between leads to a retry rather than a lost payment.
+            if await self.payment_repo.was_processed(invoice_id):
+                return await self.user_repo.get_by_telegram_id(telegram_id)
             user = await self.provision_user(telegram_id, tariff)
+            marked = await self.payment_repo.complete_or_skip(invoice_id)
+        # Outside the invitee's lock: the bonus takes the referrer's lock, and
+        # holding two user locks at once could deadlock with striped locks.
+        if marked:
             await self._apply_referral_bonus(telegram_id)
-            return user
+        return user
 
     async def provision_trial(self, telegram_id: int) -> User:
         tariff = Tariff(
@@ -231,8 +372,10 @@ class SubscriptionService:
         if not user:
             return None
         username = user.marzban_username or f"tg_{telegram_id}"
+        if self._is_recently_synced(user):
+            return user
         try:
-            marzban_user = await self.marzban.get_user(username)
+            marzban_user = await self._cached_marzban_user(username, user.marzban_node)
             expires_at = self._extract_expire(marzban_user) or user.subscription_expires_at
             link = user.subscription_link or await self._fetch_subscription_link(username, marzban_user)
             if (expires_at != user.subscription_expires_at) or (
@@ -243,6 +386,8 @@ class SubscriptionService:
                     expires_at or user.subscription_expires_at,
                     link or user.subscription_link,
                 )
+                if expires_at != user.subscription_expires_at:
+                    self._notify_expiry(telegram_id, expires_at)
             return User(
                 telegram_id=user.telegram_id,
                 marzban_username=username,
@@ -254,13 +399,16 @@ class SubscriptionService:
                 trial_used=user.trial_used,
                 referrer_telegram_id=user.referrer_telegram_id,
                 referral_bonus_applied=user.referral_bonus_applied,
+                used_traffic_bytes=self._extract_used_traffic(marzban_user),
+                synced_at=user.synced_at,
+                marzban_node=user.marzban_node,
             )
-        except aiohttp.ClientResponseError as exc:
+        except (aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError) as exc:
             self._logger.warning(
-                "Marzban status sync failed, returning local data: telegram_id=%s username=%s status=%s",
+                "Marzban status sync failed, returning local data: telegram_id=%s username=%s error=%r",
                 telegram_id,
                 username,
-                exc.status,
+                exc,
             )
             return User(
                 telegram_id=user.telegram_id,
@@ -273,8 +421,66 @@ class SubscriptionService:
                 trial_used=user.trial_used,
                 referrer_telegram_id=user.referrer_telegram_id,
                 referral_bonus_applied=user.referral_bonus_applied,
+                used_traffic_bytes=user.used_traffic_bytes,
+                synced_at=user.synced_at,
+                marzban_node=user.marzban_node,
             )
 
+    async def _cached_marzban_user(self, username: str, node: str | None) -> dict[str, object]:
+        cached = self.status_cache.get(username)
+        if cached is None:
+            generation = self._generations.get(username, 0)
+            marzban_user = await self.marzban.get_user(username, node=node)
+            self._cache_fetched(username, generation, marzban_user)
+            return marzban_user
+        marzban_user, stale = cached
+        if stale and username not in self._refreshing:
+            task = asyncio.create_task(self._refresh_marzban_user(username, node))
+            self._refreshing[username] = task
+            task.add_done_callback(lambda _: self._refreshing.pop(username, None))
+        return marzban_user
+
+    def _cache_fetched(self, username: str, generation: int, marzban_user: dict[str, object]) -> None:
+        if self._generations.get(username, 0) == generation:
+            self.status_cache.set(username, marzban_user)
+
+    def _invalidate_status(self, username: str) -> None:
+        # A fetch started before provisioning could write back the old expiry.
+        self._generations[username] = self._generations.get(username, 0) + 1
+        refresh = self._refreshing.pop(username, None)
+        if refresh is not None:
+            refresh.cancel()
+        self.status_cache.invalidate(username)
+
+    async def _refresh_marzban_user(self, username: str, node: str | None) -> None:
+        generation = self._generations.get(username, 0)
+        try:
+            self._cache_fetched(username, generation, await self.marzban.get_user(username, node=node))
+        except Exception:
+            self._logger.warning("Background Marzban refresh failed: username=%s", username, exc_info=True)
+
+    def _is_recently_synced(self, user: User) -> bool:
+        if not user.synced_at or self.settings.marzban_sync_max_staleness <= 0:
+            return False
+        age = (datetime.utcnow() - user.synced_at).total_seconds()
+        return age <= self.settings.marzban_sync_max_staleness
+
+    def marzban_snapshot(
+        self, marzban_user: dict[str, object]
+    ) -> tuple[datetime | None, str | None, int | None]:
+        """Expiry, subscription link and used traffic as reported by Marzban."""
+        raw_link = str(marzban_user.get("subscription_url") or marzban_user.get("subscription_link") or "")
+        link = self._ensure_absolute_link(raw_link) or None
+        return self._extract_expire(marzban_user), link, self._extract_used_traffic(marzban_user)
+
+    def _extract_used_traffic(self, marzban_user: dict[str, object] | None) -> int | None:
+        if not marzban_user:
+            return None
+        used = marzban_user.get("used_traffic")
+        if isinstance(used, (int, float)):
+            return int(used)
+        return None
+
     def _extract_expire(self, marzban_user: dict[str, object] | None) -> datetime | None:
         if not marzban_user:
             return None
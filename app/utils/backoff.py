@@ -0,0 +1,9 @@
+from __future__ import annotations
+
+import random
+
+
+def backoff_delay(attempt: int, base: float, maximum: float) -> float:
+    """Exponential delay for the given 1-based attempt with "equal jitter"."""
+    delay = min(maximum, base * 2 ** max(attempt - 1, 0))
+    return delay / 2 + random.random() * delay / 2
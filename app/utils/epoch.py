@@ -0,0 +1,20 @@
+from __future__ import annotations
+
+from datetime import datetime, timezone
+
+# SQL expression for "now" in the same unit as the epoch columns.
+SQL_EPOCH_NOW = "CAST(strftime('%s', 'now') AS INTEGER)"
+
+
+def to_epoch(value: datetime | None) -> int | None:
+    """Naive UTC datetime -> integer epoch seconds."""
+    if value is None:
+        return None
+    return int(value.replace(tzinfo=timezone.utc).timestamp())
+
+
+def from_epoch(value: int | None) -> datetime | None:
+    """Integer epoch seconds -> naive UTC datetime."""
+    if value is None:
+        return None
+    return datetime.utcfromtimestamp(value)
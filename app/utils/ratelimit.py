@@ -0,0 +1,74 @@
+from __future__ import annotations
+
+import asyncio
+from collections import OrderedDict
+import time
+from typing import Hashable
+
+
+class RateLimiter:
+    """Token bucket shared by concurrent senders; ``acquire`` waits for a slot."""
+
+    def __init__(self, rate: float, burst: int | None = None):
+        self._rate = rate
+        self._capacity = float(burst or max(1, int(rate)))
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        """Stop handing out slots for ``seconds`` (e.g. after a flood-wait)."""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+
+
+class KeyedRateLimiter:
+    """Non-blocking per-key token bucket (GCRA).
+
+    Each key costs one float: the time its bucket will be full again. Keys
+    whose bucket has refilled carry no state and are dropped, so memory
+    tracks recently active keys only; ``maxsize`` caps the worst case.
+    """
+
+    def __init__(self, rate: float, burst: int = 1, maxsize: int = 100_000):
+        self._interval = 1.0 / rate
+        self._tolerance = self._interval * max(1, burst)
+        self.maxsize = maxsize
+        # Ordered by last update; refills are roughly FIFO so expiry sweeps the head.
+        self._full_at: OrderedDict[Hashable, float] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._full_at)
+
+    def allow(self, key: Hashable) -> bool:
+        now = time.monotonic()
+        self._expire(now)
+        full_at = max(self._full_at.get(key, now), now) + self._interval
+        if full_at - now > self._tolerance:
+            return False
+        self._full_at[key] = full_at
+        self._full_at.move_to_end(key)
+        if len(self._full_at) > self.maxsize:
+            self._full_at.popitem(last=False)
+        return True
+
+    def _expire(self, now: float) -> None:
+        while self._full_at:
+            key, full_at = next(iter(self._full_at.items()))
+            if full_at > now:
+                return
+            del self._full_at[key]
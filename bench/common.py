@@ -0,0 +1,20 @@
+"""Helpers shared by the benchmark scripts."""
+
+from __future__ import annotations
+
+import statistics
+
+
+def summarize(samples: list[float]) -> str:
+    """``p50/p95/p99/max`` of latencies given in seconds, rendered in milliseconds."""
+    if not samples:
+        return "no samples"
+    ordered = sorted(samples)
+
+    def pick(q: float) -> float:
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+
+    return (
+        f"mean={statistics.fmean(ordered) * 1000:.2f}ms p50={pick(0.50):.2f}ms "
+        f"p95={pick(0.95):.2f}ms p99={pick(0.99):.2f}ms max={ordered[-1] * 1000:.2f}ms"
+    )
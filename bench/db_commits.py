@@ -0,0 +1,108 @@
+"""Commits per operation: statement-per-commit repository vs ``db.transaction()``.
+
+Runs the trial and referral flag updates against a file database, once with
+the old repository code (every statement committed on its own) and once with
+the current ``UserRepository``. Commits are counted with a SQLite trace
+callback on the writer connection; each one is a journal fsync.
+
+    python -m bench.db_commits --users 500
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from app.db import Database
+from app.repositories.user_repository import UserRepository
+
+
+class LegacyUserRepository(UserRepository):
+    """The flag updates as they were before the unit-of-work API."""
+
+    async def _register(self, telegram_id: int) -> None:
+        await self._db.execute(
+            "INSERT INTO telegram_users (telegram_id) VALUES (?) ON CONFLICT(telegram_id) DO NOTHING",
+            telegram_id,
+        )
+
+    async def _mark(self, column: str, telegram_id: int) -> bool:
+        await self._register(telegram_id)
+        rowcount = await self._db.execute_with_rowcount(
+            f"UPDATE users SET {column} = 1 WHERE telegram_id = ? AND {column} = 0", telegram_id
+        )
+        if rowcount == 0:
+            rowcount = await self._db.execute_with_rowcount(
+                f"UPDATE telegram_users SET {column} = 1 WHERE telegram_id = ? AND {column} = 0", telegram_id
+            )
+        await self._db.execute(f"UPDATE users SET {column} = 1 WHERE telegram_id = ?", telegram_id)
+        await self._db.execute(f"UPDATE telegram_users SET {column} = 1 WHERE telegram_id = ?", telegram_id)
+        return rowcount == 1
+
+    async def try_mark_trial_used(self, telegram_id: int) -> bool:
+        return await self._mark("trial_used", telegram_id)
+
+    async def try_mark_referral_bonus_applied(self, invitee_id: int) -> bool:
+        return await self._mark("referral_bonus_applied", invitee_id)
+
+    async def set_referrer(self, invitee_id: int, referrer_id: int) -> bool:
+        await self._register(invitee_id)
+        row = await self._db.fetchone(
+            "SELECT referrer_telegram_id FROM telegram_users WHERE telegram_id = ?", invitee_id
+        )
+        if row and row[0] is not None:
+            return False
+        await self._db.execute(
+            "UPDATE telegram_users SET referrer_telegram_id = ? WHERE telegram_id = ?", referrer_id, invitee_id
+        )
+        await self._db.execute(
+            "UPDATE users SET referrer_telegram_id = ? WHERE telegram_id = ?", referrer_id, invitee_id
+        )
+        return True
+
+
+async def _measure(repo_cls: type[UserRepository], path: str, users: int) -> None:
+    db = Database(path)
+    await db.connect()
+    commits = 0
+
+    def trace(statement: str) -> None:
+        nonlocal commits
+        if statement.lstrip().upper().startswith("COMMIT"):
+            commits += 1
+
+    assert db._conn is not None
+    await db._conn.set_trace_callback(trace)
+    repo = repo_cls(db)
+    for name, operation in (
+        ("set_referrer", lambda user: repo.set_referrer(user, 1)),
+        ("try_mark_trial_used", repo.try_mark_trial_used),
+        ("try_mark_referral_bonus_applied", repo.try_mark_referral_bonus_applied),
+    ):
+        commits = 0
+        started = time.perf_counter()
+        for user in range(2, users + 2):
+            await operation(user)
+        elapsed = time.perf_counter() - started
+        print(
+            f"  {name:<32} {commits / users:4.1f} commits/op  "
+            f"{elapsed / users * 1000:7.3f} ms/op"
+        )
+    await db.close()
+
+
+async def main(users: int) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        for label, repo_cls in (("commit per statement", LegacyUserRepository), ("db.transaction()", UserRepository)):
+            print(f"{label}:")
+            await _measure(repo_cls, os.path.join(directory, f"{repo_cls.__name__}.sqlite3"), users)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=500)
+    args = parser.parse_args()
+    asyncio.run(main(args.users))
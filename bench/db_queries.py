@@ -0,0 +1,106 @@
+"""Statements per repository operation, counted with ``Database.statements``.
+
+Compares the old two-lookup load of a user and its account meta with
+``UserRepository.get_with_meta``, and the old register-then-update flag
+writes with the current upserts. The last section times ``get_with_meta``
+with and without the prepared statement cache.
+
+    python -m bench.db_queries --users 2000
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+from datetime import datetime, timedelta
+import os
+import tempfile
+import time
+from typing import Awaitable, Callable
+
+from app.db import Database
+from app.models.user import User
+from app.repositories.user_repository import UserRepository
+from bench.db_commits import LegacyUserRepository
+
+SELECT_META = """
+    SELECT trial_used, referrer_telegram_id, referral_bonus_applied
+    FROM telegram_users WHERE telegram_id = ?
+"""
+
+
+async def _seed(db: Database, users: int) -> None:
+    repo = UserRepository(db)
+    expires_at = datetime.utcnow() + timedelta(days=30)
+    async with db.transaction():
+        for telegram_id in range(1, users + 1):
+            await repo.upsert_user(
+                User(
+                    telegram_id=telegram_id,
+                    marzban_username=f"tg_{telegram_id}",
+                    marzban_uuid=f"uuid-{telegram_id}",
+                    subscription_expires_at=expires_at,
+                    subscription_link=f"https://panel/sub/tg_{telegram_id}",
+                    traffic_limit_gb=50.0,
+                )
+            )
+            await repo.register_telegram_user(telegram_id)
+
+
+async def _per_op(db: Database, users: int, operation: Callable[[int], Awaitable[object]]) -> tuple[float, float]:
+    before = db.statements
+    started = time.perf_counter()
+    for telegram_id in range(1, users + 1):
+        await operation(telegram_id)
+    elapsed = time.perf_counter() - started
+    return (db.statements - before) / users, elapsed / users * 1000
+
+
+async def main(users: int) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.sqlite3")
+        db = Database(path, readers=4)
+        await db.connect()
+        await _seed(db, users)
+        repo = UserRepository(db)
+        legacy = LegacyUserRepository(db)
+
+        async def load_two_queries(telegram_id: int) -> None:
+            await repo.get_by_telegram_id(telegram_id)
+            await db.fetchone(SELECT_META, telegram_id)
+
+        print(f"{users} users, statements per operation:")
+        for label, operation in (
+            ("load user + meta, two lookups", load_two_queries),
+            ("load user + meta, get_with_meta", repo.get_with_meta),
+            ("try_mark_trial_used, old", legacy.try_mark_trial_used),
+            ("try_mark_referral_bonus_applied, old", legacy.try_mark_referral_bonus_applied),
+        ):
+            statements, ms = await _per_op(db, users, operation)
+            print(f"  {label:<40} {statements:4.1f} statements  {ms:6.3f} ms/op")
+        # Flip the flags back so the current methods do the same work.
+        await db.execute("UPDATE telegram_users SET trial_used = 0, referral_bonus_applied = 0")
+        await db.execute("UPDATE users SET trial_used = 0, referral_bonus_applied = 0")
+        for label, operation in (
+            ("try_mark_trial_used, upsert", repo.try_mark_trial_used),
+            ("try_mark_referral_bonus_applied, upsert", repo.try_mark_referral_bonus_applied),
+        ):
+            statements, ms = await _per_op(db, users, operation)
+            print(f"  {label:<40} {statements:4.1f} statements  {ms:6.3f} ms/op")
+        await db.close()
+
+        print("get_with_meta by prepared statement cache size:")
+        for cache_size in (0, 256):
+            db = Database(path, readers=4, statement_cache_size=cache_size)
+            await db.connect()
+            repo = UserRepository(db)
+            _, ms = await _per_op(db, users, repo.get_with_meta)
+            print(f"  cached_statements={cache_size:<4} {ms:6.3f} ms/op")
+            await db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=2000)
+    args = parser.parse_args()
+    asyncio.run(main(args.users))
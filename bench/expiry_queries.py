@@ -0,0 +1,213 @@
+"""Stats, pending-invoice and expiry lookups on a large database.
+
+Builds two databases with ``--users`` users and as many payments: one with
+the current schema (epoch integers, expiry/payment indexes and the stats
+triggers), one with the old layout (ISO text timestamps, no indexes). Prints
+the query plan and the median latency of each lookup on both.
+
+    python -m bench.expiry_queries --users 1000000
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+from datetime import datetime
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import time
+from typing import Callable
+
+from app.db import Database
+from app.repositories.payment_repository import PaymentRepository
+from app.repositories.reminder_repository import LIST_EXPIRING, ReminderRepository
+from app.repositories.stats_repository import EXPIRING_BEFORE, FUTURE_EXPIRY_BUCKETS, StatsRepository
+
+DAY = 86400
+WINDOW = 6 * 3600
+
+LEGACY_SCHEMA = """
+    CREATE TABLE users (
+        telegram_id INTEGER PRIMARY KEY,
+        marzban_username TEXT NOT NULL UNIQUE,
+        marzban_uuid TEXT NOT NULL UNIQUE,
+        subscription_expires_at TEXT,
+        subscription_link TEXT,
+        traffic_limit_gb REAL,
+        trial_used INTEGER DEFAULT 0,
+        referrer_telegram_id INTEGER,
+        referral_bonus_applied INTEGER DEFAULT 0,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE payments (
+        invoice_id TEXT PRIMARY KEY,
+        telegram_id INTEGER NOT NULL,
+        tariff_code TEXT NOT NULL,
+        amount REAL NOT NULL,
+        currency TEXT NOT NULL,
+        status TEXT NOT NULL,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(invoice_id, status)
+    );
+    CREATE INDEX idx_payments_user ON payments(telegram_id);
+"""
+LEGACY_ACTIVE = "SELECT COUNT(*) FROM users WHERE subscription_expires_at IS NOT NULL AND subscription_expires_at > ?"
+LEGACY_PENDING = "SELECT invoice_id FROM payments WHERE status = 'paid_pending' ORDER BY updated_at ASC"
+LEGACY_EXPIRING = """
+    SELECT telegram_id, subscription_expires_at FROM users
+    WHERE subscription_expires_at >= ? AND subscription_expires_at < ?
+"""
+CURRENT_PENDING = """
+    SELECT invoice_id FROM payments
+    WHERE status = 'paid_pending'
+      AND invoice_id NOT IN (
+          SELECT invoice_id FROM provisioning_jobs WHERE status IN ('queued', 'running')
+      )
+    ORDER BY updated_at ASC
+"""
+
+
+def _rows(users: int, now: int, seed: int) -> tuple[list[tuple], list[tuple]]:
+    rng = random.Random(seed)
+    user_rows = []
+    payment_rows = []
+    for telegram_id in range(1, users + 1):
+        expires = now + rng.randint(-180 * DAY, 365 * DAY)
+        paid_at = now - rng.randint(0, 365 * DAY)
+        status = "paid_pending" if rng.random() < 0.0005 else "paid"
+        user_rows.append((telegram_id, f"tg_{telegram_id}", f"uuid-{telegram_id}", expires))
+        payment_rows.append((f"inv-{telegram_id}", telegram_id, "m1", 1.0, "XTR", status, paid_at, paid_at))
+    return user_rows, payment_rows
+
+
+def _iso(ts: int) -> str:
+    return datetime.utcfromtimestamp(ts).isoformat()
+
+
+def _build_legacy(path: str, user_rows: list[tuple], payment_rows: list[tuple]) -> None:
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    with conn:
+        conn.executemany(
+            "INSERT INTO users (telegram_id, marzban_username, marzban_uuid, subscription_expires_at) VALUES (?, ?, ?, ?)",
+            ((row[0], row[1], row[2], _iso(row[3])) for row in user_rows),
+        )
+        conn.executemany(
+            "INSERT INTO payments VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (row[:6] + (_iso(row[6]), _iso(row[7])) for row in payment_rows),
+        )
+    conn.close()
+
+
+async def _build_current(path: str, user_rows: list[tuple], payment_rows: list[tuple]) -> None:
+    db = Database(path)
+    await db.connect()
+    await db.close()
+    # Bulk load outside aiosqlite; the stats triggers still fire per row.
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany("INSERT INTO telegram_users (telegram_id) VALUES (?)", ((row[0],) for row in user_rows))
+        conn.executemany(
+            "INSERT INTO users (telegram_id, marzban_username, marzban_uuid, subscription_expires_at) VALUES (?, ?, ?, ?)",
+            user_rows,
+        )
+        conn.executemany("INSERT INTO payments VALUES (?, ?, ?, ?, ?, ?, ?, ?)", payment_rows)
+    conn.execute("ANALYZE")
+    conn.close()
+
+
+def _plan(conn: sqlite3.Connection, query: str, *args: object) -> str:
+    rows = conn.execute(f"EXPLAIN QUERY PLAN {query}", args).fetchall()
+    return "; ".join(row[-1] for row in rows)
+
+
+async def _median(operation: Callable[[], object], repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = operation()
+        if asyncio.iscoroutine(result):
+            await result
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples) * 1000
+
+
+async def main(users: int, repeat: int, keep: str | None) -> None:
+    now = int(time.time())
+    directory = keep or tempfile.mkdtemp()
+    os.makedirs(directory, exist_ok=True)
+    legacy_path = os.path.join(directory, "legacy.sqlite3")
+    current_path = os.path.join(directory, "current.sqlite3")
+    if not (os.path.exists(legacy_path) and os.path.exists(current_path)):
+        started = time.perf_counter()
+        user_rows, payment_rows = _rows(users, now, seed=1)
+        _build_legacy(legacy_path, user_rows, payment_rows)
+        await _build_current(current_path, user_rows, payment_rows)
+        del user_rows, payment_rows
+        print(f"built {users:,}-user databases in {time.perf_counter() - started:.0f}s under {directory}")
+    else:
+        print(f"reusing databases under {directory}")
+
+    legacy = sqlite3.connect(legacy_path)
+    now_iso, window_iso = _iso(now), _iso(now + WINDOW)
+    db = Database(current_path, readers=1)
+    await db.connect()
+    stats, payments, reminders = StatsRepository(db), PaymentRepository(db), ReminderRepository(db)
+    plans = sqlite3.connect(current_path)
+    next_hour = (now // 3600 + 1) * 3600
+
+    def legacy_expiring() -> list[tuple[int, datetime]]:
+        rows = legacy.execute(LEGACY_EXPIRING, (now_iso, window_iso)).fetchall()
+        return [(row[0], datetime.fromisoformat(row[1])) for row in rows]
+
+    lookups = [
+        (
+            "active subscriptions",
+            [("old", _plan(legacy, LEGACY_ACTIVE, now_iso))],
+            [
+                ("new", _plan(plans, FUTURE_EXPIRY_BUCKETS, next_hour)),
+                ("new", _plan(plans, EXPIRING_BEFORE, now, next_hour)),
+            ],
+            lambda: legacy.execute(LEGACY_ACTIVE, (now_iso,)).fetchone(),
+            lambda: stats.count_active_subscriptions(now),
+        ),
+        (
+            "pending invoices",
+            [("old", _plan(legacy, LEGACY_PENDING))],
+            [("new", _plan(plans, CURRENT_PENDING))],
+            lambda: legacy.execute(LEGACY_PENDING).fetchall(),
+            payments.list_pending_invoices,
+        ),
+        (
+            "expiring in 6h",
+            [("old", _plan(legacy, LEGACY_EXPIRING, now_iso, window_iso))],
+            [("new", _plan(plans, LIST_EXPIRING, now, now + WINDOW))],
+            legacy_expiring,
+            lambda: reminders.list_expiring(now, now + WINDOW),
+        ),
+    ]
+    for name, old_plans, new_plans, old_op, new_op in lookups:
+        old_ms = await _median(old_op, repeat)
+        new_ms = await _median(new_op, repeat)
+        print(f"{name}: old {old_ms:.2f}ms -> new {new_ms:.2f}ms")
+        for label, plan in old_plans + new_plans:
+            print(f"  {label}: {plan}")
+    await db.close()
+    legacy.close()
+    plans.close()
+    if keep is None:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--keep", metavar="DIR", help="build (or reuse) the databases in DIR instead of a temp dir")
+    args = parser.parse_args()
+    asyncio.run(main(args.users, args.repeat, args.keep))
@@ -0,0 +1,80 @@
+"""Memory of the per-user lock registry after many distinct users.
+
+Takes the lock for ``--users`` distinct keys, ``--batch`` of them at a time,
+the way concurrent provisioning calls would, and samples traced memory as it
+goes. ``KeyedLock`` (plain and striped) should stay flat; the old
+``dict.setdefault(key, asyncio.Lock())`` registry grows with every key.
+
+    python -m bench.lock_memory --users 1000000
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+from contextlib import asynccontextmanager
+import time
+import tracemalloc
+from typing import AsyncIterator, Hashable
+
+from app.services.locks import KeyedLock
+
+
+class LegacyLocks:
+    """The registry SubscriptionService used to keep: one lock per key, forever."""
+
+    def __init__(self) -> None:
+        self._locks: dict[Hashable, asyncio.Lock] = {}
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def hold(self, key: Hashable) -> AsyncIterator[None]:
+        async with self._locks.setdefault(key, asyncio.Lock()):
+            yield None
+
+
+async def _stress(locks: KeyedLock | LegacyLocks, users: int, batch: int) -> None:
+    async def provision(key: int) -> None:
+        async with locks.hold(key):
+            await asyncio.sleep(0)
+
+    samples = []
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    step = max(users // 5, batch)
+    for offset in range(0, users, batch):
+        await asyncio.gather(*(provision(key) for key in range(offset, min(offset + batch, users))))
+        done = min(offset + batch, users)
+        if done % step == 0 or done == users:
+            samples.append(f"{done // 1000}k:{(tracemalloc.get_traced_memory()[0] - baseline) / 2**20:.1f}MiB")
+    elapsed = time.perf_counter() - started
+    peak = (tracemalloc.get_traced_memory()[1] - baseline) / 2**20
+    tracemalloc.stop()
+    print(f"    retained after N users: {' '.join(samples)}")
+    print(f"    peak={peak:.1f}MiB entries left={len(locks)} {users / elapsed:,.0f} users/s")
+
+
+async def main(users: int, batch: int, stripes: int, legacy: bool) -> None:
+    registries: list[tuple[str, KeyedLock | LegacyLocks]] = [
+        ("KeyedLock()", KeyedLock()),
+        (f"KeyedLock(stripes={stripes})", KeyedLock(stripes=stripes)),
+    ]
+    if legacy:
+        registries.append(("dict.setdefault (old)", LegacyLocks()))
+    print(f"{users:,} distinct users, {batch} concurrent:")
+    for label, locks in registries:
+        print(f"  {label}")
+        await _stress(locks, users, batch)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--stripes", type=int, default=1024)
+    parser.add_argument("--no-legacy", dest="legacy", action="store_false", help="skip the unbounded dict")
+    args = parser.parse_args()
+    asyncio.run(main(args.users, args.batch, args.stripes, args.legacy))
@@ -0,0 +1,89 @@
+"""Per-request latency of MarzbanService: pooled session vs a session per call.
+
+The baseline reproduces the old client, which opened a new ``ClientSession``
+(and so a new TCP connection) for every API call. Both clients talk to the
+in-process stub panel, so only connection setup differs; against a real
+HTTPS panel the gap grows by a TLS handshake per call.
+
+    python -m bench.marzban_session --requests 2000 --concurrency 50
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import time
+from typing import Any
+
+import aiohttp
+
+from app.services.marzban import MarzbanService
+from bench.common import summarize
+from bench.stub_marzban import StubMarzban
+
+
+class PerCallSessionMarzban(MarzbanService):
+    """The pre-pooling behaviour: every request builds and tears down its own session."""
+
+    async def _send_request(
+        self,
+        method: str,
+        path: str,
+        json: dict[str, Any] | None,
+        timeout: float,
+        allow_refresh: bool,
+    ) -> dict[str, Any]:
+        token = await self._get_token()
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        async with aiohttp.ClientSession(headers=headers) as session:
+            async with session.request(
+                method,
+                f"{self.base_url}{path}",
+                json=json,
+                timeout=aiohttp.ClientTimeout(total=timeout),
+            ) as resp:
+                resp.raise_for_status()
+                return await resp.json(content_type=None)
+
+
+async def _run(client: MarzbanService, requests: int, concurrency: int) -> tuple[list[float], float]:
+    latencies: list[float] = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(index: int) -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            await client.get_user(f"user{index % 100}")
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(index) for index in range(requests)))
+    return latencies, time.perf_counter() - started
+
+
+async def main(requests: int, concurrency: int, latency: float) -> None:
+    stub = StubMarzban(latency)
+    base_url = await stub.start()
+    for index in range(100):
+        stub.add_user(f"user{index}", int(time.time()) + 30 * 86400)
+    try:
+        for label, cls in (("session per call", PerCallSessionMarzban), ("pooled session", MarzbanService)):
+            client = cls(base_url, "admin:secret")
+            stub.reset()
+            latencies, elapsed = await _run(client, requests, concurrency)
+            await client.close()
+            print(
+                f"{label:>17}: {requests / elapsed:8.0f} req/s, {stub.connections:5d} TCP connections, "
+                f"{summarize(latencies)}"
+            )
+    finally:
+        await stub.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.0, help="stub server delay per request, seconds")
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.concurrency, args.latency))
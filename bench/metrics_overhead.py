@@ -0,0 +1,125 @@
+"""Overhead of the handler instrumentation and the ``/metrics`` render.
+
+Feeds a recorded message update through dispatchers without middleware,
+with a no-op middleware (aiogram's own cost) and with
+``InstrumentationMiddleware``, times the DB/Marzban observer hooks on their
+own, and renders a registry populated the way a busy bot would populate it.
+
+    python -m bench.metrics_overhead --updates 20000
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.types import Message, TelegramObject, Update
+
+from app.services.context import InstrumentationMiddleware
+from app.services.metrics import BotMetrics, UpdateScope, current_scope
+from bench.webhook_load import UPDATES
+
+
+def _message_update() -> dict:
+    for line in UPDATES.read_text(encoding="utf-8").splitlines():
+        update = json.loads(line)
+        if "message" in update:
+            return update
+    raise RuntimeError(f"no message update in {UPDATES}")
+
+
+async def _feed(updates: int, rounds: int) -> dict[str, float]:
+    """Median us/update per variant; variants alternate so drift hits them alike."""
+    bot = Bot("123456:bench-token")
+    update = Update.model_validate(_message_update(), context={"bot": bot})
+
+    async def on_message(message: Message) -> None:
+        return None
+
+    dispatchers = {}
+    for label, middleware in (
+        ("without middleware", None),
+        ("no-op middleware", _NoopMiddleware()),
+        ("InstrumentationMiddleware", InstrumentationMiddleware(BotMetrics())),
+    ):
+        dp = Dispatcher()
+        dp.message.register(on_message)
+        if middleware is not None:
+            dp.message.middleware(middleware)
+        dispatchers[label] = dp
+    samples: dict[str, list[float]] = {label: [] for label in dispatchers}
+    batch = max(updates // rounds, 1)
+    for round_index in range(rounds + 1):
+        for label, dp in dispatchers.items():
+            started = time.perf_counter()
+            for _ in range(batch):
+                await dp.feed_update(bot, update)
+            if round_index:  # the first round is warm-up
+                samples[label].append((time.perf_counter() - started) / batch * 1e6)
+    await bot.session.close()
+    return {label: statistics.median(values) for label, values in samples.items()}
+
+
+class _NoopMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        return await handler(event, data)
+
+
+def _hooks(calls: int) -> tuple[float, float]:
+    metrics = BotMetrics()
+    token = current_scope.set(UpdateScope())
+    started = time.perf_counter()
+    for _ in range(calls):
+        metrics.observe_db("read", 0.0004)
+    db_us = (time.perf_counter() - started) / calls * 1e6
+    started = time.perf_counter()
+    for _ in range(calls):
+        metrics.observe_marzban("default", "GET /api/user/{username}", "2xx", 0.012)
+    marzban_us = (time.perf_counter() - started) / calls * 1e6
+    current_scope.reset(token)
+    return db_us, marzban_us
+
+
+def _render(handlers: int, endpoints: int, repeat: int) -> tuple[float, int]:
+    metrics = BotMetrics()
+    scope = UpdateScope(db_statements=3, marzban_calls=1)
+    for index in range(handlers):
+        metrics.observe_handler(f"router{index % 8}.handler{index}", 0.02, scope, None)
+    for index in range(endpoints):
+        for status in ("2xx", "404", "500", "TimeoutError"):
+            metrics.observe_marzban(f"node{index % 3}", f"GET /api/endpoint{index}", status, 0.01)
+    metrics.observe_db("read", 0.001)
+    metrics.observe_db("write", 0.002)
+    started = time.perf_counter()
+    for _ in range(repeat):
+        body = metrics.registry.render()
+    return (time.perf_counter() - started) / repeat * 1000, len(body.encode())
+
+
+async def main(updates: int) -> None:
+    results = await _feed(updates, rounds=10)
+    plain = results["without middleware"]
+    print(f"feed_update, {updates} message updates per variant (median of 10 rounds):")
+    for label, micros in results.items():
+        print(f"  {label:<26} {micros:7.1f} us/update  ({micros - plain:+.1f} us)")
+    db_us, marzban_us = _hooks(updates * 5)
+    print(f"observer hooks: observe_db {db_us:.2f} us/call, observe_marzban {marzban_us:.2f} us/call")
+    render_ms, size = _render(handlers=40, endpoints=10, repeat=200)
+    print(f"/metrics render (40 handlers, 10 endpoints x 3 nodes): {render_ms:.2f} ms, {size / 1024:.1f} KiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=20000)
+    args = parser.parse_args()
+    asyncio.run(main(args.updates))
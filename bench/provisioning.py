@@ -0,0 +1,91 @@
+"""Marzban round trips and latency of ``SubscriptionService.provision_user``.
+
+Provisions ``--users`` users against the stub panel through the real
+MarzbanCluster/MarzbanService stack and an in-memory database, in three
+rounds: first purchase (create), a renewal right after it (status cache
+warm), and a renewal after the cache was dropped, e.g. by a restart. The
+stub adds ``--latency`` to every response, so latency tracks round trips.
+The stub shares the event loop with the service, so with ``--concurrency``
+above 1 latency mostly measures queueing behind the other calls.
+
+    python -m bench.provisioning --users 200 --latency 0.005
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import logging
+import time
+
+from app.config import Settings
+from app.db import Database
+from app.repositories.payment_repository import PaymentRepository
+from app.repositories.user_repository import UserRepository
+from app.services.marzban import MarzbanService
+from app.services.marzban_cluster import MarzbanCluster
+from app.services.subscription import SubscriptionService
+from bench.common import summarize
+from bench.stub_marzban import StubMarzban
+
+
+async def _round(
+    service: SubscriptionService, stub: StubMarzban, users: int, concurrency: int, label: str
+) -> None:
+    tariff = service.get_tariff("m1")
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+
+    async def one(telegram_id: int) -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            async with service._user_lock(telegram_id):
+                await service.provision_user(telegram_id, tariff)
+            latencies.append(time.perf_counter() - started)
+
+    stub.reset()
+    started = time.perf_counter()
+    await asyncio.gather(*(one(telegram_id) for telegram_id in range(1, users + 1)))
+    elapsed = time.perf_counter() - started
+    calls = ", ".join(f"{route} x{count / users:g}" for route, count in sorted(stub.requests.items()))
+    print(f"  {label:<26} {sum(stub.requests.values()) / users:.1f} round trips/op ({calls})")
+    print(f"  {'':<26} {users / elapsed:.0f} ops/s {summarize(latencies)}")
+
+
+async def main(users: int, concurrency: int, latency: float) -> None:
+    logging.disable(logging.INFO)
+    stub = StubMarzban(latency)
+    base_url = await stub.start()
+    settings = Settings(
+        _env_file=None,
+        telegram_token="123456:bench-token",
+        marzban_base_url=base_url,
+        marzban_api_key="admin:secret",
+        payment_provider_key="",
+        payment_public_key="",
+        payment_webhook_secret="",
+    )
+    db = Database(":memory:")
+    await db.connect()
+    cluster = MarzbanCluster({"default": MarzbanService(base_url, settings.marzban_api_key)}, health_interval=0)
+    service = SubscriptionService(settings, UserRepository(db), PaymentRepository(db), cluster)
+    print(f"{users} users, {concurrency} concurrent, stub latency {latency * 1000:.0f}ms:")
+    try:
+        await _round(service, stub, users, concurrency, "first purchase")
+        await _round(service, stub, users, concurrency, "renewal, warm cache")
+        for telegram_id in range(1, users + 1):
+            service.status_cache.invalidate(f"tg_{telegram_id}")
+        await _round(service, stub, users, concurrency, "renewal, cold cache")
+    finally:
+        await cluster.close()
+        await db.close()
+        await stub.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.005, help="stub server delay per request, seconds")
+    args = parser.parse_args()
+    asyncio.run(main(args.users, args.concurrency, args.latency))
@@ -0,0 +1,175 @@
+"""In-process stub of the Marzban API used by the benchmarks.
+
+Implements just the routes MarzbanService calls, keeps users in memory and
+counts requests per route so a benchmark can report round trips. ``latency``
+adds a fixed server-side delay to every response.
+
+Run standalone with ``python -m bench.stub_marzban --port 8900``.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+from collections import Counter
+import time
+from typing import Any
+
+from aiohttp import web
+
+TOKEN = "stub-token"
+
+
+class StubMarzban:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.users: dict[str, dict[str, Any]] = {}
+        self.requests: Counter[str] = Counter()
+        self.peers: set[tuple[str, int]] = set()
+        self.base_url = ""
+        self._runner: web.AppRunner | None = None
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self._count])
+        app.add_routes(
+            [
+                web.post("/api/admin/token", self.token),
+                web.post("/api/user", self.create_user),
+                web.get("/api/user/{username}", self.get_user),
+                web.put("/api/user/{username}", self.modify_user),
+                web.delete("/api/user/{username}", self.delete_user),
+                web.post("/api/user/{username}/renew", self.renew_user),
+                web.get("/api/user/{username}/subscription", self.subscription),
+                web.get("/api/users", self.list_users),
+                web.get("/api/system", self.system),
+            ]
+        )
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        sockets = site._server.sockets  # type: ignore[union-attr]
+        self.base_url = f"http://{host}:{sockets[0].getsockname()[1]}"
+        return self.base_url
+
+    async def close(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    @property
+    def connections(self) -> int:
+        """Distinct client sockets seen since the last ``reset``."""
+        return len(self.peers)
+
+    def reset(self) -> None:
+        self.requests.clear()
+        self.peers.clear()
+
+    @web.middleware
+    async def _count(self, request: web.Request, handler: Any) -> web.StreamResponse:
+        resource = request.match_info.route.resource
+        self.requests[f"{request.method} {resource.canonical if resource else request.path}"] += 1
+        peer = request.transport.get_extra_info("peername") if request.transport else None
+        if peer:
+            self.peers.add(tuple(peer[:2]))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if request.path != "/api/admin/token" and request.headers.get("Authorization") != f"Bearer {TOKEN}":
+            return web.json_response({"detail": "Not authenticated"}, status=401)
+        return await handler(request)
+
+    async def token(self, request: web.Request) -> web.Response:
+        return web.json_response({"access_token": TOKEN, "token_type": "bearer"})
+
+    def add_user(self, username: str, expire: int = 0) -> dict[str, Any]:
+        """Seed a user without going through the API (and its request counters)."""
+        self.users[username] = self._user(username, expire)
+        return self.users[username]
+
+    def _user(self, username: str, expire: int, data_limit: int | None = None) -> dict[str, Any]:
+        return {
+            "username": username,
+            "uuid": f"uuid-{username}",
+            "expire": expire,
+            "data_limit": data_limit,
+            "used_traffic": 0,
+            "status": "active",
+            "subscription_url": f"/sub/{username}",
+        }
+
+    async def create_user(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        username = body["username"]
+        if username in self.users:
+            return web.json_response({"detail": "User already exists"}, status=409)
+        self.users[username] = self._user(username, int(body.get("expire") or 0), body.get("data_limit"))
+        return web.json_response(self.users[username])
+
+    async def get_user(self, request: web.Request) -> web.Response:
+        user = self.users.get(request.match_info["username"])
+        if user is None:
+            return web.json_response({"detail": "User not found"}, status=404)
+        return web.json_response(user)
+
+    async def modify_user(self, request: web.Request) -> web.Response:
+        user = self.users.get(request.match_info["username"])
+        if user is None:
+            return web.json_response({"detail": "User not found"}, status=404)
+        body = await request.json()
+        if "expire" in body:
+            user["expire"] = int(body["expire"])
+        return web.json_response(user)
+
+    async def renew_user(self, request: web.Request) -> web.Response:
+        user = self.users.get(request.match_info["username"])
+        if user is None:
+            return web.json_response({"detail": "User not found"}, status=404)
+        body = await request.json()
+        user["expire"] = max(int(user["expire"] or 0), int(time.time())) + int(body.get("add_days", 0)) * 86400
+        return web.json_response(user)
+
+    async def subscription(self, request: web.Request) -> web.Response:
+        user = self.users.get(request.match_info["username"])
+        if user is None:
+            return web.json_response({"detail": "User not found"}, status=404)
+        return web.json_response({"url": user["subscription_url"]})
+
+    async def delete_user(self, request: web.Request) -> web.Response:
+        if self.users.pop(request.match_info["username"], None) is None:
+            return web.json_response({"detail": "User not found"}, status=404)
+        return web.json_response({"detail": "User successfully deleted"})
+
+    async def list_users(self, request: web.Request) -> web.Response:
+        offset = int(request.query.get("offset", 0))
+        limit = int(request.query.get("limit", 100))
+        users = list(self.users.values())
+        return web.json_response({"users": users[offset : offset + limit], "total": len(users)})
+
+    async def system(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "total_user": len(self.users),
+                "users_active": len(self.users),
+                "incoming_bandwidth": 0,
+                "outgoing_bandwidth": 0,
+                "time": int(time.time()),
+            }
+        )
+
+
+async def _serve(host: str, port: int, latency: float) -> None:
+    stub = StubMarzban(latency)
+    print("Stub Marzban listening on", await stub.start(host, port))
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=0.0, help="server-side delay per request, seconds")
+    args = parser.parse_args()
+    asyncio.run(_serve(args.host, args.port, args.latency))
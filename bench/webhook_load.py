@@ -0,0 +1,158 @@
+"""Load test for webhook-mode update delivery.
+
+Replays the recorded updates in ``bench/data/updates.jsonl`` (renumbered so
+every request is a distinct update) against a local ``TelegramWebhookHandler``
+for several ``--concurrency`` limits. The dispatcher's handlers only sleep for
+``--work`` seconds, standing in for database and Marzban calls, and never call
+the Bot API. A final run closes the handler mid-load and checks that every
+accepted update finished draining and that later requests get 503.
+
+    python -m bench.webhook_load --updates 2000 --work 0.02
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+from pathlib import Path
+import time
+from typing import Any
+
+import aiohttp
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import CallbackQuery, Message
+
+from app.server import TelegramWebhookHandler
+
+UPDATES = Path(__file__).with_name("data") / "updates.jsonl"
+PATH = "/telegram/webhook"
+SECRET = "bench-secret"
+
+
+class _Counter:
+    def __init__(self) -> None:
+        self.done = 0
+        self.in_flight = 0
+        self.peak = 0
+
+
+def _dispatcher(work: float, counter: _Counter) -> Dispatcher:
+    dp = Dispatcher()
+
+    async def handle(event: Any) -> None:
+        counter.in_flight += 1
+        counter.peak = max(counter.peak, counter.in_flight)
+        try:
+            await asyncio.sleep(work)
+        finally:
+            counter.in_flight -= 1
+            counter.done += 1
+
+    async def on_message(message: Message) -> None:
+        await handle(message)
+
+    async def on_callback(callback: CallbackQuery) -> None:
+        await handle(callback)
+
+    dp.message.register(on_message)
+    dp.callback_query.register(on_callback)
+    return dp
+
+
+def _load_updates(count: int) -> list[bytes]:
+    recorded = [json.loads(line) for line in UPDATES.read_text(encoding="utf-8").splitlines() if line.strip()]
+    payloads = []
+    for index in range(count):
+        update = dict(recorded[index % len(recorded)])
+        update["update_id"] = index + 1
+        payloads.append(json.dumps(update).encode())
+    return payloads
+
+
+async def _serve(handler: TelegramWebhookHandler) -> tuple[web.AppRunner, str]:
+    app = web.Application()
+    handler.register(app, path=PATH)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]  # type: ignore[union-attr]
+    return runner, f"http://127.0.0.1:{port}{PATH}"
+
+
+async def _post_all(url: str, payloads: list[bytes], clients: int) -> list[int]:
+    statuses: list[int] = []
+    queue: asyncio.Queue[bytes] = asyncio.Queue()
+    for payload in payloads:
+        queue.put_nowait(payload)
+    headers = {"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": SECRET}
+
+    async def client(session: aiohttp.ClientSession) -> None:
+        while not queue.empty():
+            payload = queue.get_nowait()
+            async with session.post(url, data=payload, headers=headers) as resp:
+                statuses.append(resp.status)
+
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(client(session) for _ in range(clients)))
+    return statuses
+
+
+async def _run(payloads: list[bytes], concurrency: int, work: float, clients: int) -> None:
+    counter = _Counter()
+    bot = Bot("123456:bench-token")
+    handler = TelegramWebhookHandler(_dispatcher(work, counter), bot, concurrency, 30.0, secret_token=SECRET)
+    runner, url = await _serve(handler)
+    started = time.perf_counter()
+    statuses = await _post_all(url, payloads, clients)
+    while counter.done < len(payloads):
+        await asyncio.sleep(0.005)
+    elapsed = time.perf_counter() - started
+    await handler.close()
+    await runner.cleanup()
+    ok = statuses.count(200)
+    print(
+        f"  concurrency={concurrency:<4} {len(payloads) / elapsed:8.0f} updates/s  "
+        f"ok={ok}/{len(payloads)} peak in flight={counter.peak}"
+    )
+
+
+async def _run_drain(payloads: list[bytes], concurrency: int, work: float, clients: int) -> None:
+    counter = _Counter()
+    bot = Bot("123456:bench-token")
+    handler = TelegramWebhookHandler(_dispatcher(work, counter), bot, concurrency, 30.0, secret_token=SECRET)
+    runner, url = await _serve(handler)
+    statuses = await _post_all(url, payloads, clients)
+    accepted = statuses.count(200)
+    started = time.perf_counter()
+    await handler.close()
+    drained_in = time.perf_counter() - started
+    late = await _post_all(url, payloads[:10], 1)
+    await runner.cleanup()
+    print(
+        f"  accepted={accepted} finished by close()={counter.done} "
+        f"drain took {drained_in * 1000:.0f}ms, requests after close: {sorted(set(late))}"
+    )
+    if counter.done != accepted or set(late) != {503}:
+        raise SystemExit("drain check failed")
+
+
+async def main(count: int, work: float, clients: int, limits: list[int]) -> None:
+    payloads = _load_updates(count)
+    print(f"{count} updates, {work * 1000:.0f}ms of work each, {clients} HTTP clients:")
+    for concurrency in limits:
+        await _run(payloads, concurrency, work, clients)
+    print("graceful drain:")
+    await _run_drain(payloads[: max(limits) * 2], max(limits), work * 10, clients)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--work", type=float, default=0.02, help="simulated handler time per update, seconds")
+    parser.add_argument("--clients", type=int, default=64, help="concurrent HTTP senders")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 16, 64, 256])
+    args = parser.parse_args()
+    asyncio.run(main(args.updates, args.work, args.clients, args.concurrency))
@@ -1,67 +1,274 @@
 from __future__ import annotations
 
 from aiogram.client.default import DefaultBotProperties
+from aiogram.fsm.storage.base import BaseStorage
 from aiogram.fsm.storage.memory import MemoryStorage
 
 import logging
 import asyncio
+import signal
 
 from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import setup_application
+from aiohttp import web
 
 from app.config import Settings
 from app.db import Database
 from app.handlers import admin, help, install, purchase, referral, renew, start, status, trial
+from app.repositories.broadcast_repository import BroadcastRepository
+from app.repositories.fsm_repository import FSMRepository
+from app.repositories.job_repository import ProvisioningJobRepository
+from app.repositories.lock_repository import LockRepository
 from app.repositories.payment_repository import PaymentRepository
 from app.repositories.referral_repository import ReferralRepository
+from app.repositories.reminder_repository import ReminderRepository
+from app.repositories.stats_repository import StatsRepository
+from app.repositories.token_repository import TokenRepository
 from app.repositories.user_repository import UserRepository
-from app.services.context import DependencyMiddleware
+from app.server import MetricsApp, TelegramWebhookHandler, WebhookApp
+from app.services.broadcast import BroadcastService
+from app.services.context import DependencyMiddleware, InstrumentationMiddleware, ThrottlingMiddleware
+from app.services.fsm_storage import SQLiteStorage
+from app.services.locks import KeyedLock, LockBackend, SQLiteLeaseLock
 from app.services.marzban import MarzbanService
+from app.services.marzban_cluster import MarzbanCluster
+from app.services.marzban_sync import MarzbanSyncWorker
+from app.services.metrics import BotMetrics
 from app.services.payments import PaymentService
+from app.services.provisioning import ProvisioningQueue
+from app.services.reconciliation import PendingPaymentWorker
 from app.services.referral import ReferralService
+from app.services.reminders import ReminderScheduler
+from app.services.stats import StatsService
 from app.services.subscription import SubscriptionService
 
 logging.basicConfig(level=logging.INFO)
 
 
+async def start_web_app(app: web.Application, settings: Settings) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, settings.webhook_host, settings.webhook_port)
+    await site.start()
+    logging.info("HTTP server listening on %s:%s", settings.webhook_host, settings.webhook_port)
+    return runner
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher, settings: Settings, app: web.Application) -> None:
+    handler = TelegramWebhookHandler(
+        dp,
+        bot,
+        concurrency=settings.update_concurrency,
+        drain_timeout=settings.shutdown_drain_timeout,
+        secret_token=settings.telegram_webhook_secret,
+    )
+    handler.register(app, path=settings.telegram_webhook_path)
+    setup_application(app, dp, bot=bot)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    runner = await start_web_app(app, settings)
+    await bot.set_webhook(
+        settings.telegram_webhook_url.rstrip("/") + settings.telegram_webhook_path,
+        secret_token=settings.telegram_webhook_secret,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    try:
+        await stop.wait()
+    finally:
+        # Runs the handler's close(), which drains in-flight updates.
+        await runner.cleanup()
+
+
+def _register_gauges(
+    metrics: BotMetrics,
+    db: Database,
+    marzban: MarzbanCluster,
+    subscription_service: SubscriptionService,
+    provisioning_queue: ProvisioningQueue,
+    pending_worker: PendingPaymentWorker,
+    marzban_sync: MarzbanSyncWorker,
+    reminders: ReminderScheduler,
+    throttling: ThrottlingMiddleware,
+) -> None:
+    registry = metrics.registry
+    registry.gauge("db_statements", "SQLite statements issued since start.", lambda: [({}, db.statements)])
+    registry.gauge(
+        "status_cache",
+        "Marzban status cache size and hit counters.",
+        lambda: [({"stat": key}, value) for key, value in subscription_service.status_cache.stats().items()],
+    )
+    registry.gauge(
+        "provisioning_jobs",
+        "Provisioning queue outcomes since start.",
+        lambda: [({"outcome": key}, value) for key, value in vars(provisioning_queue.metrics).items()],
+    )
+    registry.gauge(
+        "pending_reconciliation",
+        "Pending-payment worker counters.",
+        lambda: [
+            ({"stat": key}, value)
+            for key, value in vars(pending_worker.metrics).items()
+            if isinstance(value, (int, float))
+        ],
+    )
+    registry.gauge(
+        "marzban_sync",
+        "Marzban user sync counters.",
+        lambda: [
+            ({"stat": key}, value)
+            for key, value in vars(marzban_sync.metrics).items()
+            if isinstance(value, (int, float))
+        ],
+    )
+    registry.gauge("reminders_sent", "Expiry reminders sent since start.", lambda: [({}, reminders.sent)])
+    registry.gauge("throttled_updates", "Updates dropped by per-user throttling.", lambda: [({}, throttling.throttled)])
+    registry.gauge(
+        "throttle_buckets", "Per-user throttle buckets held in memory.", lambda: [({}, throttling.tracked_users())]
+    )
+    registry.gauge(
+        "marzban_node_healthy",
+        "1 if the node is admitted for provisioning.",
+        lambda: [({"node": name}, int(health.healthy)) for name, health in marzban.health.items()],
+    )
+    registry.gauge(
+        "marzban_node_latency_ms",
+        "Smoothed health-check latency.",
+        lambda: [
+            ({"node": name}, health.latency_ms)
+            for name, health in marzban.health.items()
+            if health.latency_ms is not None
+        ],
+    )
+    registry.gauge(
+        "marzban_node_users",
+        "Users on the node as last reported by the panel.",
+        lambda: [({"node": name}, load.users) for name, load in marzban.loads.items()],
+    )
+    registry.gauge(
+        "marzban_breaker_open",
+        "1 while the endpoint's circuit breaker rejects calls.",
+        lambda: [
+            ({"node": node, "endpoint": endpoint}, int(state != "closed"))
+            for node, service in marzban.nodes.items()
+            for endpoint, state in service.breaker_states().items()
+        ],
+    )
+
+
 async def main() -> None:
     settings = Settings()
-    db = Database(settings.database_path)
+    db = Database(
+        settings.database_path,
+        readers=settings.database_readers,
+        busy_timeout_ms=settings.database_busy_timeout_ms,
+        statement_cache_size=settings.database_statement_cache_size,
+    )
     await db.connect()
+    metrics = BotMetrics()
+    if settings.metrics_enabled:
+        db.observer = metrics.observe_db
 
     user_repo = UserRepository(db)
     payment_repo = PaymentRepository(db)
     referral_repo = ReferralRepository(db)
+    broadcast_repo = BroadcastRepository(db)
+    job_repo = ProvisioningJobRepository(db)
 
-    marzban = MarzbanService(settings.marzban_base_url, settings.marzban_api_key)
+    token_repo = TokenRepository(db)
+    nodes = settings.cluster_nodes()
+    marzban = MarzbanCluster(
+        {
+            node.name: MarzbanService(
+                node.base_url,
+                node.api_key,
+                connection_limit=settings.marzban_connection_limit,
+                dns_cache_ttl=settings.marzban_dns_cache_ttl,
+                keepalive_timeout=settings.marzban_keepalive_timeout,
+                request_timeout=settings.marzban_request_timeout,
+                request_budget=settings.marzban_request_budget,
+                max_concurrency=settings.marzban_max_concurrency,
+                retry_attempts=settings.marzban_retry_attempts,
+                retry_base_delay=settings.marzban_retry_base_delay,
+                retry_max_delay=settings.marzban_retry_max_delay,
+                breaker_threshold=settings.marzban_breaker_threshold,
+                breaker_reset=settings.marzban_breaker_reset,
+                token_repository=token_repo,
+                token_refresh_margin=settings.marzban_token_refresh_margin,
+                name=node.name,
+            )
+            for node in nodes
+        },
+        placement=settings.marzban_placement,
+        health_interval=settings.marzban_health_interval,
+        health_timeout=settings.marzban_health_timeout,
+        unhealthy_after=settings.marzban_unhealthy_after,
+        healthy_after=settings.marzban_healthy_after,
+        max_users={node.name: node.max_users for node in nodes},
+    )
     payment_service = PaymentService(settings, payment_repo)
     referral_service = ReferralService(settings, referral_repo, user_repo)
-    subscription_service = SubscriptionService(settings, user_repo, payment_repo, marzban)
+    stats_service = StatsService(StatsRepository(db), ttl=settings.stats_cache_ttl)
+    if settings.lock_backend == "sqlite":
+        user_locks: LockBackend = SQLiteLeaseLock(LockRepository(db), ttl=settings.lock_lease_ttl)
+    else:
+        user_locks = KeyedLock(stripes=settings.user_lock_stripes)
+    if settings.metrics_enabled:
+        for service in marzban.nodes.values():
+            service.observer = metrics.observe_marzban
+    subscription_service = SubscriptionService(settings, user_repo, payment_repo, marzban, locks=user_locks)
 
     bot = Bot(
         token=settings.telegram_token,
         default=DefaultBotProperties(parse_mode="HTML"),
     )
-    dp = Dispatcher(storage=MemoryStorage())
+    if settings.fsm_storage == "sqlite":
+        storage: BaseStorage = SQLiteStorage(
+            FSMRepository(db),
+            flush_interval=settings.fsm_flush_interval,
+            cache_ttl=settings.fsm_cache_ttl,
+            state_ttl=settings.fsm_state_ttl,
+        )
+        storage.start()
+    else:
+        storage = MemoryStorage()
+    dp = Dispatcher(storage=storage)
+
+    broadcast_service = BroadcastService(bot, user_repo, broadcast_repo, settings)
+    provisioning_queue = ProvisioningQueue(bot, settings, job_repo, payment_repo, subscription_service)
+    pending_worker = PendingPaymentWorker(bot, settings, payment_repo, subscription_service)
+    marzban_sync = MarzbanSyncWorker(settings, user_repo, marzban, subscription_service)
+    reminders = ReminderScheduler(bot, settings, ReminderRepository(db), user_repo)
+    subscription_service.add_expiry_listener(reminders.on_expiry_changed)
 
     bot_info = await bot.get_me()
-    dp.message.middleware(DependencyMiddleware(
+    dependencies = DependencyMiddleware(
         payment_service=payment_service,
         subscription_service=subscription_service,
         referral_service=referral_service,
+        broadcast_service=broadcast_service,
+        pending_worker=pending_worker,
+        provisioning_queue=provisioning_queue,
+        marzban_cluster=marzban,
+        stats_service=stats_service,
         user_repo=user_repo,
         payment_repo=payment_repo,
         settings=settings,
         bot_username=bot_info.username,
-    ))
-    dp.callback_query.middleware(DependencyMiddleware(
-        payment_service=payment_service,
-        subscription_service=subscription_service,
-        referral_service=referral_service,
-        user_repo=user_repo,
-        payment_repo=payment_repo,
-        settings=settings,
-        bot_username=bot_info.username,
-    ))
+    )
+    throttling = ThrottlingMiddleware(settings)
+    dp.message.middleware(throttling)
+    dp.callback_query.middleware(throttling)
+    if settings.metrics_enabled:
+        instrumentation = InstrumentationMiddleware(metrics)
+        dp.message.middleware(instrumentation)
+        dp.callback_query.middleware(instrumentation)
+        dp.pre_checkout_query.middleware(instrumentation)
+    dp.message.middleware(dependencies)
+    dp.callback_query.middleware(dependencies)
 
     dp.include_router(start.router)
     dp.include_router(purchase.router)
@@ -73,7 +280,53 @@ async def main() -> None:
     dp.include_router(help.router)
     dp.include_router(admin.router)
 
-    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    await broadcast_service.resume_unfinished()
+    await provisioning_queue.start()
+    pending_worker.start()
+    marzban.start()
+    marzban_sync.start()
+    reminders.start()
+    stats_service.start()
+
+    app = web.Application()
+    if settings.payment_webhook_secret:
+        WebhookApp(payment_service, provisioning_queue, settings.webhook_path).register(app)
+    if settings.metrics_enabled:
+        _register_gauges(
+            metrics,
+            db,
+            marzban,
+            subscription_service,
+            provisioning_queue,
+            pending_worker,
+            marzban_sync,
+            reminders,
+            throttling,
+        )
+        MetricsApp(metrics.registry, settings.metrics_path).register(app)
+
+    try:
+        if settings.telegram_webhook_url:
+            await run_webhook(bot, dp, settings, app)
+        else:
+            serve_http = settings.payment_webhook_secret or settings.metrics_enabled
+            runner = await start_web_app(app, settings) if serve_http else None
+            try:
+                await bot.delete_webhook()
+                await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+            finally:
+                if runner is not None:
+                    await runner.cleanup()
+    finally:
+        await stats_service.close()
+        await reminders.close()
+        await marzban_sync.close()
+        await pending_worker.close()
+        await provisioning_queue.close()
+        await broadcast_service.close()
+        await storage.close()
+        await marzban.close()
+        await db.close()
 
 
 if __name__ == "__main__":